@@ -0,0 +1,167 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Precomputed stargate jump distances between every pair of k-space systems.
+
+The table is built from SystemJump by the buildjumptable management command
+and stored as two files: <path>.npy holds an N x N uint8 matrix of jump
+counts indexed by a dense system index, memory mapped when loaded so every
+process shares the same pages, and <path>.npz holds the system ids and the
+gate adjacency used to reconstruct routes.
+"""
+import os
+
+import numpy as np
+
+# Distance stored for pairs of systems that have no stargate route
+UNREACHABLE = 255
+
+
+class NoRouteError(Exception):
+    """Raised when there is no stargate route between two systems."""
+    pass
+
+
+class JumpTable(object):
+    """All-pairs jump distances with route reconstruction."""
+    def __init__(self, system_ids, distances, indptr, neighbours):
+        # system_ids is sorted; _index maps each id to its row
+        self.system_ids = system_ids
+        self.distances = distances
+        self.indptr = indptr
+        self.neighbours = neighbours
+        self._index = dict((int(x), i) for i, x in enumerate(system_ids))
+
+    @classmethod
+    def build(cls, edges):
+        """Builds a table from an iterable of (from_id, to_id) gate pairs.
+
+        Gates are treated as two way. Distances are found with one
+        breadth-first search per jump level run for every source at once.
+        """
+        edges = np.array(list(edges), dtype=np.int64).reshape(-1, 2)
+        edges = np.vstack((edges, edges[:, ::-1]))
+        system_ids = np.unique(edges)
+        edges = np.searchsorted(system_ids, edges)
+        edges = np.unique(edges[:, 0] * len(system_ids) + edges[:, 1])
+        sources = (edges // len(system_ids)).astype(np.int32)
+        neighbours = (edges % len(system_ids)).astype(np.int32)
+        size = len(system_ids)
+        indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=size), out=indptr[1:])
+
+        distances = np.full((size, size), UNREACHABLE, dtype=np.uint8)
+        # reached[i, j] and frontier[i, j] are indexed [system, source]
+        frontier = np.eye(size, dtype=bool)
+        reached = frontier.copy()
+        np.fill_diagonal(distances, 0)
+        has_neighbours = indptr[1:] > indptr[:-1]
+        level = 0
+        while frontier.any():
+            level += 1
+            if level >= UNREACHABLE:
+                raise ValueError('Route longer than the table can store')
+            expanded = np.zeros_like(frontier)
+            expanded[has_neighbours] = np.logical_or.reduceat(
+                frontier[neighbours], indptr[:-1][has_neighbours], axis=0)
+            frontier = expanded & ~reached
+            reached |= frontier
+            distances[frontier.T] = level
+        return cls(system_ids, distances, indptr, neighbours)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the table saved at path, or returns None if there isn't
+        one.
+        """
+        if not (os.path.exists(path + '.npy') and
+                os.path.exists(path + '.npz')):
+            return None
+        index = np.load(path + '.npz')
+        return cls(index['system_ids'], np.load(path + '.npy', mmap_mode='r'),
+                   index['indptr'], index['neighbours'])
+
+    def save(self, path):
+        """Saves the table to path.npy and path.npz.
+
+        The files are written next to the destination and renamed so
+        processes loading the table never see a partial file.
+        """
+        np.save(path + '.tmp.npy', self.distances)
+        np.savez(path + '.tmp.npz', system_ids=self.system_ids,
+                 indptr=self.indptr, neighbours=self.neighbours)
+        os.rename(path + '.tmp.npy', path + '.npy')
+        os.rename(path + '.tmp.npz', path + '.npz')
+
+    def __contains__(self, system_id):
+        return system_id in self._index
+
+    def _get_index(self, system_id):
+        try:
+            return self._index[system_id]
+        except KeyError:
+            raise NoRouteError('System %s is not in the jump table'
+                               % system_id)
+
+    def jumps(self, sys1_id, sys2_id):
+        """Returns the number of jumps between two system ids."""
+        distance = self.distances[self._get_index(sys1_id),
+                                  self._get_index(sys2_id)]
+        if distance == UNREACHABLE:
+            raise NoRouteError('No route from %s to %s' % (sys1_id, sys2_id))
+        return int(distance)
+
+    def route(self, sys1_id, sys2_id):
+        """Returns the system ids of a shortest route, including both ends.
+
+        Each step moves to the first neighbour one jump closer to the
+        destination.
+        """
+        self.jumps(sys1_id, sys2_id)
+        target = self._get_index(sys2_id)
+        # Gates are two way, so the target's row holds the distance from
+        # every system to it and is contiguous in the file.
+        to_target = self.distances[target]
+        current = self._get_index(sys1_id)
+        route = [current]
+        while current != target:
+            options = self.neighbours[self.indptr[current]:
+                                      self.indptr[current + 1]]
+            current = options[to_target[options] ==
+                              to_target[current] - 1][0]
+            route.append(current)
+        return [int(self.system_ids[x]) for x in route]
+
+    def closest(self, source_ids, target_ids):
+        """
+        Returns a dict mapping each of target_ids to a (source_id, jumps)
+        tuple for the nearest of source_ids, or None if none can reach it.
+        Ties go to the source listed first.
+        """
+        sources = [x for x in source_ids if x in self._index]
+        result = dict((x, None) for x in target_ids)
+        targets = [x for x in target_ids if x in self._index]
+        if not sources or not targets:
+            return result
+        # Rows are per target so each read is a contiguous slice
+        distances = self.distances[
+            np.ix_([self._index[x] for x in targets],
+                   [self._index[x] for x in sources])]
+        nearest = distances.argmin(axis=1)
+        for row, target in enumerate(targets):
+            jumps = int(distances[row, nearest[row]])
+            if jumps != UNREACHABLE:
+                result[target] = (sources[nearest[row]], jumps)
+        return result
@@ -0,0 +1,232 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Tracks which system each pilot's characters are in.
+
+Every character has its own entry holding its user, system and ship, so
+a checkin only writes that character's entry. Indexes of the characters
+in each system and of each user are written when a character moves and
+checked against the entries when read, so characters that have moved on
+are simply skipped. Entries expire LOCATION_TIMEOUT seconds after their
+last update. The store class is chosen with the MAP_LOCATION_BACKEND
+setting.
+"""
+from collections import namedtuple
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+# Seconds a location is kept after the character's last checkin
+LOCATION_TIMEOUT = 15 * 60
+
+_store = None
+
+
+def get_store():
+    """Returns the location store instance for this process."""
+    global _store
+    if _store is None:
+        _store = import_string(settings.MAP_LOCATION_BACKEND)()
+    return _store
+
+
+# The fields are ordered so templates indexing the old location tuples
+# (username, charname, shipname, shiptype, time) keep working.
+Location = namedtuple('Location', ['username', 'charname', 'shipname',
+                                   'shiptype', 'timestamp', 'system_id',
+                                   'user_id'])
+
+
+class BaseLocationStore(object):
+    """Interface for location stores.
+
+    Locations are returned as dicts mapping character ids to Location
+    tuples.
+    """
+    def update(self, user, system_id, charid, charname, shipname, shiptype):
+        """Records that the character is in system_id and returns its
+        Location.
+        """
+        raise NotImplementedError
+
+    def remove(self, charid):
+        """Forgets the character's location."""
+        raise NotImplementedError
+
+    def systems(self, system_ids):
+        """Returns a dict mapping each of system_ids that has characters
+        in it to the locations of those characters.
+        """
+        raise NotImplementedError
+
+    def system(self, system_id):
+        """Returns the locations of the characters in system_id."""
+        return self.systems([system_id]).get(system_id, {})
+
+    def user(self, user_id):
+        """Returns the locations of the user's characters."""
+        raise NotImplementedError
+
+    @staticmethod
+    def _make_location(user, system_id, charname, shipname, shiptype):
+        return Location(user.username, charname, shipname, shiptype,
+                        time.time(), system_id, user.pk)
+
+    @staticmethod
+    def _by_system(locations, system_ids):
+        result = {}
+        for charid, location in locations.items():
+            if location.system_id in system_ids:
+                result.setdefault(location.system_id, {})[charid] = location
+        return result
+
+
+class LocalLocationStore(BaseLocationStore):
+    """Keeps locations in memory.
+
+    Only the current process sees the locations, so this is meant for
+    tests and single process development servers.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locations = {}
+
+    def _current(self):
+        threshold = time.time() - LOCATION_TIMEOUT
+        return dict((k, v) for k, v in self._locations.items()
+                    if v.timestamp >= threshold)
+
+    def update(self, user, system_id, charid, charname, shipname, shiptype):
+        location = self._make_location(user, system_id, charname, shipname,
+                                       shiptype)
+        with self._lock:
+            self._locations[charid] = location
+        return location
+
+    def remove(self, charid):
+        with self._lock:
+            self._locations.pop(charid, None)
+
+    def systems(self, system_ids):
+        with self._lock:
+            return self._by_system(self._current(), set(system_ids))
+
+    def user(self, user_id):
+        with self._lock:
+            return dict((k, v) for k, v in self._current().items()
+                        if v.user_id == user_id)
+
+
+class CacheLocationStore(BaseLocationStore):
+    """Shares locations between processes through the Django cache.
+
+    Each character's entry is stored under its own key with the time its
+    index memberships were last written. Checkins from a character that
+    has not moved only rewrite that entry. Index writes hold a short lock
+    taken with cache.add, so characters moving into the same system at
+    once are not lost, and drop members whose entries have expired or
+    moved elsewhere. Reads take two cache round trips however many
+    systems and characters they cover.
+    """
+    # Seconds between rewrites of the indexes of a character that stays
+    # put, so it is found again if an index is evicted
+    reindex_interval = 5 * 60
+    # Seconds a lock on an index is held at most
+    lock_timeout = 5
+    # Attempts to take a lock on an index, lock_wait seconds apart
+    lock_attempts = 100
+    lock_wait = 0.01
+
+    @staticmethod
+    def _entry_key(charid):
+        return 'location_char_%s' % charid
+
+    @staticmethod
+    def _system_key(system_id):
+        return 'location_sys_%s' % system_id
+
+    @staticmethod
+    def _user_key(user_id):
+        return 'location_user_%s' % user_id
+
+    def update(self, user, system_id, charid, charname, shipname, shiptype):
+        location = self._make_location(user, system_id, charname, shipname,
+                                       shiptype)
+        entry_key = self._entry_key(charid)
+        previous = cache.get(entry_key)
+        if (previous is not None and
+                previous[0].system_id == system_id and
+                previous[0].user_id == user.pk and
+                location.timestamp - previous[1] < self.reindex_interval):
+            cache.set(entry_key, (location, previous[1]), LOCATION_TIMEOUT)
+            return location
+        # The entry is written first so the index writes below, ours or
+        # another character's, see this character where it now is.
+        cache.set(entry_key, (location, location.timestamp),
+                  LOCATION_TIMEOUT)
+        indexed = (
+            self._add_member(self._system_key(system_id), charid,
+                             lambda x: x.system_id == system_id) and
+            self._add_member(self._user_key(user.pk), charid,
+                             lambda x: x.user_id == user.pk))
+        if not indexed:
+            # Have the next checkin try again
+            cache.set(entry_key, (location, 0), LOCATION_TIMEOUT)
+        return location
+
+    def _add_member(self, index_key, charid, belongs):
+        """Adds charid to the index under index_key, dropping members
+        whose current location does not satisfy belongs. Returns False if
+        the index stayed locked.
+        """
+        lock_key = '%s_lock' % index_key
+        for _ in range(self.lock_attempts):
+            if cache.add(lock_key, 1, self.lock_timeout):
+                try:
+                    members = cache.get(index_key) or frozenset()
+                    current = self._get_entries(members)
+                    members = set(x for x in members
+                                  if x in current and belongs(current[x]))
+                    members.add(charid)
+                    cache.set(index_key, frozenset(members), None)
+                finally:
+                    cache.delete(lock_key)
+                return True
+            time.sleep(self.lock_wait)
+        return False
+
+    def _get_entries(self, charids):
+        keys = dict((self._entry_key(x), x) for x in charids)
+        return dict((keys[k], v[0])
+                    for k, v in cache.get_many(keys.keys()).items())
+
+    def remove(self, charid):
+        cache.delete(self._entry_key(charid))
+
+    def systems(self, system_ids):
+        system_ids = set(system_ids)
+        charids = set()
+        for members in cache.get_many(
+                [self._system_key(x) for x in system_ids]).values():
+            charids |= members
+        return self._by_system(self._get_entries(charids), system_ids)
+
+    def user(self, user_id):
+        members = cache.get(self._user_key(user_id)) or ()
+        return dict((k, v) for k, v in self._get_entries(members).items()
+                    if v.user_id == user_id)
@@ -0,0 +1,39 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from Map.jumptable import JumpTable
+from Map.utils import bump_route_version, get_kspace_gates
+import time
+
+
+class Command(NoArgsCommand):
+    help = 'Builds the stargate jump table used for k-space routes.'
+
+    def handle_noargs(self, **options):
+        """
+        Builds the jump distance table from SystemJump and saves it to
+        MAP_JUMP_TABLE_PATH. The cached networkx graph is dropped as well
+        and running processes reload both on their next route lookup.
+        """
+        start = time.time()
+        table = JumpTable.build(get_kspace_gates())
+        table.save(settings.MAP_JUMP_TABLE_PATH)
+        cache.delete('route_graph')
+        bump_route_version()
+        self.stdout.write('Built jump table for %s systems in %.1fs: %s.npy'
+                          % (len(table.system_ids), time.time() - start,
+                             settings.MAP_JUMP_TABLE_PATH))
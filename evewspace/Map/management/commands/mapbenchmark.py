@@ -0,0 +1,363 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+import cPickle
+import json
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = 'Runs a benchmark of map internals against the current database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark',
+                            choices=['routes', 'exits', 'refresh',
+                                     'checkin', 'layout', 'downtime',
+                                     'yaml'])
+        parser.add_argument('--count', type=int, default=1000,
+                            help='Number of iterations to run.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed for the random choices.')
+        parser.add_argument('--map', type=int, default=None,
+                            help='Map to use, the largest by default.')
+        parser.add_argument('--user', default=None,
+                            help='User to act as, the first superuser by '
+                                 'default.')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.options = options
+        getattr(self, 'benchmark_%s' % options['benchmark'])(options['count'])
+
+    def get_map_and_user(self):
+        """Returns the map and user given in the options."""
+        from django.contrib.auth import get_user_model
+        from django.db.models import Count
+        from Map.models import Map
+        if self.options['map']:
+            current_map = Map.objects.get(pk=self.options['map'])
+        else:
+            current_map = (Map.objects.annotate(size=Count('systems'))
+                           .order_by('-size')[0])
+        users = get_user_model().objects.order_by('pk')
+        if self.options['user']:
+            user = users.get(username=self.options['user'])
+        else:
+            user = users.filter(is_superuser=True)[0]
+        return current_map, user
+
+    def timed(self, label, func, items):
+        """Calls func with each item of items and reports the timing."""
+        start = time.time()
+        results = [func(*item) for item in items]
+        elapsed = time.time() - start
+        self.stdout.write('%-40s %10.1f ms %10.4f ms/call' % (
+            label, elapsed * 1000, elapsed * 1000 / len(items)))
+        return results
+
+    def benchmark_routes(self, count):
+        """
+        Compares route lengths from the networkx graph, unpickled per
+        lookup as RouteFinder does and shared, with the jump table. The
+        unpickling case only runs a tenth of the pairs as it is slow.
+        """
+        import networkx as nx
+        from Map.jumptable import JumpTable, NoRouteError
+        from Map.utils import get_jump_table, get_kspace_gates
+
+        edges = get_kspace_gates()
+        graph = nx.Graph(edges)
+        pickled = cPickle.dumps(graph, cPickle.HIGHEST_PROTOCOL)
+        table = get_jump_table()
+        if table is None:
+            self.stdout.write('No jump table built, building one in memory')
+            table = self.timed('JumpTable.build', JumpTable.build,
+                               [(edges,)])[0]
+        nodes = graph.nodes()
+        pairs = [(self.random.choice(nodes), self.random.choice(nodes))
+                 for _ in range(count)]
+
+        def graph_length(graph, sys1, sys2):
+            try:
+                return len(nx.shortest_path(graph, sys1, sys2)) - 1
+            except nx.NetworkXNoPath:
+                return None
+
+        def table_length(sys1, sys2):
+            try:
+                return table.jumps(sys1, sys2)
+            except NoRouteError:
+                return None
+
+        def table_route(sys1, sys2):
+            try:
+                return len(table.route(sys1, sys2)) - 1
+            except NoRouteError:
+                return None
+
+        self.stdout.write('%s random pairs of %s systems'
+                          % (count, len(nodes)))
+        expected = self.timed(
+            'networkx, graph unpickled per call',
+            lambda a, b: graph_length(cPickle.loads(pickled), a, b),
+            pairs[:max(1, count // 10)])
+        shared = self.timed('networkx, shared graph',
+                            lambda a, b: graph_length(graph, a, b), pairs)
+        lengths = self.timed('JumpTable.jumps', table_length, pairs)
+        routes = self.timed('JumpTable.route', table_route, pairs)
+        if (shared != lengths or routes != lengths or
+                expected != lengths[:len(expected)]):
+            self.stderr.write('Route lengths from the graph and the jump '
+                              'table differ')
+
+    def benchmark_exits(self, count):
+        """
+        Times finding the closest of 12 exits to each of 20 destinations,
+        per pair as destination_list does and in one pass with the jump
+        table and the multi-source search.
+        """
+        import networkx as nx
+        from Map.jumptable import JumpTable
+        from Map.utils import closest_by_bfs, get_jump_table, get_kspace_gates
+
+        edges = get_kspace_gates()
+        graph = nx.Graph(edges)
+        table = get_jump_table() or JumpTable.build(edges)
+        nodes = graph.nodes()
+        cases = [(self.random.sample(nodes, 12), self.random.sample(nodes, 20))
+                 for _ in range(count)]
+
+        def per_pair(exits, destinations):
+            result = {}
+            for destination in destinations:
+                lengths = []
+                for exit_id in exits:
+                    try:
+                        lengths.append(
+                            (len(nx.shortest_path(graph, exit_id,
+                                                  destination)) - 1,
+                             exit_id))
+                    except nx.NetworkXNoPath:
+                        pass
+                result[destination] = min(lengths)[0] if lengths else None
+            return result
+
+        def jumps_only(closest):
+            return dict((k, v and v[1]) for k, v in closest.items())
+
+        self.stdout.write('%s cases of 12 exits and 20 destinations' % count)
+        expected = self.timed('networkx, per pair', per_pair,
+                              cases[:max(1, count // 10)])
+        by_table = self.timed('JumpTable.closest', table.closest, cases)
+        by_bfs = self.timed('closest_by_bfs',
+                            lambda a, b: closest_by_bfs(graph, a, b), cases)
+        by_table = [jumps_only(x) for x in by_table]
+        if ([jumps_only(x) for x in by_bfs] != by_table or
+                expected != by_table[:len(expected)]):
+            self.stderr.write('Closest exits from the graph and the jump '
+                              'table differ')
+
+    def benchmark_refresh(self, count):
+        """
+        Times rebuilding the map JSON with config lookups served from the
+        process cache and, as before, from the database on every lookup.
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from core.models import ConfigEntry
+        from Map import utils
+
+        current_map, user = self.get_map_and_user()
+
+        def uncached_config(name, user):
+            try:
+                return ConfigEntry.objects.get(name=name, user=user)
+            except ConfigEntry.DoesNotExist:
+                return ConfigEntry.objects.get(name=name, user=None)
+
+        def refresh():
+            current_map.clear_caches()
+            utils.MapJSONGenerator(current_map, user).get_systems_json()
+
+        def run(label):
+            with CaptureQueriesContext(connection) as queries:
+                refresh()
+            self.timed('%s (%s queries)' % (label, len(queries)), refresh,
+                       [()] * count)
+
+        self.stdout.write('%s refreshes of %s (%s systems) as %s' % (
+            count, current_map.name, current_map.systems.count(),
+            user.username))
+        cached_config = utils.get_config
+        utils.get_config = uncached_config
+        try:
+            run('config from the database')
+        finally:
+            utils.get_config = cached_config
+        run('config from the process cache')
+
+    def benchmark_checkin(self, count):
+        """
+        Times count rounds of 100 clients polling the map's checkin, with
+        nothing new and with a visible log entry added every round, and
+        the timestamp range query the checkin ran before. The entries added
+        are rolled back.
+        """
+        from datetime import datetime
+        import pytz
+        from django.db import connection, transaction
+        from django.test import RequestFactory
+        from django.test.utils import CaptureQueriesContext
+        from Map.models import MapLog
+        from Map.views import map_checkin
+
+        current_map, user = self.get_map_and_user()
+        clients = 100
+        factory = RequestFactory()
+        cursors = [MapLog.get_cursor(current_map.pk)] * clients
+        load_time = datetime.now(pytz.utc)
+
+        def checkin(client):
+            request = factory.post('/map/%s/update/' % current_map.pk,
+                                   {'cursor': cursors[client]})
+            request.user = user
+            request.is_igb_trusted = False
+            response = map_checkin(request, str(current_map.pk))
+            cursors[client] = json.loads(response.content)['cursor']
+
+        def checkin_after_log(client):
+            if client == 0:
+                log = MapLog.objects.create(
+                    user=user, map=current_map, action='Benchmark checkin',
+                    timestamp=datetime.now(pytz.utc), visible=True)
+                MapLog.advance_cursor(current_map.pk, log.pk)
+            checkin(client)
+
+        def by_timestamp(client):
+            list(MapLog.objects.filter(timestamp__gt=load_time, visible=True,
+                                       map=current_map))
+
+        def run(label, func):
+            checkins = [(x,) for x in range(clients)] * count
+            with CaptureQueriesContext(connection) as queries:
+                for item in checkins[:clients]:
+                    func(*item)
+            self.timed('%s (%s queries)' % (label, len(queries)), func,
+                       checkins)
+
+        self.stdout.write('%s rounds of %s clients polling %s as %s' % (
+            count, clients, current_map.name, user.username))
+        try:
+            with transaction.atomic():
+                run('timestamp query, as before', by_timestamp)
+                run('cursor, nothing new', checkin)
+                run('cursor, one new entry per round', checkin_after_log)
+                transaction.set_rollback(True)
+        finally:
+            cache.delete(MapLog.cursor_key(current_map.pk))
+
+    def benchmark_layout(self, count):
+        """
+        Times laying out count synthetic 500 system maps, random trees and
+        a single chain, computed and from the layout cache.
+        """
+        from collections import defaultdict
+        from Map.utils import LayoutGenerator
+
+        def make_tree(size, chain=False):
+            children = defaultdict(list)
+            children[None].append(0)
+            for node in range(1, size):
+                parent = node - 1 if chain else self.random.randrange(node)
+                children[parent].append(node)
+            return children
+
+        trees = [(make_tree(500),) for _ in range(count)]
+        chains = [(make_tree(500, chain=True),)] * count
+
+        def computed(children):
+            return LayoutGenerator(children).compute_layout()
+
+        def cached(children):
+            return LayoutGenerator(children).get_layout()
+
+        self.stdout.write('%s layouts of 500 systems' % count)
+        self.timed('random trees, computed', computed, trees)
+        self.timed('chain, computed', computed, chains)
+        self.timed('random trees, first get_layout', cached, trees)
+        self.timed('random trees, cached get_layout', cached, trees)
+
+    def benchmark_downtime(self, count):
+        """
+        Times the downtime update over count activated signatures added
+        across the existing systems, set based and, for a hundredth of them,
+        row by row as it ran before. The signatures are rolled back.
+        """
+        from django.db import connection, transaction
+        from django.test.utils import CaptureQueriesContext
+        from Map.models import Signature, System
+
+        system_ids = list(System.objects.values_list('pk', flat=True))
+        self.stdout.write('Downtime for %s activated signatures in %s systems'
+                          % (count, len(system_ids)))
+        with transaction.atomic():
+            Signature.objects.bulk_create(
+                [Signature(system_id=system_ids[i % len(system_ids)],
+                           sigid='BEN-%06d' % i, downtimes=0)
+                 for i in range(count)], batch_size=500)
+            with CaptureQueriesContext(connection) as queries:
+                self.timed('set based', Signature.increment_downtimes, [()])
+            self.stdout.write('%s queries' % len(queries))
+            sample = Signature.objects.filter(
+                sigid__startswith='BEN-')[:max(1, count // 100)]
+            self.timed('row by row, per signature',
+                       Signature.increment_downtime, [(x,) for x in sample])
+            transaction.set_rollback(True)
+
+    def benchmark_yaml(self, count):
+        """
+        Times exporting the map to YAML and importing the export as a new
+        map with its signatures removed, count times each. The imports are
+        rolled back.
+        """
+        from django.db import connection, transaction
+        from django.test.utils import CaptureQueriesContext
+        from Map.models import Map, Signature
+
+        current_map, user = self.get_map_and_user()
+        self.stdout.write('%s exports and imports of %s (%s systems, %s '
+                          'signatures) as %s' % (
+                              count, current_map.name,
+                              current_map.systems.count(),
+                              Signature.objects.filter(
+                                  system__maps__map=current_map).count(),
+                              user.username))
+        with CaptureQueriesContext(connection) as queries:
+            exported = current_map.as_yaml()
+        self.timed('export (%s queries)' % len(queries),
+                   current_map.as_yaml, [()] * count)
+
+        def import_map(i):
+            with transaction.atomic():
+                Signature.objects.filter(
+                    system__maps__map=current_map).delete()
+                Map.yaml_import(user, exported.replace(
+                    'map_name: %s' % current_map.name,
+                    'map_name: Benchmark import %s' % i, 1))
+                transaction.set_rollback(True)
+
+        self.timed('import', import_map, [(x,) for x in range(count)])
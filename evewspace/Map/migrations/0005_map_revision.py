@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Map', '0004_auto_20151229_1537'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='map',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
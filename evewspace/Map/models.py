@@ -12,24 +12,34 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
-from django.db import models, transaction
+from django.db import IntegrityError, models
+from django.db.models import Case, F, Max, Value, When
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.conf import settings
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import Group, Permission
 from core.models import SystemData
 from django import forms
 from django.forms import ModelForm
+from collections import defaultdict
 from datetime import datetime, timedelta
-import pytz
 import time
+import pytz
 import yaml
-from Map import utils
+from Map import locations, pubsub, utils
 from Map.utils import MapJSONGenerator
+from Map.tree import MapTree
+from core.caching import ProcessCache
 from core.utils import get_config
 from django.core.cache import cache
 # Create your models here.
 
 User = settings.AUTH_USER_MODEL
 
+# The libyaml bindings are much faster for large maps, when PyYAML was
+# built with them
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAMLDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 SYSCLASS_MAPPING = {
         1: 'C1',
         2: 'C2',
@@ -114,6 +124,13 @@ class System(SystemData):
     first_visited = models.DateTimeField(null=True, blank=True)
     last_visited = models.DateTimeField(null=True, blank=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(System, cls).from_db(db, field_names, values)
+        # Saves only reload the cached system classes when this changes
+        instance._loaded_sysclass = instance.__dict__.get('sysclass')
+        return instance
+
     def __unicode__(self):
         """Returns name of System as unicode representation"""
         return self.name
@@ -157,53 +174,38 @@ class System(SystemData):
 
         super(System, self).save(*args, **kwargs)
 
-    def add_active_pilot(self, username, charid, charname,
-                         shipname, shiptype):
-        sys_cache_key = 'sys_%s_locations' % self.pk
-        current_time = time.time()
-        time_threshold = current_time - (15 * 60)
-        sys_location_dict = cache.get(sys_cache_key)
-        location = (username, charname, shipname, shiptype, current_time)
-        if sys_location_dict:
-            sys_location_dict.pop(charid, None)
-            sys_location_dict[charid] = location
-        else:
-            sys_location_dict = {charid: location}
-
-        # Prune dict to prevent carrying over stale entries
-        for charid, location in sys_location_dict.items():
-            if location[4] < time_threshold:
-                sys_location_dict.pop(charid, None)
-
-        cache.set(sys_cache_key, sys_location_dict, 15 * 60)
-        return location
-
-    def remove_active_pilot(self, charid):
-        current_time = time.time()
-        time_threshold = current_time - (15 * 60)
-        sys_cache_key = 'sys_%s_locations' % self.pk
-        sys_location_dict = cache.get(sys_cache_key)
-        if sys_location_dict:
-            sys_location_dict.pop(charid, None)
-            # Prune dict to prevent carrying over stale entries
-            for charid, location in sys_location_dict.items():
-                if location[4] < time_threshold:
-                    sys_location_dict.pop(charid, None)
-            cache.set(sys_cache_key, sys_location_dict, 15 * 60)
-        return True
-
     def _active_pilot_list(self):
-        sys_cache_key = 'sys_%s_locations' % self.pk
-        sys_location_dict = cache.get(sys_cache_key)
-        if sys_location_dict:
-            return sys_location_dict
-        else:
-            return {}
+        return locations.get_store().system(self.pk)
 
     pilot_list = property(_active_pilot_list)
 
+    @staticmethod
+    def sig_cache_key(system_id):
+        return 'sys_%s_sig_list' % system_id
+
+    @staticmethod
+    def sig_revision(system_id):
+        """Returns the revision of the system's signature list.
+
+        The revision is kept under sig_cache_key and a new one is made
+        whenever the key is cleared, so rendered lists can be cached per
+        revision.
+        """
+        key = System.sig_cache_key(system_id)
+        revision = cache.get(key)
+        if revision is None:
+            cache.add(key, '%x' % int(time.time() * 1000000), None)
+            revision = cache.get(key) or '%x' % int(time.time() * 1000000)
+        return revision
+
     def clear_sig_cache(self):
-        cache.delete('sys_%s_sig_list' % self.pk)
+        """Starts a new revision of the system's signature list."""
+        cache.delete(self.sig_cache_key(self.pk))
+
+    def bump_map_revisions(self):
+        """Bumps the revision of every map containing the system."""
+        Map.bump_revisions(MapSystem.objects.filter(system_id=self.pk)
+                           .values_list('map_id', flat=True).distinct())
 
 
 class KSystem(System):
@@ -241,6 +243,9 @@ class Map(models.Model):
     # require an explicit permission entry to access.
     explicitperms = models.BooleanField(default=False)
     truncate_allowed = models.BooleanField(default=True)
+    # Incremented whenever the systems, wormholes or signatures of the map
+    # change so clients can ask for changes since the revision they have.
+    revision = models.PositiveIntegerField(default=0)
 
     class Meta:
         permissions = (("map_unrestricted",
@@ -265,7 +270,30 @@ class Map(models.Model):
         if system is None:
             return False
 
-        return self.systems.filter(system=system).exists()
+        return system.pk in self.get_members(self.pk)
+
+    @staticmethod
+    def members_key(map_id):
+        return 'map_%s_members' % map_id
+
+    @classmethod
+    def get_members(cls, map_id):
+        """Returns a dict of the System ids in the map with pk map_id to
+        the ids of their MapSystems.
+
+        The index is kept in the cache and cleared whenever a MapSystem of
+        the map is saved or deleted.
+        """
+        members = cache.get(cls.members_key(map_id))
+        if members is None:
+            members = dict(MapSystem.objects.filter(map_id=map_id)
+                           .values_list('system_id', 'pk'))
+            cache.set(cls.members_key(map_id), members, 24 * 60 * 60)
+        return members
+
+    @classmethod
+    def clear_members(cls, map_id):
+        cache.delete(cls.members_key(map_id))
 
     # Given a __contains__ function I guess it makes sense to implement this
     # so for ... in ... will work too.
@@ -280,30 +308,17 @@ class Map(models.Model):
     @classmethod
     def yaml_import(self, user, yaml_string):
         """Imports a YAML export string into a new Map."""
-        yaml_dict = yaml.safe_load(yaml_string)
+        yaml_dict = yaml.load(yaml_string, Loader=YAMLLoader)
         map_name = yaml_dict['map_name']
         root_system = yaml_dict['systems'][0]
-        root_sys = System.objects.get(name=root_system['system'])
-        new_map = Map(name=map_name, root=root_sys)
-        new_map.save()
-        root_mapsys = new_map.add_system(user=user, system=root_sys,
-                                         friendlyname=root_system['tag'])
-        for sig in root_system['signatures']:
-            sig_id = sig['id']
-            info = sig['info']
-            if sig['type']:
-                sig_type = SignatureType.objects.get(shortname=sig['type'])
-            else:
-                sig_type = None
-            if not Signature.objects.filter(
-                    sigid=sig_id, system=root_mapsys.system).exists():
-                Signature(sigid=sig_id, sigtype=sig_type,
-                          system=root_mapsys.system, info=info,
-                          updated=bool(sig_type)).save()
-        from POS.models import POS
-        POS.update_from_import_list(root_mapsys.system,
-                                    root_system['starbases'])
-        root_mapsys.add_children_from_list(root_system['children'])
+        with pubsub.atomic():
+            root_sys = System.objects.get(name=root_system['system'])
+            new_map = Map(name=map_name, root=root_sys)
+            new_map.save()
+            root_mapsys = new_map.add_system(user=user, system=root_sys,
+                                             friendlyname=root_system['tag'])
+            root_mapsys.add_children_from_list(root_system['children'],
+                                               root=root_system)
         return new_map
 
     def add_log(self, user, action, visible=False):
@@ -312,6 +327,37 @@ class Map(models.Model):
                      timestamp=datetime.now(pytz.utc),
                      visible=visible)
         log.save()
+        if visible:
+            MapLog.advance_cursor(self.pk, log.pk)
+            self._publish_log(log)
+
+    def add_logs(self, user, actions, visible=False):
+        """Adds a MapLog entry for each of actions in one query."""
+        now = datetime.now(pytz.utc)
+        logs = [MapLog(user=user, map=self, action=action, timestamp=now,
+                       visible=visible)
+                for action in actions]
+        if not visible:
+            MapLog.objects.bulk_create(logs)
+            return
+        last_pk = MapLog.objects.aggregate(Max('pk'))['pk__max'] or 0
+        MapLog.objects.bulk_create(logs)
+        if logs and logs[0].pk is None:
+            # bulk_create does not set the ids on every backend, so read
+            # the new entries back for them
+            logs = list(MapLog.objects.filter(
+                map=self, user=user, visible=True, pk__gt=last_pk,
+                action__in=actions).order_by('pk'))
+        if logs:
+            MapLog.advance_cursor(self.pk, logs[-1].pk)
+        for log in logs:
+            self._publish_log(log)
+
+    def _publish_log(self, log):
+        pubsub.publish(pubsub.map_channel(self.pk), 'log',
+                       {'id': log.pk, 'user': log.user.username,
+                        'action': log.action,
+                        'timestamp': log.timestamp.isoformat()})
 
     def get_permission(self, user):
         """Returns the highest permision that user has on the map.
@@ -320,6 +366,12 @@ class Map(models.Model):
         1 = Read Access
         2 = Write Access
         """
+        return get_map_permission(self.pk, user, self)
+
+    def resolve_permission(self, user):
+        """Works out the permission get_permission returns without using
+        the permission cache.
+        """
         # Anonymous users always return 0
         if user.is_anonymous():
             return 0
@@ -364,11 +416,54 @@ class Map(models.Model):
 
     def as_yaml(self):
         """Returns the yaml representation of the map for import/export."""
-        data = {'map_name': self.name,
-                'export_time': datetime.now(pytz.utc),
-                'systems': [x.as_dict() for x in
-                            self.systems.filter(parentsystem=None).all()]}
-        return yaml.safe_dump(data, encoding='utf-8', allow_unicode=True)
+        return ''.join(self.yaml_chunks())
+
+    def yaml_chunks(self):
+        """Yields the yaml representation of the map one system at a time.
+
+        The systems, their parent wormholes, signatures and starbases are
+        loaded in three queries up front, however big the map.
+        """
+        from POS.models import POS
+        map_systems = list(self.systems.select_related(
+            'system', 'parent_wormhole__top_type',
+            'parent_wormhole__bottom_type').order_by('pk'))
+        children = defaultdict(list)
+        for map_system in map_systems:
+            children[map_system.parentsystem_id].append(map_system)
+        signatures = defaultdict(list)
+        for sig in Signature.objects.filter(
+                system__maps__map=self).select_related('sigtype'):
+            signatures[sig.system_id].append(sig)
+        starbases = defaultdict(list)
+        for pos in POS.objects.filter(system__maps__map=self).select_related(
+                'towertype', 'corporation'):
+            starbases[pos.system_id].append(pos)
+
+        def dump(data):
+            return yaml.dump(data, Dumper=YAMLDumper, encoding='utf-8',
+                             allow_unicode=True, default_flow_style=False)
+
+        def system_chunks(map_system, indent):
+            # Each system is dumped as a one item list without its
+            # children, which follow indented under its children key.
+            data = map_system.as_dict(
+                signatures=signatures[map_system.system_id],
+                starbases=starbases[map_system.system_id], children=False)
+            lines = dump([data]).splitlines(True)
+            lines.append('  children:%s\n' % (
+                '' if children[map_system.pk] else ' []'))
+            yield ''.join(indent + x for x in lines)
+            for child in children[map_system.pk]:
+                for chunk in system_chunks(child, indent + '  '):
+                    yield chunk
+
+        yield dump({'map_name': self.name,
+                    'export_time': datetime.now(pytz.utc)})
+        yield 'systems:\n'
+        for root in children[None]:
+            for chunk in system_chunks(root, ''):
+                yield chunk
 
     def snapshot(self, user, name, description):
         """Makes and returns a snapshot of the map."""
@@ -379,10 +474,28 @@ class Map(models.Model):
         return result
 
     def clear_caches(self):
-        """Clears the tooltip and json caches for the map."""
-        cache.delete('map_%s_wh_tooltip' % self.pk)
-        cache.delete('map_%s_sys_tooltip' % self.pk)
-        cache.delete(MapJSONGenerator.get_cache_key(self))
+        """Expires the json cache for the map. The previous json is served
+        until one request has rebuilt it.
+
+        Tooltips are cached per system and wormhole by the views and need
+        no clearing.
+        """
+        MapJSONGenerator.expire_map_state(self)
+
+    def bump_revision(self):
+        """Increments the map revision and clears the map caches."""
+        Map.bump_revisions([self.pk])
+
+    @staticmethod
+    def bump_revisions(map_ids):
+        """Increments the revision of each map in map_ids in one query."""
+        map_ids = list(map_ids)
+        if not map_ids:
+            return
+        Map.objects.filter(pk__in=map_ids).update(revision=F('revision') + 1)
+        for map_id in map_ids:
+            Map(pk=map_id).clear_caches()
+            pubsub.publish(pubsub.map_channel(map_id), 'revision', {})
 
 
 class MapSystem(models.Model):
@@ -402,52 +515,99 @@ class MapSystem(models.Model):
     def __unicode__(self):
         return "system %s in map %s" % (self.system.name, self.map.name)
 
-    def add_children_from_list(self, children=None):
-        """Adds child systems from list generated by the YAML importer."""
+    def add_children_from_list(self, children=None, root=None):
+        """Adds child systems from list generated by the YAML importer.
+
+        System and type names are resolved up front and the tree is
+        inserted with one bulk create per level, followed by the wormholes
+        and signatures in bulk, all in one transaction. root can be the
+        imported dict of this system itself to import its signatures and
+        starbases as well.
+        """
+        from POS.models import POS
         if not children:
             children = []
-        print "Adding %s children to %s" % (len(children), self.system.name)
-        for child in children:
-            new_sys = System.objects.get(name=child['system'])
-            friendlyname = child['tag']
-            new_mapsys = MapSystem(map=self.map, system=new_sys,
-                                   friendlyname=friendlyname,
-                                   parentsystem=self)
-            new_mapsys.save()
-            parent_wh = child['parent_wh']
-            top_type = WormholeType.objects.get(name=parent_wh['near_type'])
-            bottom_type = WormholeType.objects.get(name=parent_wh['far_type'])
-            top_bubbled = parent_wh['top_bubbled']
-            bottom_bubbled = parent_wh['bottom_bubbled']
-            mass_status = parent_wh['mass_status']
-            time_status = parent_wh['time_status']
-
-            wh = new_mapsys.connect_to(
-                system=self, top_type=top_type,
-                bottom_type=bottom_type, top_bubbled=top_bubbled,
-                bottom_bubbled=bottom_bubbled, time_status=time_status,
-                mass_status=mass_status)
-            wh.save()
-
-            for sig in child['signatures']:
-                sig_id = sig['id']
-                info = sig['info']
-                if sig['type']:
-                    sig_type = SignatureType.objects.get(shortname=sig['type'])
-                else:
-                    sig_type = None
-                if sig_type:
-                    updated = True
-                else:
-                    updated = False
-                if not Signature.objects.filter(
-                        system=self.system, sigid=sig_id).exists():
-                    Signature(sigid=sig_id, sigtype=sig_type,
-                              system=self.system, info=info,
-                              updated=updated).save()
-            from POS.models import POS
-            POS.update_from_import_list(self.system, child['starbases'])
-            new_mapsys.add_children_from_list(child['children'])
+        nodes = []
+        pending = list(children)
+        while pending:
+            node = pending.pop()
+            nodes.append(node)
+            pending.extend(node['children'])
+        systems = self._resolve_names(
+            System, 'name', set(x['system'] for x in nodes))
+        wormhole_types = self._resolve_names(
+            WormholeType, 'name',
+            set(x['parent_wh'][side] for x in nodes
+                for side in ('near_type', 'far_type')))
+        now = datetime.now(pytz.utc)
+
+        with pubsub.atomic():
+            contents = [(self.system_id, root)] if root else []
+            wormholes = []
+            level = [(self, x) for x in children]
+            while level:
+                last_pk = MapSystem.objects.aggregate(Max('pk'))['pk__max']
+                MapSystem.objects.bulk_create([
+                    MapSystem(map_id=self.map_id, parentsystem_id=parent.pk,
+                              system_id=systems[node['system']].pk,
+                              friendlyname=node['tag'].upper())
+                    for parent, node in level])
+                # bulk_create does not set primary keys on every backend,
+                # so read the rows back in insertion order
+                created = list(MapSystem.objects.filter(
+                    map_id=self.map_id, pk__gt=last_pk or 0,
+                    parentsystem_id__in=set(x.pk for x, _ in level)
+                ).order_by('pk'))
+                # Anything else inserted meanwhile would shift the rows and
+                # attach wormholes and signatures to the wrong systems
+                if len(created) != len(level) or any(
+                        (x.parentsystem_id, x.system_id) !=
+                        (parent.pk, systems[node['system']].pk)
+                        for x, (parent, node) in zip(created, level)):
+                    raise IntegrityError(
+                        'Imported systems could not be matched to the rows '
+                        'inserted for them')
+                next_level = []
+                for map_system, (parent, node) in zip(created, level):
+                    parent_wh = node['parent_wh']
+                    wormholes.append(Wormhole(
+                        map_id=self.map_id, top_id=parent.pk,
+                        bottom_id=map_system.pk,
+                        top_type=wormhole_types[parent_wh['near_type']],
+                        bottom_type=wormhole_types[parent_wh['far_type']],
+                        top_bubbled=parent_wh['top_bubbled'],
+                        bottom_bubbled=parent_wh['bottom_bubbled'],
+                        mass_status=parent_wh['mass_status'],
+                        time_status=parent_wh['time_status'],
+                        eol_time=now if parent_wh['time_status'] == 1
+                        else None))
+                    contents.append((map_system.system_id, node))
+                    next_level.extend((map_system, x)
+                                      for x in node['children'])
+                level = next_level
+            Wormhole.objects.bulk_create(wormholes)
+            Signature.import_list(
+                self.map_id, [(system_id, node['signatures'])
+                              for system_id, node in contents])
+            for system_id, node in contents:
+                if node['starbases']:
+                    POS.update_from_import_list(System(pk=system_id),
+                                                node['starbases'])
+        Map.clear_members(self.map_id)
+        self.map.bump_revision()
+
+    @staticmethod
+    def _resolve_names(model, field, names):
+        """Returns a dict of names to the model instances with those names,
+        raising DoesNotExist if any is missing.
+        """
+        found = dict((getattr(x, field), x) for x in model.objects.filter(
+            **{'%s__in' % field: names}))
+        missing = set(names) - set(found)
+        if missing:
+            raise model.DoesNotExist('No %s named %s' % (
+                model._meta.verbose_name, ', '.join(sorted(missing))))
+        return found
 
     def connect_to(self, system,
                    top_type, bottom_type,
@@ -468,107 +628,116 @@ class MapSystem(models.Model):
 
     def save(self, *args, **kwargs):
         self.friendlyname = self.friendlyname.upper()
-        self.map.clear_caches()
         super(MapSystem, self).save(*args, **kwargs)
+        Map.clear_members(self.map_id)
+        self.map.bump_revision()
 
     def delete(self, *args, **kwargs):
-        self.map.clear_caches()
         super(MapSystem, self).delete(*args, **kwargs)
+        Map.clear_members(self.map_id)
+        self.map.bump_revision()
 
     def remove_system(self, user):
         """Removes the supplied system and all of its children."""
         # Raise ValueError if we're trying to delete the root
-        if not self.parentsystem:
+        if not self.parentsystem_id:
             raise ValueError("Cannot remove the root system.")
-        self.parent_wormhole.delete()
-        for system in self.childsystems.all():
-            system.remove_system(user)
-        self.map.add_log(user, "Removed system: %s (%s)" %
-                         (self.system.name, self.friendlyname), True)
-        self.delete()
+        removed = MapTree.for_map(self.map_id).subtree(self.pk)
+        action = "Removed system: %s (%s)" % (self.system.name,
+                                               self.friendlyname)
+        if len(removed) > 1:
+            action += " and %s systems beyond it" % (len(removed) - 1)
+        with pubsub.atomic():
+            self._delete_systems(removed)
+            self.map.add_log(user, action, True)
+        Map.clear_members(self.map_id)
+        self.map.bump_revision()
+
+    @staticmethod
+    def _delete_systems(ids):
+        """Deletes the map systems in ids and the wormholes leading to them
+        in bulk, without the per object revision bumps.
+        """
+        Wormhole.objects.filter(bottom_id__in=ids).delete()
+        MapSystem.objects.filter(pk__in=ids).delete()
 
     def get_all_children(self):
-        child_list = []
-        for system in self.childsystems.all():
-            for sys in system.get_all_children():
-                child_list.append(sys)
-        child_list.append(self)
-        return child_list
+        return list(MapSystem.objects.filter(
+            pk__in=MapTree.for_map(self.map_id).subtree(self.pk)))
 
     def promote_system(self, user):
         """Makes this system the root system and deletes all other chains."""
-        if not self.parentsystem:
+        if not self.parentsystem_id:
             # This is already the root system
             return True
-        # Cut all ties
-        self.parent_wormhole.delete()
-        self.parentsystem = None
-        self.save()
-        # Generate a list of systems to delete
-        child_list = self.get_all_children()
-        for sys in self.map.systems.all():
-            if sys not in child_list:
-                try:
-                    sys.parent_wormhole.delete()
-                except Exception:
-                    # Nasty hack because of race condition for deleting hole
-                    pass
-                sys.delete()
-        self.map.add_log(
-            user,
-            "Truncated to: %s (%s)" % (self.system.name, self.friendlyname),
-            True)
+        tree = MapTree.for_map(self.map_id)
+        removed = set(tree.parents) - tree.subtree(self.pk)
+        with pubsub.atomic():
+            # Cut all ties
+            Wormhole.objects.filter(bottom_id=self.pk).delete()
+            MapSystem.objects.filter(pk=self.pk).update(parentsystem=None)
+            self.parentsystem = None
+            self._delete_systems(removed)
+            self.map.add_log(
+                user,
+                "Truncated to: %s (%s)" % (self.system.name, self.friendlyname),
+                True)
+        Map.clear_members(self.map_id)
+        self.map.bump_revision()
+
+    def move_to(self, index):
+        """Moves the system to position index among its siblings, counted
+        top to bottom as they are drawn.
+        """
+        self._reorder(lambda current: index)
 
     def move_up(self):
         """Switch display priority with the sibling above"""
-        if not self.parentsystem:
-            return
-
-        with transaction.atomic():
-            siblings = self.parentsystem.childsystems.order_by(
-                '-display_order_priority', '-pk')
-            i = siblings.count()
-            it = siblings.iterator()
-            while True:
-                try:
-                    mapsys = it.next()
-                    if self == mapsys:
-                        next_mapsys = it.next()
-                        next_mapsys.display_order_priority = i
-                        next_mapsys.save()
-                        i -= 1
-                except StopIteration:
-                    break
-                mapsys.display_order_priority = i
-                mapsys.save()
-                i -= 1
+        self._reorder(lambda current: current - 1)
 
     def move_down(self):
         """Switch display priority with the sibling below"""
-        if not self.parentsystem:
-            return
+        self._reorder(lambda current: current + 1)
 
-        with transaction.atomic():
-            siblings = self.parentsystem.childsystems.order_by(
-                'display_order_priority', 'pk')
-            i = 0
-            it = siblings.iterator()
-            while True:
-                try:
-                    mapsys = it.next()
-                    if self == mapsys:
-                        next_mapsys = it.next()
-                        next_mapsys.display_order_priority = i
-                        next_mapsys.save()
-                        i += 1
-                except StopIteration:
-                    break
-                mapsys.display_order_priority = i
-                mapsys.save()
-                i += 1
+    def _reorder(self, get_index):
+        """Moves the system to get_index(current index) among its siblings.
 
-    def as_dict(self):
-        """Returns a dict representation of the system."""
+        The sibling priorities are renumbered in memory and the changed ones
+        written with a single update, then the map revision is bumped once.
+        """
+        if not self.parentsystem_id:
+            return
+        with pubsub.atomic():
+            priorities = list(MapSystem.objects.select_for_update().filter(
+                parentsystem_id=self.parentsystem_id).order_by(
+                'display_order_priority', 'pk').values_list(
+                'pk', 'display_order_priority'))
+            order = [pk for pk, _ in priorities]
+            current = order.index(self.pk)
+            order.remove(self.pk)
+            order.insert(max(0, min(get_index(current), len(order))), self.pk)
+            priorities = dict(priorities)
+            changed = [(pk, i) for i, pk in enumerate(order)
+                       if priorities[pk] != i]
+            if not changed:
+                return
+            MapSystem.objects.filter(pk__in=[pk for pk, _ in changed]).update(
+                display_order_priority=Case(
+                    *[When(pk=pk, then=Value(i)) for pk, i in changed],
+                    output_field=models.IntegerField()))
+        self.display_order_priority = order.index(self.pk)
+        self.map.bump_revision()
+
+    def as_dict(self, signatures=None, starbases=None, children=True):
+        """Returns a dict representation of the system.
+
+        signatures and starbases can be passed in when they were loaded
+        beforehand. With children=False the children are left out.
+        """
+        if signatures is None:
+            signatures = self.system.signatures.all()
+        if starbases is None:
+            starbases = self.system.poses.all()
         try:
             parent_wh_dict = {
                 'near_type': self.parent_wormhole.top_type.name,
@@ -586,12 +755,12 @@ class MapSystem(models.Model):
         data = {
             'tag': self.friendlyname,
             'system': self.system.name,
-            'signatures': [sig.as_dict() for sig in
-                           self.system.signatures.all()],
-            'starbases': [pos.as_dict() for pos in self.system.poses.all()],
+            'signatures': [sig.as_dict() for sig in signatures],
+            'starbases': [pos.as_dict() for pos in starbases],
             'parent_wh': parent_wh_dict,
-            'children': [x.as_dict() for x in self.childsystems.all()],
         }
+        if children:
+            data['children'] = [x.as_dict() for x in self.childsystems.all()]
         return data
 
     def has_siblings(self):
@@ -601,14 +770,8 @@ class MapSystem(models.Model):
         return parent_sys.childsystems.count() > 1
 
     def distance_from_root(self):
-        distance = 0
-        parent_sys = self.parentsystem
-        while parent_sys != None:
-            parent_sys = parent_sys.parentsystem
-            distance +=1
-            if parent_sys == None or distance > 100:
-                break
-        return distance
+        """Returns the number of jumps from the map root."""
+        return MapTree.for_map(self.map_id).depth(self.pk)
 
     def delete_old_sigs(self, user):
         delete_threshold = int(get_config("MAP_AUTODELETE_DAYS", user).value)
@@ -670,16 +833,16 @@ class Wormhole(models.Model):
         return 0
 
     def save(self, *args, **kwargs):
-        self.map.clear_caches()
         if self.time_status == 1 and not self.eol_time:
             self.eol_time = datetime.now(pytz.utc)
         elif self.time_status != 1:
             self.eol_time = None
         super(Wormhole, self).save(*args, **kwargs)
+        self.map.bump_revision()
 
     def delete(self, *args, **kwargs):
-        self.map.clear_caches()
-        super(Wormhole, self).save(*args, **kwargs)
+        super(Wormhole, self).delete(*args, **kwargs)
+        self.map.bump_revision()
 
 
 class SignatureType(models.Model):
@@ -738,6 +901,28 @@ class Signature(models.Model):
         }
         return data
 
+    def as_list_dict(self):
+        """Returns the signature as shown in the system's signature list."""
+        def timestamp(value):
+            return value.isoformat() if value else None
+
+        return {
+            'pk': self.pk,
+            'id': self.sigid,
+            'type': self.sigtype.shortname if self.sigtype else None,
+            'type_name': self.sigtype.longname if self.sigtype else None,
+            'info': self.info,
+            'updated': self.updated,
+            'activated': timestamp(self.activated),
+            'downtimes': self.downtimes,
+            'rats_cleared': timestamp(self.ratscleared),
+            'escalated': timestamp(self.lastescalated),
+            'owned_by': self.owned_by.username if self.owned_by else None,
+            'modified_by': (self.modified_by.username if self.modified_by
+                            else None),
+            'modified_time': timestamp(self.modified_time),
+        }
+
     def activate(self):
         """Toggles the site activation."""
         if not self.activated:
@@ -779,6 +964,61 @@ class Signature(models.Model):
             self.downtimes = 1
         self.save()
 
+    @classmethod
+    def import_list(cls, map_id, system_signatures):
+        """Creates signatures from lists generated by the YAML importer.
+
+        system_signatures is a list of (system id, signature dicts) pairs
+        for systems in the map with pk map_id. Signatures the systems
+        already have are skipped. The new ones are created in bulk and the
+        signature caches of their systems cleared.
+        """
+        sigtypes = {}
+        for sigtype in SignatureType.objects.order_by('-pk'):
+            sigtypes[sigtype.shortname] = sigtype
+        existing = set(cls.objects.filter(system__maps__map_id=map_id)
+                       .values_list('system_id', 'sigid'))
+        created = []
+        for system_id, signatures in system_signatures:
+            for sig in signatures:
+                sigid = utils.convert_signature_id(sig['id'])
+                if (system_id, sigid) in existing:
+                    continue
+                existing.add((system_id, sigid))
+                if sig['type'] and sig['type'] not in sigtypes:
+                    raise SignatureType.DoesNotExist(
+                        'No signature type named %s' % sig['type'])
+                sig_type = sigtypes.get(sig['type']) if sig['type'] else None
+                created.append(cls(system_id=system_id, sigid=sigid,
+                                   sigtype=sig_type, info=sig['info'],
+                                   updated=bool(sig_type)))
+        cls.objects.bulk_create(created)
+        cache.delete_many([System.sig_cache_key(x)
+                           for x in set(x.system_id for x in created)])
+        return created
+
+    @classmethod
+    def increment_downtimes(cls):
+        """Runs increment_downtime on every activated signature at once.
+
+        The signatures are changed with one update, the signature caches
+        of their systems cleared with one delete and each map containing
+        them bumped once. Returns a (signatures, systems, maps) tuple of
+        counts.
+        """
+        activated = cls.objects.filter(downtimes__isnull=False)
+        with pubsub.atomic():
+            system_ids = list(activated.order_by().values_list(
+                'system_id', flat=True).distinct())
+            map_ids = list(MapSystem.objects.filter(
+                system_id__in=activated.values('system_id')).values_list(
+                'map_id', flat=True).distinct())
+            count = activated.update(activated=None, lastescalated=None,
+                                     downtimes=F('downtimes') + 1)
+        cache.delete_many([System.sig_cache_key(x) for x in system_ids])
+        Map.bump_revisions(map_ids)
+        return count, len(system_ids), len(map_ids)
+
     def update(self):
         """Mark the signature as having been updated since DT."""
         self.updated = True
@@ -789,6 +1029,24 @@ class Signature(models.Model):
         import updated an existing signature on the map, and whether or not the update
         includes new scan data (for logging purposes).
 
+        """
+        def get_sigtype(longname):
+            try:
+                return SignatureType.objects.get(longname=longname)
+            except:
+                return None
+
+        action = self._apply_tsv(wascreated, row, get_sigtype)
+        if action != "None":
+            self.log_sig(user, action, map_system)
+        return self, action
+
+    def _apply_tsv(self, wascreated, row, get_sigtype):
+        """Applies a line of copied data to the signature without saving or
+        logging it and returns the action taken.
+
+        get_sigtype takes a SignatureType longname and returns the type or
+        None.
         """
         # map columns
         COL_SIG = 0
@@ -809,18 +1067,13 @@ class Signature(models.Model):
         # Is there a valid signature type from pasted data - is it valid?
         scan_group = self._translate_client_string(row[COL_SIG_SCAN_GROUP])
         if scan_group == "Cosmic Signature" or scan_group == "Cosmic Anomaly":
-            try:
-                # translate names such as Ore Site, Gas Site, from
-                # localized clients
-                sig_type_name = self._translate_client_string(
-                    row[COL_SIG_GROUP])
-                sig_type = SignatureType.objects.get(
-                    longname=sig_type_name)
+            # translate names such as Ore Site, Gas Site, from
+            # localized clients
+            sig_type_name = self._translate_client_string(
+                row[COL_SIG_GROUP])
+            sig_type = get_sigtype(sig_type_name)
+            if sig_type:
                 self.updated = True
-            except:
-                sig_type = None
-        else:
-            sig_type = None
 
         if sig_type:
             if action != "Created" and self.sigtype != sig_type:
@@ -837,33 +1090,102 @@ class Signature(models.Model):
                     if scan_group == "Cosmic Signature":
                         # only record new scanning activity for signatures
                         action = "Scanned"
-        if action != "None":
-            self.log_sig(user, action, map_system)
 
         # is this still necessary?
         if self.info is None:
             self.info = ''
 
-        return self, action
+        return action
 
+    @classmethod
+    def import_tsv(cls, user, map_system, rows):
+        """Imports rows of copied scanner data into map_system's system.
+
+        Existing signatures are loaded in one query and the changes are
+        written in a fixed number of queries whatever the number of rows.
+        Rows are applied in order, so a signature pasted twice is created
+        by the first row and updated by the second. Returns a list of
+        (signature, action, row) tuples, one per row.
+        """
+        COL_SIG = 0
+        system = map_system.system
+        sigtypes = {}
+        for sigtype in SignatureType.objects.all():
+            # Ambiguous names don't resolve, as with objects.get()
+            sigtypes[sigtype.longname] = (
+                None if sigtype.longname in sigtypes else sigtype)
+        sig_ids = set(utils.convert_signature_id(row[COL_SIG])
+                      for row in rows)
+        existing = dict((sig.sigid, sig) for sig in
+                        cls.objects.filter(system=system, sigid__in=sig_ids)
+                        .select_related('sigtype'))
+        created = {}
+        results = []
+        for row in rows:
+            sig_id = utils.convert_signature_id(row[COL_SIG])
+            sig = existing.get(sig_id) or created.get(sig_id)
+            wascreated = sig is None
+            if wascreated:
+                sig = cls(sigid=sig_id, system=system)
+                created[sig_id] = sig
+            sig.modified_by = user
+            results.append((sig, sig._apply_tsv(wascreated, row,
+                                                sigtypes.get), row))
+
+        now = datetime.now(pytz.utc)
+        with pubsub.atomic():
+            if existing:
+                updates = {}
+                for field, attname, output in (
+                        ('sigtype', 'sigtype_id', models.IntegerField()),
+                        ('info', 'info', models.CharField()),
+                        ('updated', 'updated', models.BooleanField())):
+                    updates[field] = Case(
+                        *[When(pk=sig.pk, then=Value(getattr(sig, attname)))
+                          for sig in existing.values()],
+                        output_field=output)
+                (cls.objects.filter(pk__in=[x.pk for x in existing.values()])
+                 .update(modified_by=user, modified_time=now, **updates))
+                for sig in existing.values():
+                    sig.modified_time = now
+            if created:
+                cls.objects.bulk_create(created.values())
+                # bulk_create does not set primary keys on every backend
+                for sig_id, pk in (cls.objects
+                                   .filter(system=system,
+                                           sigid__in=created.keys())
+                                   .values_list('sigid', 'pk')):
+                    created[sig_id].pk = pk
+            changes = [(sig, action) for sig, action, row in results
+                       if action != "None"]
+            if changes:
+                messages = cls.log_messages(changes, map_system)
+                map_system.map.add_logs(user, messages)
+        system.clear_sig_cache()
+        system.bump_map_revisions()
+        return results
 
     def log_sig(self, user, action, map_system):
         """Log the fact that the signature was scanned."""
+        map_system.map.add_log(
+            user, Signature.log_messages([(self, action)], map_system)[0])
 
+    @staticmethod
+    def log_messages(changes, map_system):
+        """Returns the log message for each (signature, action) in changes.
+        """
         # only include advanced logging if enabled
         include_distance = get_config("MAP_ADVANCED_LOGGING", None).value
         if include_distance == "1":
-            map_system.map.add_log(
-                user,
-                "%s signature %s in %s (%s), %s jumps out from root system."
-                %(action, self.sigid, map_system.system.name,
-                  map_system.friendlyname, map_system.distance_from_root()))
-        else:
-            map_system.map.add_log(
-                user,
-                "%s signature %s in %s (%s)."
-                %(action, self.sigid, map_system.system.name,
-                  map_system.friendlyname))
+            distance = map_system.distance_from_root()
+            return ["%s signature %s in %s (%s), %s jumps out from root "
+                    "system." % (action, sig.sigid, map_system.system.name,
+                                 map_system.friendlyname, distance)
+                    for sig, action in changes]
+        return ["%s signature %s in %s (%s)."
+                % (action, sig.sigid, map_system.system.name,
+                   map_system.friendlyname)
+                for sig, action in changes]
 
     def toggle_ownership(self, user):
         """Toggles ownership."""
@@ -882,11 +1204,18 @@ class Signature(models.Model):
         self.system.clear_sig_cache()
         self.sigid = utils.convert_signature_id(self.sigid)
         super(Signature, self).save(*args, **kwargs)
+        self.bump_map_revisions()
 
     def delete(self, user, mapsys, *args, **kwargs):
         self.log_sig(user, "Deleted", mapsys)
         self.system.clear_sig_cache()
         super(Signature, self).delete(*args, **kwargs)
+        self.bump_map_revisions()
+
+    def bump_map_revisions(self):
+        """Bumps the revision of every map containing the signature's system.
+        """
+        self.system.bump_map_revisions()
 
     def _translate_client_string(self, client_text):
         """Translate text strings from EVE client.
@@ -992,6 +1321,32 @@ class MapLog(models.Model):
                 (self.map.name, self.user.username,
                  self.action, self.timestamp))
 
+    @staticmethod
+    def cursor_key(map_id):
+        return 'map_%s_log_cursor' % map_id
+
+    @classmethod
+    def get_cursor(cls, map_id):
+        """Returns the id of the newest visible log entry of the map with
+        pk map_id, or 0 if there are none.
+
+        The id is kept in the cache so checkins with nothing new do not
+        touch the database. It expires after a minute in case two logs
+        were added at once and the older id was stored last.
+        """
+        cursor = cache.get(cls.cursor_key(map_id))
+        if cursor is None:
+            cursor = cls.objects.filter(map_id=map_id, visible=True).aggregate(
+                Max('pk'))['pk__max'] or 0
+            cache.set(cls.cursor_key(map_id), cursor, 60)
+        return cursor
+
+    @classmethod
+    def advance_cursor(cls, map_id, log_id):
+        """Moves the cursor of the map with pk map_id to log_id."""
+        if log_id > cls.get_cursor(map_id):
+            cache.set(cls.cursor_key(map_id), log_id, 60)
+
 
 class Snapshot(models.Model):
     """Represents a snapshot of the JSON strings used to draw a map."""
@@ -1076,3 +1431,103 @@ class SignatureForm(ModelForm):
     class Meta:
         model = Signature
         fields = ('sigid', 'sigtype', 'info')
+
+
+def wormhole_types_changed(sender, **kwargs):
+    """Drops the cached wormhole type lookups when a WormholeType changes."""
+    utils.invalidate_wormhole_types()
+
+post_save.connect(wormhole_types_changed, sender=WormholeType)
+post_delete.connect(wormhole_types_changed, sender=WormholeType)
+
+
+def system_class_changed(sender, instance, **kwargs):
+    """Reloads the cached system classes when a system's class changes."""
+    if getattr(instance, '_loaded_sysclass', None) != instance.sysclass:
+        utils.invalidate_system_classes()
+        instance._loaded_sysclass = instance.sysclass
+
+
+def system_deleted(sender, **kwargs):
+    """Reloads the cached system classes when a system is deleted."""
+    utils.invalidate_system_classes()
+
+for system_model in (System, KSystem, WSystem):
+    post_save.connect(system_class_changed, sender=system_model)
+    post_delete.connect(system_deleted, sender=system_model)
+
+
+class _MapPermissionCache(ProcessCache):
+    """
+    Holds the permission of each user on each map. Permissions are kept in
+    this process and in the shared cache under keys carrying the version
+    token, so a bump drops both tiers.
+    """
+    version_key = 'map_permissions_version'
+    # Seconds permissions stay in the shared cache
+    timeout = 60 * 60 * 24
+
+    def reset(self):
+        self.access = {}
+
+    def get(self, map_id, user, current_map):
+        self.validate()
+        key = (int(map_id), user.pk)
+        if key not in self.access:
+            shared_key = 'map_%s_perm_%s_%s' % (map_id, user.pk, self.version)
+            access = cache.get(shared_key)
+            if access is None:
+                access = current_map.resolve_permission(user)
+                cache.set(shared_key, access, self.timeout)
+            self.access[key] = access
+        return self.access[key]
+
+_map_permissions = _MapPermissionCache()
+
+
+def get_map_permission(map_id, user, current_map):
+    """Returns the permission user has on the map with pk map_id.
+
+    current_map is only used when the permission is not cached, so it can
+    be a lazy object that fetches the map when first touched.
+    """
+    if user.is_anonymous():
+        return 0
+    return _map_permissions.get(map_id, user, current_map)
+
+
+def invalidate_map_permissions():
+    """Drops the cached map permissions in every process."""
+    _map_permissions.bump()
+    _map_permissions.reset()
+
+
+def map_permissions_changed(sender, **kwargs):
+    """Drops the cached map permissions when a map's permissions change."""
+    invalidate_map_permissions()
+
+
+def user_changed(sender, **kwargs):
+    """Drops the cached map permissions when a user is saved, unless only
+    the last login changed.
+    """
+    if kwargs.get('update_fields') != frozenset(['last_login']):
+        invalidate_map_permissions()
+
+
+def auth_relation_changed(sender, instance, model, action, **kwargs):
+    """
+    Drops the cached map permissions when group membership or the Django
+    permissions of a user or group change.
+    """
+    if not action.startswith('post_'):
+        return
+    if model in (Group, Permission) or isinstance(instance, Group):
+        invalidate_map_permissions()
+
+post_save.connect(map_permissions_changed, sender=Map)
+post_delete.connect(map_permissions_changed, sender=Map)
+post_save.connect(map_permissions_changed, sender=MapPermission)
+post_delete.connect(map_permissions_changed, sender=MapPermission)
+post_save.connect(user_changed, sender=settings.AUTH_USER_MODEL)
+m2m_changed.connect(auth_relation_changed)
@@ -0,0 +1,256 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Publish / subscribe channels used to push map events to clients.
+
+Events are stored per channel with increasing integer ids so a subscriber
+that reconnects can resume from the last id it has seen. The broker class
+is chosen with the MAP_PUBSUB_BACKEND setting.
+"""
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+_broker = None
+_local = threading.local()
+
+
+def get_broker():
+    """Returns the broker instance for this process."""
+    global _broker
+    if _broker is None:
+        _broker = import_string(settings.MAP_PUBSUB_BACKEND)()
+    return _broker
+
+
+def publish(channel, event, data):
+    """Publishes an event to channel with the configured broker.
+
+    Inside an atomic() block the event is held back until the block
+    commits and None is returned instead of the event id.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        pending.append((channel, event, data))
+        return None
+    return get_broker().publish(channel, event, data)
+
+
+@contextmanager
+def atomic(using=None):
+    """
+    Runs the block in transaction.atomic and publishes the events sent
+    inside it once the outermost block has committed, so a client woken
+    by an event never reads the state from before the transaction.
+    Events from a block that raises are dropped. Use it instead of
+    transaction.atomic for any block that can publish.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        mark = len(pending)
+        try:
+            with transaction.atomic(using=using):
+                yield
+        except Exception:
+            del pending[mark:]
+            raise
+        return
+    _local.pending = pending = []
+    try:
+        with transaction.atomic(using=using):
+            yield
+    finally:
+        _local.pending = None
+    broker = get_broker()
+    for channel, event, data in pending:
+        broker.publish(channel, event, data)
+
+
+def map_channel(map_id):
+    return 'map_%s' % map_id
+
+
+class BaseBroker(object):
+    """Interface for pub/sub brokers.
+
+    Events are returned as (event_id, event, data) tuples.
+    """
+    # Maximum number of events kept and returned per channel
+    max_events = 100
+    # Seconds between checks for new events in listen()
+    poll_interval = 0.5
+
+    def publish(self, channel, event, data):
+        """Stores an event and returns its id."""
+        raise NotImplementedError
+
+    def last_id(self, channel):
+        """Returns the id of the newest event in channel, or 0."""
+        raise NotImplementedError
+
+    def read(self, channel, last_id):
+        """Returns the events in channel newer than last_id."""
+        raise NotImplementedError
+
+    def listen(self, channel, last_id, timeout):
+        """Waits up to timeout seconds for events newer than last_id."""
+        deadline = time.time() + timeout
+        while True:
+            events = self.read(channel, last_id)
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return events
+            time.sleep(min(self.poll_interval, remaining))
+
+
+class LocalBroker(BaseBroker):
+    """Keeps events in memory and wakes listeners directly.
+
+    Only subscribers in the same process see the events, so this is
+    meant for tests and single process development servers.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._channels = {}
+
+    def publish(self, channel, event, data):
+        with self._condition:
+            last_id, events = self._channels.get(
+                channel, (0, deque(maxlen=self.max_events)))
+            last_id += 1
+            events.append((last_id, event, data))
+            self._channels[channel] = (last_id, events)
+            self._condition.notify_all()
+        return last_id
+
+    def last_id(self, channel):
+        with self._condition:
+            return self._channels.get(channel, (0, None))[0]
+
+    def read(self, channel, last_id):
+        with self._condition:
+            return self._read(channel, last_id)
+
+    def _read(self, channel, last_id):
+        if channel not in self._channels:
+            return []
+        newest, events = self._channels[channel]
+        if last_id > newest:
+            # The id is from before this process started
+            last_id = 0
+        return [x for x in events if x[0] > last_id]
+
+    def listen(self, channel, last_id, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                events = self._read(channel, last_id)
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                self._condition.wait(remaining)
+
+
+class CacheBroker(BaseBroker):
+    """Shares events between processes through the Django cache.
+
+    Each channel has a counter incremented atomically with cache.incr and
+    every event is stored under its own key, so publishers never overwrite
+    each other. Listeners poll the counter, which costs a cache read per
+    poll_interval but no requests from the client.
+
+    A new counter starts from the current time in milliseconds, so when the
+    counter is evicted the ids keep rising past the ones clients already
+    hold as long as a channel averages under 1000 events a second.
+    """
+    # Seconds an event is kept in the cache
+    timeout = 5 * 60
+    # Seconds to wait for an event whose id was taken but is not stored
+    # yet before skipping it
+    gap_timeout = 2
+
+    def __init__(self):
+        self._gaps = {}
+
+    @staticmethod
+    def _counter_key(channel):
+        return 'pubsub_%s_last' % channel
+
+    @staticmethod
+    def _first_key(channel):
+        return 'pubsub_%s_first' % channel
+
+    @staticmethod
+    def _event_key(channel, event_id):
+        return 'pubsub_%s_%s' % (channel, event_id)
+
+    def publish(self, channel, event, data):
+        counter_key = self._counter_key(channel)
+        start = int(time.time() * 1000)
+        if cache.add(counter_key, start, None):
+            # Remember where this counter started so readers don't wait
+            # for the ids below it
+            cache.set(self._first_key(channel), start, None)
+        try:
+            event_id = cache.incr(counter_key)
+        except ValueError:
+            # The counter was evicted between add and incr
+            event_id = start + 1
+            cache.set_many({counter_key: event_id,
+                            self._first_key(channel): start}, None)
+        cache.set(self._event_key(channel, event_id), (event, data),
+                  self.timeout)
+        return event_id
+
+    def last_id(self, channel):
+        return cache.get(self._counter_key(channel)) or 0
+
+    def read(self, channel, last_id):
+        counter_key = self._counter_key(channel)
+        first_key = self._first_key(channel)
+        values = cache.get_many([counter_key, first_key])
+        newest = values.get(counter_key, 0)
+        start = values.get(first_key, 0)
+        if last_id > newest:
+            # The counter went back, so last_id is from before it was
+            # reset; send everything published since
+            last_id = start
+        if newest <= last_id:
+            return []
+        first = max(last_id + 1, start + 1, newest - self.max_events + 1)
+        keys = dict((self._event_key(channel, x), x)
+                    for x in range(first, newest + 1))
+        found = dict((keys[k], v) for k, v in cache.get_many(keys).items())
+        events = []
+        for event_id in range(first, newest + 1):
+            if event_id not in found:
+                # The publisher has taken this id but not stored the
+                # event yet; stop here unless we've waited long enough.
+                gap = (channel, event_id)
+                since = self._gaps.setdefault(gap, time.time())
+                if time.time() - since < self.gap_timeout:
+                    break
+                self._gaps.pop(gap, None)
+                continue
+            self._gaps.pop((channel, event_id), None)
+            event, data = found[event_id]
+            events.append((event_id, event, data))
+        return events
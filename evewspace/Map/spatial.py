@@ -0,0 +1,115 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Light-year distances between solar systems, computed with NumPy over a
+table of every system's coordinates.
+
+Range queries use a uniform grid: systems are bucketed into cubes of
+GRID_CELL_LY a side, so finding the systems within a radius only has to
+look at the cubes that radius touches.
+"""
+import numpy as np
+
+# Metres in a light year, as used by RouteFinder
+METRES_PER_LY = 9.4605284e+15
+# Side of a grid cube in light years
+GRID_CELL_LY = 2.0
+# Cube indexes are offset so the packed key is never negative
+_GRID_OFFSET = 1 << 20
+
+
+class CoordinateTable(object):
+    """Coordinates of solar systems with bulk distance queries."""
+    def __init__(self, system_ids, coordinates):
+        self.system_ids = np.asarray(system_ids, dtype=np.int64)
+        # Stored in light years so the grid and results share units
+        self.coordinates = (np.asarray(coordinates, dtype=np.float64)
+                            .reshape(-1, 3) / METRES_PER_LY)
+        self._index = dict((int(x), i) for i, x in enumerate(self.system_ids))
+        cells = self._cells(self.coordinates)
+        self._order = np.argsort(cells, kind='mergesort')
+        self._sorted_cells = cells[self._order]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds a table from (system_id, x, y, z) rows."""
+        rows = list(rows)
+        return cls([x[0] for x in rows], [x[1:] for x in rows])
+
+    @staticmethod
+    def _pack(cube):
+        cube = cube + _GRID_OFFSET
+        return ((cube[..., 0] << 42) | (cube[..., 1] << 21) | cube[..., 2])
+
+    def _cells(self, coordinates):
+        cubes = np.floor(coordinates / GRID_CELL_LY).astype(np.int64)
+        return self._pack(cubes)
+
+    def __contains__(self, system_id):
+        return system_id in self._index
+
+    def _get_index(self, system_id):
+        try:
+            return self._index[system_id]
+        except KeyError:
+            raise KeyError('System %s has no coordinates' % system_id)
+
+    def position(self, system_id):
+        """Returns the coordinates of system_id in light years."""
+        return self.coordinates[self._get_index(system_id)]
+
+    def ly_distances(self, system_id, system_ids=None):
+        """
+        Returns an array of the light-year distances from system_id to each
+        of system_ids, or to every system in table order if it is None.
+        """
+        origin = self.position(system_id)
+        if system_ids is None:
+            others = self.coordinates
+        else:
+            others = self.coordinates[[self._get_index(x)
+                                       for x in system_ids]]
+        return np.sqrt(((others - origin) ** 2).sum(axis=1))
+
+    def within(self, system_id, radius):
+        """
+        Returns a list of (system_id, distance) for the systems within
+        radius light years of system_id, nearest first. The system itself
+        is included at distance 0.
+        """
+        origin = self.position(system_id)
+        low = np.floor((origin - radius) / GRID_CELL_LY).astype(np.int64)
+        high = np.floor((origin + radius) / GRID_CELL_LY).astype(np.int64)
+        if np.prod(high - low + 1) > len(self.system_ids):
+            # More cubes than systems, scanning everything is cheaper
+            candidates = np.arange(len(self.system_ids))
+        else:
+            axes = [np.arange(low[x], high[x] + 1) for x in range(3)]
+            cubes = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+            cells = self._pack(cubes.reshape(-1, 3))
+            starts = np.searchsorted(self._sorted_cells, cells, 'left')
+            ends = np.searchsorted(self._sorted_cells, cells, 'right')
+            candidates = np.concatenate(
+                [self._order[start:end] for start, end
+                 in zip(starts, ends) if end > start] or
+                [np.array([], dtype=np.int64)])
+        distances = np.sqrt(
+            ((self.coordinates[candidates] - origin) ** 2).sum(axis=1))
+        inside = distances <= radius
+        candidates = candidates[inside]
+        distances = distances[inside]
+        order = np.argsort(distances, kind='mergesort')
+        return [(int(self.system_ids[candidates[x]]), float(distances[x]))
+                for x in order]
@@ -16,7 +16,6 @@
 //  Portions Copyright (c) 2011 Georgi Kolev (arcanis@wiadvice.com). Licensed under the Apache 2.0 license.
 
 
-var loadtime = null;
 var paper = null;
 var objSystems = [];
 var focusMS;
@@ -24,6 +23,17 @@ var sigTimerID;
 var updateTimerID;
 var refreshTimerID;
 var systemsJSON;
+var mapVersion = null; // Version of the map data we last received
+var mapSystems = {}; // System dicts by msID, without the user location overlay
+var mapOrder = []; // msIDs in drawing order
+var userLocations = ""; // System IDs of the user's characters
+var eventSource = null; // Server-sent event stream of map changes
+var streamConnected = false; // Is the event stream currently open?
+var streamRefreshTimerID; // Coalesces revision events into one refresh
+var streamRefreshTicks = 0; // Auto refresh ticks skipped while streaming
+var streamRefreshEvery = 4; // Auto refresh every Nth tick while streaming
+var logLimit = 20; // Log entries kept in the log list
+var logCursor = null; // Id of the newest log entry received
 var activityLimit = 100;
 var scalingFactor = 1; //scale the interface
 var textFontSize, indentX, indentY, strokeWidth, interestWidth; // Initialize scalable variables in the global scope
@@ -103,6 +113,9 @@ $(document).ready(function () {
             clearTimeout(sigTimerID);
         }
         clearTimeout(updateTimerID);
+        if (eventSource !== null) {
+            eventSource.close();
+        }
     });
 
     $('#mapDiv').html(ajax_image);
@@ -119,10 +132,13 @@ $(document).ready(function () {
     });
     
     updateTimerID = setInterval(doMapAjaxCheckin, 5000);
+    if (eventStream) {
+        StartEventStream();
+    }
 
     if (autoRefresh === true) {
         $('#btnRefreshToggle').find('> span').text('ON');
-        refreshTimerID = setInterval(RefreshMap, autoRefreshInterval);
+        refreshTimerID = setInterval(AutoRefreshMap, autoRefreshInterval);
     } else {
         $('#btnRefreshToggle').find('> span').text('OFF');
     }
@@ -178,23 +194,80 @@ function processAjax(data) {
     }
 
     if (data.logs) {
-        var logDiv = $('#logDiv');
-        logDiv.empty();
-        logDiv.html(data.logs);
+        for (var i = 0; i < data.logs.length; i++) {
+            AppendLogEntry(data.logs[i]);
+        }
+    }
+    if (data.cursor > logCursor) {
+        logCursor = data.cursor;
     }
 }
 
+function StartEventStream() {
+    // Browsers without EventSource keep polling
+    if (!window.EventSource) {
+        return;
+    }
+    eventSource = new EventSource('events/');
+    eventSource.addEventListener('open', function () {
+        streamConnected = true;
+    });
+    eventSource.addEventListener('error', function () {
+        // The browser reconnects on its own, poll until it does
+        streamConnected = false;
+    });
+    eventSource.addEventListener('revision', function () {
+        clearTimeout(streamRefreshTimerID);
+        streamRefreshTimerID = setTimeout(function () {
+            RefreshMap(true);
+        }, 250);
+    });
+    eventSource.addEventListener('log', function (e) {
+        AppendLogEntry(JSON.parse(e.data));
+    });
+    eventSource.addEventListener('dialog', function (e) {
+        // The IGB gets its dialogs from its own checkin
+        if (!is_igb) {
+            processAjax({'dialogHTML': JSON.parse(e.data).html});
+        }
+    });
+}
+
+function AppendLogEntry(log) {
+    // Entries can arrive from both the event stream and the IGB checkin
+    if (log.id) {
+        if (log.id <= logCursor) {
+            return;
+        }
+        logCursor = log.id;
+    }
+    var logList = $('#logList');
+    if (!logList[0]) {
+        logList = $('<ul id="logList" class="logList"></ul>');
+        $('#logDiv').empty().append(logList);
+    }
+    var entry = $('<li class="logEntry"><strong></strong> <strong></strong></li>');
+    entry.find('strong').first().text('User: ' + log.user);
+    entry.find('strong').last().text('Action: ' + log.action);
+    logList.append(entry);
+    logList.children().slice(0, -logLimit).remove();
+}
+
 function doMapAjaxCheckin() {
     var currentPath = 'update/';
-    if (loadtime !== null) {
+    // The IGB still checks in to report its location
+    if (streamConnected && !is_igb) {
+        return;
+    }
+    if (logCursor !== null) {
         $.ajax({
             type: "POST",
             url: currentPath,
-            data: {"loadtime": loadtime, "silent": silentSystem, 'kspace': kspaceIGBMapping},
+            data: {"cursor": logCursor, "silent": silentSystem, 'kspace': kspaceIGBMapping},
             success: processAjax
         });
     } else {
-        console.log('Skipping checkin due to null loadtime value.');
+        console.log('Skipping checkin due to null logCursor value.');
     }
 }
 
@@ -230,7 +303,7 @@ function ToggleKspaceMapping() {
 function ToggleAutoRefresh() {
     if (autoRefresh === false) {
         autoRefresh = true;
-        refreshTimerID = setInterval(RefreshMap, autoRefreshInterval);
+        refreshTimerID = setInterval(AutoRefreshMap, autoRefreshInterval);
         $('#btnRefreshToggle').text('Auto Refresh: ON');
     } else {
         autoRefresh = false;
@@ -607,23 +680,93 @@ function GetWormholeTooltips() {
     });
 }
 
-function RefreshMap() {
-    var address = "refresh/";
+function RefreshMap(onlyIfChanged) {
+    // Fetches the systems changed since mapVersion and redraws the map.
+    // Without a version the whole map is loaded, which the server shares
+    // between users. If onlyIfChanged is set, the map is not redrawn when
+    // nothing changed.
+    var address = "refresh/delta/";
+    var data = {"version": mapVersion};
+    var full = mapVersion === null;
+    if (full) {
+        address = "refresh/";
+        data = {};
+    }
     $.ajax({
         type: "GET",
         url: address,
-        success: function (data) {
-            objSystems = [];
-            var newData = $.parseJSON(data);
-            systemsJSON = $.parseJSON(newData[1]);
-            loadtime = newData[0];
-            GetWormholeTooltips();
-            GetSystemTooltips();
-            StartDrawing();
+        data: data,
+        success: function (data, textStatus, xhr) {
+            var changed = false;
+            var locations = xhr.getResponseHeader('X-Map-User-Locations') || "";
+            if (xhr.status !== 304) {
+                if (full) {
+                    data = {"version": data.version, "full": true,
+                            "systems": data.systems, "removed": [],
+                            "order": $.map(data.systems, function (system) {
+                                return system.msID;
+                            })};
+                }
+                ApplyMapDelta(data);
+                changed = true;
+            }
+            if (locations !== userLocations) {
+                userLocations = locations;
+                changed = true;
+            }
+            if (changed || !onlyIfChanged) {
+                BuildSystemsJSON();
+                objSystems = [];
+                GetWormholeTooltips();
+                GetSystemTooltips();
+                StartDrawing();
+            }
         }
     });
 }
 
+function AutoRefreshMap() {
+    // Changes are pushed while streaming, so only refresh occasionally
+    // to pick up pilot and activity data.
+    if (streamConnected) {
+        streamRefreshTicks++;
+        if (streamRefreshTicks < streamRefreshEvery) {
+            return;
+        }
+    }
+    streamRefreshTicks = 0;
+    RefreshMap(true);
+}
+
+function ApplyMapDelta(delta) {
+    var i;
+    if (delta.full) {
+        mapSystems = {};
+    }
+    for (i = 0; i < delta.systems.length; i++) {
+        mapSystems[delta.systems[i].msID] = delta.systems[i];
+    }
+    for (i = 0; i < delta.removed.length; i++) {
+        delete mapSystems[delta.removed[i]];
+    }
+    mapOrder = delta.order;
+    mapVersion = delta.version;
+}
+
+function BuildSystemsJSON() {
+    // Rebuild the drawing list, marking the systems the user is in
+    var locations = userLocations === "" ? [] : userLocations.split(",");
+    systemsJSON = [];
+    for (var i = 0; i < mapOrder.length; i++) {
+        var system = $.extend({}, mapSystems[mapOrder[i]]);
+        if (system.iconImageURL === null &&
+                $.inArray(String(system.sysID), locations) !== -1) {
+            system.iconImageURL = myLocationImageURL;
+        }
+        systemsJSON.push(system);
+    }
+}
+
 function EditSignature(msID, sigID) {
     var address = "system/" + msID + "/signatures/" + sigID + "/edit/";
     $.ajax({
@@ -1707,11 +1850,14 @@ function scale(factor) {
     RefreshMap();
 }
 
-function MoveSystem(msID, action) {
+function MoveSystem(msID, action, index) {
+    // action is "up", "down" or "to", which moves the system to the given
+    // index among its siblings
     var address = "system/" + msID + "/movesys/" + action + "/";
     $.ajax({
         url: address,
         type: "POST",
+        data: action === "to" ? {index: index} : {},
         success: function () {
             DisplaySystemMenu(msID);
             RefreshMap();
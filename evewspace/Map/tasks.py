@@ -12,9 +12,13 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+from collections import defaultdict
 from datetime import datetime, timedelta
+import time
 
 from celery import task
+from django.db import transaction
+from django.db.models import Case, Value, When
 from Map.models import System, KSystem, Signature
 from core.models import Faction
 import eveapi
@@ -23,59 +27,90 @@ from django.core.cache import cache
 import pytz
 
 
+# Rows written per statement by _sync_fields, which keeps the number of
+# query parameters within what every backend accepts
+SYNC_BATCH_SIZE = 200
+
+
+def _sync_fields(queryset, fields, targets, default):
+    """
+    Sets fields on every row of queryset to the tuple of values in
+    targets[pk], or default for rows not in targets. Only rows that change
+    are written, with one CASE update per batch, and their count returned.
+    """
+    changed = {}
+    for row in queryset.values_list('pk', *fields):
+        target = targets.get(row[0], default)
+        if tuple(row[1:]) != target:
+            changed[row[0]] = target
+    pks = sorted(changed)
+    for start in range(0, len(pks), SYNC_BATCH_SIZE):
+        batch = pks[start:start + SYNC_BATCH_SIZE]
+        updates = {}
+        for i, field in enumerate(fields):
+            by_value = defaultdict(list)
+            for pk in batch:
+                by_value[changed[pk][i]].append(pk)
+            updates[field] = Case(
+                *[When(pk__in=ids, then=Value(value))
+                  for value, ids in by_value.items()],
+                output_field=queryset.model._meta.get_field(field))
+        queryset.filter(pk__in=batch).update(**updates)
+    return len(pks)
+
+
 @task()
 def update_system_stats():
     """
     Updates the System Statistics (jumps, kills) from the API.
+
+    Systems missing from the API results have no jumps or kills. All
+    changes are written in one transaction, so maps never show a partly
+    updated set. Returns the number of systems changed and the time taken.
     """
     api = eveapi.EVEAPIConnection(cacheHandler=handler)
-    jumpapi = api.map.Jumps()
-    killapi = api.map.Kills()
-    System.objects.all().update(shipkills=0, podkills=0, npckills=0)
-    KSystem.objects.all().update(jumps=0)
-    # Update jumps from Jumps API for K-space systems
-    for entry in jumpapi.solarSystems:
-        try:
-            KSystem.objects.filter(pk=entry.solarSystemID).update(
-                jumps=entry.shipJumps)
-        except Exception:
-            pass
-    # Update kills from Kills API
-    for entry in killapi.solarSystems:
-        try:
-            System.objects.filter(pk=entry.solarSystemID).update(
-                shipkills=entry.shipKills,
-                podkills=entry.podKills,
-                npckills=entry.factionKills
-            )
-        except Exception:
-            pass
+    jumps = dict((x.solarSystemID, (x.shipJumps,))
+                 for x in api.map.Jumps().solarSystems)
+    kills = dict((x.solarSystemID, (x.shipKills, x.podKills, x.factionKills))
+                 for x in api.map.Kills().solarSystems)
+    start = time.time()
+    with transaction.atomic():
+        jumps_changed = _sync_fields(KSystem.objects.all(), ('jumps',),
+                                     jumps, (0,))
+        kills_changed = _sync_fields(
+            System.objects.all(), ('shipkills', 'podkills', 'npckills'),
+            kills, (0, 0, 0))
+    return {'jumps': jumps_changed, 'kills': kills_changed,
+            'seconds': time.time() - start}
 
 
 @task()
 def update_system_sov():
     """
-    Updates the Sov for K-Space systems. If any exceptions are raised
-    (e.g. Alliance record doesn't exist), sov is just marked "None."
+    Updates the Sov for K-Space systems. Systems without sov, or held by
+    a faction or alliance we don't know, are marked "None."
+
+    Only systems whose sov changed are written, in one transaction.
+    Returns the number of systems changed and the time taken.
     """
     api = eveapi.EVEAPIConnection(cacheHandler=handler)
     sovapi = api.map.Sovereignty()
-    alliance_list = api.eve.AllianceList().alliances
-    lookup_table = {}
-    for alliance in alliance_list:
-        lookup_table[alliance.allianceID] = alliance.name
-    KSystem.objects.all().update(sov="None")
+    alliances = dict((x.allianceID, x.name)
+                     for x in api.eve.AllianceList().alliances)
+    start = time.time()
+    factions = dict(Faction.objects.values_list('pk', 'name'))
+    sov = {}
     for sys in sovapi.solarSystems:
-        try:
-            if sys.factionID:
-                KSystem.objects.filter(pk=sys.solarSystemID).update(
-                    sov=Faction.objects.get(pk=sys.factionID).name)
-            elif sys.allianceID:
-                if sys.allianceID in lookup_table:
-                    KSystem.objects.filter(pk=sys.solarSystemID).update(
-                        sov=lookup_table[sys.allianceID])
-        except Exception:
-            pass
+        if sys.factionID:
+            name = factions.get(sys.factionID)
+        else:
+            name = alliances.get(sys.allianceID)
+        if name:
+            sov[sys.solarSystemID] = (name,)
+    with transaction.atomic():
+        changed = _sync_fields(KSystem.objects.all(), ('sov',), sov,
+                               ('None',))
+    return {'changed': changed, 'seconds': time.time() - start}
 
 
 @task()
@@ -107,12 +142,13 @@ def check_server_status():
 def downtime_site_update():
     """
     This task should be run during the scheduled EVE downtime.
-    It triggers the increment_downtime function on all singatures
-    that have been activated.
+    It increments the downtime count of all signatures that have been
+    activated and returns the counts of what changed and the time taken.
     """
-    for sig in Signature.objects.all():
-        if sig.downtimes or sig.downtimes == 0:
-            sig.increment_downtime()
+    start = time.time()
+    signatures, systems, maps = Signature.increment_downtimes()
+    return {'signatures': signatures, 'systems': systems, 'maps': maps,
+            'seconds': time.time() - start}
 
 
 @task()
@@ -121,6 +157,8 @@ def clear_stale_records():
     This task will clear any user location records older than 15 minutes.
     """
     limit = datetime.now(pytz.utc) - timedelta(minutes=15)
-    Signature.objects.filter(owned_time__isnull=False,
-                             owned_time__lt=limit).update(owned_time=None,
-                                                          owned_by=None)
+    stale = Signature.objects.filter(owned_time__isnull=False,
+                                     owned_time__lt=limit)
+    system_ids = set(stale.values_list('system_id', flat=True))
+    stale.update(owned_time=None, owned_by=None)
+    cache.delete_many([System.sig_cache_key(x) for x in system_ids])
@@ -19,7 +19,40 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from collections import defaultdict
+from datetime import datetime
+from io import BytesIO
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.db import IntegrityError, connection
+from django.http import Http404
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+import pytz
+import yaml
+
+from core.models import Constellation, Faction, Region
+from Map import locations, pubsub
+from Map.default_settings import load_defaults
+from Map.jumptable import JumpTable, NoRouteError
+from Map.spatial import CoordinateTable, METRES_PER_LY
+from Map.tree import MapTree
+from Map.models import (Map, MapSystem, KSystem, WSystem, Wormhole,
+                        WormholeType, Signature, System,
+                        SignatureType, MapPermission, MapLog,
+                        get_map_permission)
+from Map import tasks, utils, views
+from Map.utils import LayoutGenerator, MapJSONGenerator, closest_by_bfs
 
 
 class SimpleTest(TestCase):
@@ -28,3 +61,1212 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class MapTestMixin(object):
+    """Builds the static data and maps used by the Map tests."""
+
+    def setUp(self):
+        load_defaults()
+        # System ids are reused between tests with different classes
+        utils.invalidate_system_classes()
+        self.user = get_user_model().objects.create_user('mapper',
+                                                         password='mapper')
+        self.region = Region.objects.create(id=10000001, name='Test Region',
+                                            x=0, y=0, z=0)
+        self.constellation = Constellation.objects.create(
+            id=20000001, name='Test Constellation', region=self.region,
+            x=0, y=0, z=0)
+        self.k162 = WormholeType.objects.create(
+            name='K162', maxmass=0, jumpmass=0, lifetime=0, source='X',
+            destination=0, target='Unknown')
+        self.sigtype = SignatureType.objects.create(shortname='WH',
+                                                    longname='Wormhole')
+        self._next_system_id = 31000001
+
+    def make_system(self, sysclass=3):
+        """Creates a System with the given class and returns it."""
+        sys_id = self._next_system_id
+        self._next_system_id += 1
+        if sysclass in range(7, 12):
+            model, extra = KSystem, {'sov': '', 'jumps': 0}
+        else:
+            model, extra = WSystem, {}
+        return model.objects.create(
+            id=sys_id, name='J%s' % sys_id, constellation=self.constellation,
+            region=self.region, x=sys_id, y=0, z=0, security=-1.0,
+            sysclass=sysclass, lastscanned=datetime.now(pytz.utc),
+            npckills=0, podkills=0, shipkills=0, **extra)
+
+    def make_map(self, name, size, branching=1):
+        """Creates a map of size systems, each with one signature.
+
+        With branching=1 the map is a single chain, otherwise every
+        system gets up to branching children.
+        """
+        root = self.make_system(sysclass=7)
+        new_map = Map.objects.create(name=name, root=root)
+        map_systems = [new_map.add_system(self.user, root, 'Root')]
+        for i in range(1, size):
+            parent = map_systems[(i - 1) // branching]
+            child = new_map.add_system(self.user, self.make_system(),
+                                       'S%s' % i, parent)
+            child.connect_to(parent, self.k162, self.k162)
+            map_systems.append(child)
+        for i, map_system in enumerate(map_systems):
+            Signature.objects.create(
+                system=map_system.system, sigid='ABC-%03d' % i,
+                sigtype=self.sigtype if i % 2 else None)
+        return new_map
+
+
+class MapJSONQueryCountTest(MapTestMixin, TestCase):
+    """The map JSON must not issue queries per system."""
+
+    def _count_queries(self, map_obj):
+        generator = MapJSONGenerator(map_obj, self.user)
+        with CaptureQueriesContext(connection) as queries:
+            syslist = generator.create_syslist()
+        self.assertEqual(len(syslist), map_obj.systems.count())
+        return len(queries)
+
+    def test_query_count_is_constant(self):
+        small = self._count_queries(self.make_map('Small', 5))
+        large = self._count_queries(self.make_map('Large', 60))
+        self.assertEqual(small, large)
+
+    def test_query_count_is_constant_for_branching_maps(self):
+        chain = self._count_queries(self.make_map('Chain', 20))
+        tree = self._count_queries(self.make_map('Tree', 20, branching=3))
+        self.assertEqual(chain, tree)
+
+
+class MapRevisionTest(MapTestMixin, TestCase):
+    """Map revisions and the delta refresh."""
+
+    def _generator(self, map_obj):
+        return MapJSONGenerator(Map.objects.get(pk=map_obj.pk), self.user)
+
+    def test_saves_bump_revision(self):
+        map_obj = self.make_map('Revisions', 3)
+        revision = Map.objects.get(pk=map_obj.pk).revision
+        map_system = map_obj.systems.exclude(parentsystem=None)[0]
+        map_system.save()
+        wormhole = map_system.parent_wormhole
+        wormhole.mass_status = 1
+        wormhole.save()
+        Signature.objects.create(system=map_system.system, sigid='XYZ-123')
+        self.assertEqual(Map.objects.get(pk=map_obj.pk).revision,
+                         revision + 3)
+
+    def test_delta_only_contains_changes(self):
+        map_obj = self.make_map('Delta', 5)
+        full = self._generator(map_obj).get_systems_delta()
+        self.assertTrue(full['full'])
+        self.assertEqual(len(full['systems']), 5)
+        self.assertIsNone(
+            self._generator(map_obj).get_systems_delta(full['version']))
+
+        map_system = map_obj.systems.exclude(parentsystem=None)[0]
+        map_system.friendlyname = 'renamed'
+        map_system.save()
+        delta = self._generator(map_obj).get_systems_delta(full['version'])
+        self.assertFalse(delta['full'])
+        self.assertEqual([x['msID'] for x in delta['systems']],
+                         [map_system.pk])
+        self.assertEqual(delta['removed'], [])
+
+    def test_current_version_is_not_rebuilt(self):
+        map_obj = self.make_map('Current', 3)
+        version = self._generator(map_obj).get_systems_delta()['version']
+        generator = self._generator(map_obj)
+
+        def create_syslist():
+            raise AssertionError('The map state was rebuilt')
+        generator.create_syslist = create_syslist
+        with self.assertNumQueries(0):
+            self.assertIsNone(generator.get_systems_delta(version))
+        MapJSONGenerator.expire_map_state(map_obj)
+        self.assertRaises(AssertionError, generator.get_systems_delta,
+                          version)
+        self.assertTrue(self._generator(map_obj).get_systems_delta('junk')[
+            'full'])
+
+    def test_delta_reports_removed_systems(self):
+        map_obj = self.make_map('Removal', 4)
+        full = self._generator(map_obj).get_systems_delta()
+        leaf = map_obj.systems.order_by('-pk')[0]
+        leaf_pk = leaf.pk
+        leaf.remove_system(self.user)
+        delta = self._generator(map_obj).get_systems_delta(full['version'])
+        self.assertEqual(delta['removed'], [leaf_pk])
+        self.assertNotIn(leaf_pk, delta['order'])
+
+
+class ChainRemovalTest(MapTestMixin, TestCase):
+    """Removing and promoting map systems."""
+
+    def _ordered(self, map_obj):
+        return list(map_obj.systems.order_by('pk'))
+
+    def _remove(self, map_obj, index):
+        map_system = self._ordered(map_obj)[index]
+        logs = map_obj.logentries.count()
+        with CaptureQueriesContext(connection) as queries:
+            map_system.remove_system(self.user)
+        self.assertEqual(map_obj.logentries.count(), logs + 1)
+        return len(queries)
+
+    def test_remove_subtree(self):
+        map_obj = self.make_map('Tree', 13, branching=3)
+        # System 1's children are 4-6, which have none
+        self._remove(map_obj, 1)
+        remaining = set(x.friendlyname for x in self._ordered(map_obj))
+        self.assertEqual(remaining, set(['ROOT', 'S2', 'S3', 'S7', 'S8',
+                                         'S9', 'S10', 'S11', 'S12']))
+        self.assertEqual(Wormhole.objects.filter(map=map_obj).count(), 8)
+        self.assertRaises(ValueError,
+                          self._ordered(map_obj)[0].remove_system, self.user)
+
+    def test_remove_queries_do_not_grow(self):
+        small = self._remove(self.make_map('Small', 5), 1)
+        large = self._remove(self.make_map('Large', 40), 1)
+        self.assertEqual(small, large)
+
+    def test_promote(self):
+        map_obj = self.make_map('Promote', 10, branching=2)
+        # System 2's children are 5 and 6, which have none
+        promoted = self._ordered(map_obj)[2]
+        promoted.promote_system(self.user)
+        systems = self._ordered(map_obj)
+        self.assertEqual([x.friendlyname for x in systems],
+                         ['S2', 'S5', 'S6'])
+        self.assertIsNone(systems[0].parentsystem_id)
+        self.assertEqual(Wormhole.objects.filter(map=map_obj).count(), 2)
+        self.assertEqual(map_obj.logentries.filter(
+            action__startswith='Truncated').count(), 1)
+
+
+class ReorderTest(MapTestMixin, TestCase):
+    """Moving systems among their siblings."""
+
+    def setUp(self):
+        super(ReorderTest, self).setUp()
+        # ROOT has the children S1 to S8, all with priority 0
+        self.map = self.make_map('Reorder', 9, branching=8)
+
+    def _names(self):
+        return [x.friendlyname for x in self.map.systems.filter(
+            parentsystem__isnull=False).order_by('display_order_priority',
+                                                 'pk')]
+
+    def _get(self, name):
+        return self.map.systems.get(friendlyname=name)
+
+    def test_move_up_and_down(self):
+        self._get('S3').move_up()
+        self.assertEqual(self._names()[:4], ['S1', 'S3', 'S2', 'S4'])
+        self._get('S3').move_down()
+        self._get('S3').move_down()
+        self.assertEqual(self._names()[:4], ['S1', 'S2', 'S4', 'S3'])
+        self._get('S1').move_up()
+        self._get('S8').move_down()
+        self.assertEqual(self._names()[0], 'S1')
+        self.assertEqual(self._names()[-1], 'S8')
+
+    def test_move_to(self):
+        self._get('S7').move_to(0)
+        self.assertEqual(self._names(), ['S7', 'S1', 'S2', 'S3', 'S4', 'S5',
+                                         'S6', 'S8'])
+        self._get('S7').move_to(100)
+        self.assertEqual(self._names()[-1], 'S7')
+
+    def test_single_update(self):
+        map_system = self._get('S5')
+        revision = Map.objects.get(pk=self.map.pk).revision
+        with CaptureQueriesContext(connection) as queries:
+            map_system.move_to(0)
+        updates = [x for x in queries.captured_queries
+                   if 'UPDATE "Map_mapsystem"' in x['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Map.objects.get(pk=self.map.pk).revision,
+                         revision + 1)
+
+
+class DowntimeTest(MapTestMixin, TestCase):
+    """The downtime update of activated signatures."""
+
+    def test_downtime(self):
+        map_obj = self.make_map('Downtime', 6)
+        signatures = list(Signature.objects.order_by('pk'))
+        signatures[1].activate()
+        signatures[2].activate()
+        signatures[2].increment_downtime()
+        signatures[3].escalate()
+        revision = Map.objects.get(pk=map_obj.pk).revision
+        with CaptureQueriesContext(connection) as queries:
+            result = tasks.downtime_site_update()
+        self.assertEqual((result['signatures'], result['systems'],
+                          result['maps']), (3, 3, 1))
+        self.assertLess(len(queries), 10)
+        downtimes = dict(Signature.objects.values_list('pk', 'downtimes'))
+        self.assertEqual([downtimes[x.pk] for x in signatures],
+                         [None, 1, 2, 1, None, None])
+        self.assertFalse(Signature.objects.filter(
+            activated__isnull=False).exists())
+        self.assertFalse(Signature.objects.filter(
+            lastescalated__isnull=False).exists())
+        self.assertEqual(Map.objects.get(pk=map_obj.pk).revision,
+                         revision + 1)
+
+
+class FakeAPI(object):
+    """Stands in for eveapi.EVEAPIConnection with canned results."""
+    results = {}
+
+    def __init__(self, cacheHandler=None):
+        pass
+
+    def __getattr__(self, group):
+        results = self.results
+        return type('Group', (object,), dict(
+            (name, staticmethod(lambda rows=rows: rows))
+            for name, rows in results[group].items()))
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class APITasksTest(MapTestMixin, TestCase):
+    """The hourly stats and sov updates, against canned API results."""
+
+    def setUp(self):
+        super(APITasksTest, self).setUp()
+        self.connection = tasks.eveapi.EVEAPIConnection
+        tasks.eveapi.EVEAPIConnection = FakeAPI
+        self.k1 = self.make_system(sysclass=7)
+        self.k2 = self.make_system(sysclass=7)
+        self.k3 = self.make_system(sysclass=7)
+        self.w1 = self.make_system()
+
+    def tearDown(self):
+        tasks.eveapi.EVEAPIConnection = self.connection
+
+    def test_stats(self):
+        KSystem.objects.filter(pk=self.k3.pk).update(jumps=9)
+        System.objects.filter(pk=self.w1.pk).update(shipkills=4)
+        FakeAPI.results = {'map': {
+            'Jumps': Row(solarSystems=[
+                Row(solarSystemID=self.k1.pk, shipJumps=12),
+                Row(solarSystemID=self.k2.pk, shipJumps=3),
+                Row(solarSystemID=1, shipJumps=5)]),
+            'Kills': Row(solarSystems=[
+                Row(solarSystemID=self.k2.pk, shipKills=1, podKills=2,
+                    factionKills=30)]),
+        }}
+        with CaptureQueriesContext(connection) as queries:
+            result = tasks.update_system_stats()
+        self.assertEqual((result['jumps'], result['kills']), (3, 2))
+        self.assertLess(len(queries), 10)
+        self.assertEqual(dict(KSystem.objects.values_list('pk', 'jumps')),
+                         {self.k1.pk: 12, self.k2.pk: 3, self.k3.pk: 0})
+        self.assertEqual(
+            list(System.objects.order_by('pk').values_list(
+                'shipkills', 'podkills', 'npckills')),
+            [(0, 0, 0), (1, 2, 30), (0, 0, 0), (0, 0, 0)])
+
+    def test_sov(self):
+        Faction.objects.create(id=500001, name='Caldari State')
+        KSystem.objects.filter(pk=self.k3.pk).update(sov='Old Alliance')
+        FakeAPI.results = {
+            'map': {'Sovereignty': Row(solarSystems=[
+                Row(solarSystemID=self.k1.pk, factionID=500001,
+                    allianceID=0),
+                Row(solarSystemID=self.k2.pk, factionID=0, allianceID=99),
+                Row(solarSystemID=self.k3.pk, factionID=0, allianceID=98)])},
+            'eve': {'AllianceList': Row(alliances=[
+                Row(allianceID=99, name='Test Alliance')])},
+        }
+        result = tasks.update_system_sov()
+        self.assertEqual(result['changed'], 3)
+        self.assertEqual(dict(KSystem.objects.values_list('pk', 'sov')),
+                         {self.k1.pk: 'Caldari State',
+                          self.k2.pk: 'Test Alliance', self.k3.pk: 'None'})
+        self.assertEqual(tasks.update_system_sov()['changed'], 0)
+
+
+class YAMLTest(MapTestMixin, TestCase):
+    """Exporting maps to YAML and importing them again."""
+
+    def _without_times(self, systems):
+        for system in systems:
+            if system['parent_wh']:
+                del system['parent_wh']['updated']
+            self._without_times(system['children'])
+        return systems
+
+    def _export_queries(self, map_obj):
+        with CaptureQueriesContext(connection) as queries:
+            map_obj.as_yaml()
+        return len(queries)
+
+    def test_export(self):
+        map_obj = self.make_map('Export', 13, branching=3)
+        wormhole = Wormhole.objects.filter(map=map_obj).order_by('pk')[4]
+        wormhole.time_status = 1
+        wormhole.save()
+        exported = yaml.safe_load(map_obj.as_yaml())
+        self.assertEqual(exported['map_name'], 'Export')
+        root = map_obj.systems.get(parentsystem=None)
+        # Round trip the recursive dict too, as YAML drops time zones
+        self.assertEqual(exported['systems'], yaml.safe_load(
+            yaml.safe_dump([root.as_dict()])))
+        self.assertEqual(self._export_queries(map_obj),
+                         self._export_queries(self.make_map('Large', 60,
+                                                            branching=4)))
+
+    def test_import(self):
+        map_obj = self.make_map('Original', 13, branching=3)
+        wormhole = Wormhole.objects.filter(map=map_obj).order_by('pk')[4]
+        wormhole.time_status = 1
+        wormhole.save()
+        exported = map_obj.as_yaml().replace('map_name: Original',
+                                             'map_name: Imported')
+        expected = self._without_times(yaml.safe_load(exported)['systems'])
+        Signature.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            imported = Map.yaml_import(self.user, exported)
+        self.assertLess(len(queries), 40)
+        self.assertEqual(self._without_times(
+            yaml.safe_load(imported.as_yaml())['systems']), expected)
+        # Every system gets its own signature back
+        self.assertEqual(
+            sorted(Signature.objects.values_list('system_id', 'sigid')),
+            sorted((x.system_id, 'ABC-%03d' % i) for i, x in
+                   enumerate(map_obj.systems.order_by('pk'))))
+        self.assertIsNotNone(imported.systems.get(
+            parent_wormhole__time_status=1).parent_wormhole.eol_time)
+
+    def test_import_unknown_system(self):
+        map_obj = self.make_map('Unknown', 3)
+        exported = map_obj.as_yaml().replace('J%s' % map_obj.root_id,
+                                             'Nowhere')
+        self.assertRaises(System.DoesNotExist, Map.yaml_import, self.user,
+                          exported)
+        self.assertEqual(Map.objects.filter(name='Unknown').count(), 1)
+
+    def test_import_rejects_unmatched_rows(self):
+        exported = self.make_map('Original', 3).as_yaml().replace(
+            'map_name: Original', 'map_name: Imported')
+        bulk_create = MapSystem.objects.bulk_create
+
+        def racing_bulk_create(objs):
+            created = bulk_create(objs)
+            # Another request adds a system below the same parent
+            bulk_create([MapSystem(map_id=objs[0].map_id,
+                                   parentsystem_id=objs[0].parentsystem_id,
+                                   system_id=objs[0].system_id,
+                                   friendlyname='OTHER')])
+            return created
+        MapSystem.objects.bulk_create = racing_bulk_create
+        try:
+            self.assertRaises(IntegrityError, Map.yaml_import, self.user,
+                              exported)
+        finally:
+            del MapSystem.objects.bulk_create
+        self.assertFalse(Map.objects.filter(name='Imported').exists())
+
+
+class MapTreeTest(SimpleTestCase):
+    def setUp(self):
+        # 1 - 2 - 3 - 4 with 5 below 2, and 4's wormhole collapsed
+        self.tree = MapTree([(1, None, None), (2, 1, False), (3, 2, False),
+                             (4, 3, True), (5, 2, False)])
+
+    def test_structure(self):
+        self.assertEqual(self.tree.depth(1), 0)
+        self.assertEqual(self.tree.depth(4), 3)
+        self.assertEqual(self.tree.ancestors(4), [3, 2, 1])
+        self.assertEqual(self.tree.subtree(2), set([2, 3, 4, 5]))
+        self.assertTrue(self.tree.is_below(5, 2))
+        self.assertFalse(self.tree.is_below(5, 3))
+        self.assertIn(5, self.tree)
+
+    def test_interest_path(self):
+        self.assertEqual(self.tree.open_path(5), [5, 2, 1])
+        self.assertEqual(self.tree.open_path(4), [4])
+        self.assertEqual(self.tree.interest_path([4, 5]), set([1, 2, 4, 5]))
+
+
+class MapTreeUseTest(MapTestMixin, TestCase):
+    def test_distance_and_interest(self):
+        map_obj = self.make_map('Tree', 6)
+        systems = list(map_obj.systems.order_by('pk'))
+        with self.assertNumQueries(1):
+            self.assertEqual(systems[5].distance_from_root(), 5)
+        systems[2].interesttime = datetime.now(pytz.utc)
+        systems[2].save()
+        generator = MapJSONGenerator(Map.objects.get(pk=map_obj.pk),
+                                     self.user)
+        interest = dict((x['msID'], x['interestpath'])
+                        for x in generator.create_syslist())
+        self.assertEqual([interest[x.pk] for x in systems],
+                         [True, True, True, False, False, False])
+
+
+class LayoutGeneratorTest(SimpleTestCase):
+    def _children(self, links):
+        children = defaultdict(list)
+        for parent, child in links:
+            children[parent].append(child)
+        return children
+
+    def test_layout(self):
+        generator = LayoutGenerator(self._children(
+            [(None, 1), (1, 2), (1, 3), (2, 4), (3, 5), (3, 6)]))
+        self.assertEqual(generator.compute_layout(),
+                         {1: (0, 0), 2: (1, 0), 4: (2, 0), 3: (1, 1),
+                          5: (2, 1), 6: (2, 2)})
+        self.assertEqual(generator.processed, [1, 2, 4, 3, 5, 6])
+
+    def test_deep_chain(self):
+        links = [(None, 0)] + [(x, x + 1) for x in range(5000)]
+        positions = LayoutGenerator(self._children(links)).compute_layout()
+        self.assertEqual(positions[5000], (5000, 0))
+
+    def test_cached_by_structure(self):
+        links = [(None, 1), (1, 2), (1, 3)]
+        first = LayoutGenerator(self._children(links))
+        first.get_layout()
+        second = LayoutGenerator(self._children(links))
+        second.compute_layout = None
+        self.assertEqual(second.get_layout(), first.positions)
+        self.assertNotEqual(
+            LayoutGenerator(self._children(links[:2])).get_cache_key(),
+            first.get_cache_key())
+
+
+class BrokerTestMixin(object):
+    """Behaviour shared by every pub/sub broker."""
+    def test_read_returns_events_after_id(self):
+        first = self.broker.publish('map_1', 'log', {'action': 'a'})
+        second = self.broker.publish('map_1', 'revision', {})
+        self.assertEqual(self.broker.last_id('map_1'), second)
+        self.assertEqual(self.broker.read('map_1', first),
+                         [(second, 'revision', {})])
+        self.assertEqual(self.broker.read('map_1', second), [])
+        self.assertEqual(self.broker.read('map_2', 0), [])
+
+    def test_listen_times_out(self):
+        self.assertEqual(self.broker.listen('map_1', 0, 0.1), [])
+
+    def test_listen_wakes_on_publish(self):
+        timer = threading.Timer(
+            0.1, self.broker.publish, ('map_1', 'revision', {}))
+        timer.start()
+        events = self.broker.listen('map_1', 0, 5)
+        timer.join()
+        self.assertEqual(events, [(self.broker.last_id('map_1'), 'revision',
+                                   {})])
+
+    def test_read_starts_over_from_newer_id(self):
+        event_id = self.broker.publish('map_1', 'revision', {})
+        self.assertEqual(self.broker.read('map_1', event_id + 1000),
+                         [(event_id, 'revision', {})])
+
+
+class LocalBrokerTest(BrokerTestMixin, SimpleTestCase):
+    def setUp(self):
+        self.broker = pubsub.LocalBroker()
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'pubsub-tests'}})
+class CacheBrokerTest(BrokerTestMixin, SimpleTestCase):
+    def setUp(self):
+        pubsub.cache.clear()
+        self.broker = pubsub.CacheBroker()
+        self.broker.poll_interval = 0.05
+
+    def test_missing_event_is_skipped_after_gap_timeout(self):
+        self.broker.gap_timeout = 0
+        first = self.broker.publish('map_1', 'log', {})
+        second = self.broker.publish('map_1', 'revision', {})
+        pubsub.cache.delete(self.broker._event_key('map_1', first))
+        self.assertEqual(self.broker.read('map_1', 0),
+                         [(second, 'revision', {})])
+
+    def test_ids_keep_rising_after_counter_eviction(self):
+        old = self.broker.publish('map_1', 'log', {})
+        pubsub.cache.delete(self.broker._counter_key('map_1'))
+        time.sleep(0.01)
+        new = self.broker.publish('map_1', 'revision', {})
+        self.assertGreater(new, old)
+        self.assertEqual(self.broker.read('map_1', old),
+                         [(new, 'revision', {})])
+
+
+class PubSubAtomicTest(TestCase):
+    def setUp(self):
+        self.old_broker = pubsub._broker
+        pubsub._broker = pubsub.LocalBroker()
+
+    def tearDown(self):
+        pubsub._broker = self.old_broker
+
+    def test_events_are_published_after_the_block(self):
+        with pubsub.atomic():
+            pubsub.publish('map_1', 'revision', {})
+            with pubsub.atomic():
+                pubsub.publish('map_1', 'log', {})
+            self.assertEqual(pubsub._broker.last_id('map_1'), 0)
+        self.assertEqual([x[1] for x in pubsub._broker.read('map_1', 0)],
+                         ['revision', 'log'])
+
+    def test_events_from_failed_blocks_are_dropped(self):
+        with pubsub.atomic():
+            pubsub.publish('map_1', 'revision', {})
+            try:
+                with pubsub.atomic():
+                    pubsub.publish('map_1', 'log', {})
+                    raise ValueError
+            except ValueError:
+                pass
+        with self.assertRaises(ValueError):
+            with pubsub.atomic():
+                pubsub.publish('map_1', 'dialog', {})
+                raise ValueError
+        self.assertEqual([x[1] for x in pubsub._broker.read('map_1', 0)],
+                         ['revision'])
+
+
+class LocationStoreTestMixin(object):
+    """Behaviour shared by every location store."""
+    def setUp(self):
+        self.pilot = get_user_model()(pk=1, username='pilot')
+        self.other = get_user_model()(pk=2, username='other')
+
+    def _update(self, user, system_id, charid):
+        return self.store.update(user, system_id, charid, 'Char %s' % charid,
+                                 'Ship %s' % charid, 'Rifter')
+
+    def test_systems_and_users(self):
+        self._update(self.pilot, 30000001, 90000001)
+        self._update(self.other, 30000001, 90000002)
+        self._update(self.pilot, 30000002, 90000003)
+        systems = self.store.systems([30000001, 30000002, 30000003])
+        self.assertEqual(sorted(systems[30000001]), [90000001, 90000002])
+        self.assertEqual(systems[30000002][90000003].charname,
+                         'Char 90000003')
+        self.assertNotIn(30000003, systems)
+        self.assertEqual(sorted(self.store.user(1)), [90000001, 90000003])
+        self.assertEqual(self.store.user(3), {})
+
+    def test_move_and_remove(self):
+        self._update(self.pilot, 30000001, 90000001)
+        self._update(self.pilot, 30000002, 90000001)
+        self.assertEqual(self.store.system(30000001), {})
+        self.assertEqual(list(self.store.system(30000002)), [90000001])
+        self.store.remove(90000001)
+        self.assertEqual(self.store.system(30000002), {})
+        self.assertEqual(self.store.user(1), {})
+
+
+class LocalLocationStoreTest(LocationStoreTestMixin, SimpleTestCase):
+    def setUp(self):
+        super(LocalLocationStoreTest, self).setUp()
+        self.store = locations.LocalLocationStore()
+
+    def test_expiry(self):
+        location = self._update(self.pilot, 30000001, 90000001)
+        self.store._locations[90000001] = location._replace(
+            timestamp=location.timestamp - locations.LOCATION_TIMEOUT - 1)
+        self.assertEqual(self.store.system(30000001), {})
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'location-tests'}})
+class CacheLocationStoreTest(LocationStoreTestMixin, SimpleTestCase):
+    def setUp(self):
+        super(CacheLocationStoreTest, self).setUp()
+        locations.cache.clear()
+        self.store = locations.CacheLocationStore()
+
+    def test_concurrent_arrivals(self):
+        threads = [threading.Thread(target=self._update,
+                                    args=(self.pilot, 30000001, 90000000 + x))
+                   for x in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.store.system(30000001)), 20)
+        self.assertEqual(len(self.store.user(1)), 20)
+
+    def test_refresh_skips_indexes(self):
+        self._update(self.pilot, 30000001, 90000001)
+        locations.cache.delete(self.store._system_key(30000001))
+        self._update(self.pilot, 30000001, 90000001)
+        self.assertEqual(self.store.system(30000001), {})
+        self.store.reindex_interval = 0
+        self._update(self.pilot, 30000001, 90000001)
+        self.assertEqual(list(self.store.system(30000001)), [90000001])
+
+
+class JumpTableTest(SimpleTestCase):
+    def setUp(self):
+        # 1 - 2 - 3 - 4 with a shortcut 1 - 5 - 4 and 6 - 7 cut off
+        self.table = JumpTable.build([(1, 2), (2, 3), (3, 4), (1, 5),
+                                      (5, 4), (6, 7)])
+
+    def test_jumps(self):
+        self.assertEqual(self.table.jumps(1, 1), 0)
+        self.assertEqual(self.table.jumps(1, 3), 2)
+        self.assertEqual(self.table.jumps(4, 1), 2)
+        self.assertEqual(self.table.jumps(2, 5), 2)
+
+    def test_route(self):
+        self.assertEqual(self.table.route(1, 4), [1, 5, 4])
+        self.assertEqual(self.table.route(3, 3), [3])
+        self.assertEqual(len(self.table.route(2, 5)), 3)
+
+    def test_no_route(self):
+        self.assertRaises(NoRouteError, self.table.jumps, 1, 7)
+        self.assertRaises(NoRouteError, self.table.route, 6, 2)
+        self.assertRaises(NoRouteError, self.table.jumps, 1, 99)
+
+    def test_closest(self):
+        expected = {3: (2, 1), 4: (5, 1), 7: None, 99: None}
+        self.assertEqual(self.table.closest([2, 5], [3, 4, 7, 99]), expected)
+        graph = dict((x, set()) for x in range(1, 8))
+        for from_id, to_id in [(1, 2), (2, 3), (3, 4), (1, 5), (5, 4),
+                               (6, 7)]:
+            graph[from_id].add(to_id)
+            graph[to_id].add(from_id)
+        self.assertEqual(closest_by_bfs(graph, [2, 5], [3, 4, 7, 99]),
+                         expected)
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'jumptable')
+        self.assertIsNone(JumpTable.load(path))
+        self.table.save(path)
+        loaded = JumpTable.load(path)
+        self.assertEqual(loaded.route(1, 4), [1, 5, 4])
+        self.assertEqual(loaded.jumps(2, 4), 2)
+
+
+class RouteDataTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'jumptable')
+        override = override_settings(
+            MAP_JUMP_TABLE_PATH=self.path,
+            CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'route-tests'}})
+        override.enable()
+        self.addCleanup(override.disable)
+        utils.cache.clear()
+        self.addCleanup(setattr, utils, '_route_data', utils._route_data)
+        utils._route_data = utils._RouteData()
+
+    def test_table_is_shared_until_version_changes(self):
+        self.assertIsNone(utils.get_jump_table())
+        JumpTable.build([(1, 2)]).save(self.path)
+        utils.bump_route_version()
+        table = utils.get_jump_table()
+        self.assertEqual(table.jumps(1, 2), 1)
+        self.assertIs(utils.RouteFinder().table, table)
+
+        JumpTable.build([(1, 2), (2, 3)]).save(self.path)
+        self.assertIs(utils.get_jump_table(), table)
+        utils.bump_route_version()
+        self.assertEqual(utils.get_jump_table().jumps(1, 3), 2)
+
+
+class CoordinateTableTest(SimpleTestCase):
+    def setUp(self):
+        # Systems along the x axis at 0, 1, 3, 10 and -4 light years
+        self.table = CoordinateTable.from_rows(
+            (system_id, ly * METRES_PER_LY, 0, 0) for system_id, ly
+            in [(1, 0), (2, 1), (3, 3), (4, 10), (5, -4)])
+
+    def test_ly_distances(self):
+        self.assertEqual(self.table.ly_distances(2, [1, 3, 5]).tolist(),
+                         [1, 2, 5])
+        self.assertEqual(len(self.table.ly_distances(1)), 5)
+
+    def test_within(self):
+        self.assertEqual(self.table.within(1, 3.5),
+                         [(1, 0), (2, 1), (3, 3)])
+        self.assertEqual([x[0] for x in self.table.within(2, 5)],
+                         [2, 1, 3, 5])
+        self.assertEqual([x[0] for x in self.table.within(4, 100)],
+                         [4, 3, 2, 1, 5])
+
+
+class WormholeTypeTableTest(TestCase):
+    def setUp(self):
+        utils.invalidate_wormhole_types()
+        self.types = {}
+        for name, source, destination in [
+                ('B274', 'H', 2), ('Z971', 'K', 1), ('D382', '2', 2),
+                ('E004', 'W', 2), ('N062', 'Z', 7), ('B449', '5', 7),
+                ('A239', 'K', 8)]:
+            self.types[name] = WormholeType.objects.create(
+                name=name, maxmass=0, jumpmass=0, lifetime=0, source=source,
+                destination=destination, target='Unknown')
+
+    def _names(self, sysclass1, sysclass2):
+        system1 = WSystem(sysclass=sysclass1)
+        system2 = WSystem(sysclass=sysclass2)
+        return [x.name for x in utils.get_wormhole_type(system1, system2)]
+
+    def test_resolution(self):
+        # Highsec uses its own types, falling back to any k-space
+        self.assertEqual(self._names(7, 2), ['B274'])
+        self.assertEqual(self._names(7, 1), ['Z971'])
+        # Low/null uses NH, falling back to any k-space
+        self.assertEqual(self._names(8, 8), ['A239'])
+        # C5 and C6 use Z types when there are any
+        self.assertEqual(self._names(5, 7), ['N062'])
+        self.assertEqual(self._names(4, 7), [])
+        # Wormhole classes add the W types
+        self.assertEqual(self._names(2, 2), ['D382', 'E004'])
+
+    def test_cached_until_types_change(self):
+        self._names(2, 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._names(2, 2), ['D382', 'E004'])
+            self._names(7, 2)
+        self.types['E004'].delete()
+        self.assertEqual(self._names(2, 2), ['D382'])
+
+
+class MapPermissionCacheTest(MapTestMixin, TestCase):
+    def setUp(self):
+        super(MapPermissionCacheTest, self).setUp()
+        self.map = self.make_map('Permissions', 1)
+        self.map.explicitperms = True
+        self.map.save()
+        self.group = Group.objects.create(name='Scouts')
+        self.user.groups.add(self.group)
+        self.grant = MapPermission.objects.create(group=self.group,
+                                                  map=self.map, access=1)
+
+    def _access(self):
+        return get_map_permission(self.map.pk, self.user, self.map)
+
+    def test_cached(self):
+        self.assertEqual(self._access(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._access(), 1)
+            self.assertEqual(self.map.get_permission(self.user), 1)
+
+    def test_invalidated_by_map_permission(self):
+        self.assertEqual(self._access(), 1)
+        self.grant.access = 2
+        self.grant.save()
+        self.assertEqual(self._access(), 2)
+        self.grant.delete()
+        self.assertEqual(self._access(), 0)
+
+    def test_invalidated_by_groups_and_permissions(self):
+        self.assertEqual(self._access(), 1)
+        self.user.groups.remove(self.group)
+        self.assertEqual(self._access(), 0)
+        self.group.user_set.add(self.user)
+        self.assertEqual(self._access(), 1)
+        self.group.permissions.add(
+            Permission.objects.get(codename='map_admin'))
+        self.user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertEqual(self._access(), 2)
+
+    def test_invalidated_by_map(self):
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='map_unrestricted'))
+        self.user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertEqual(self._access(), 1)
+        self.map.explicitperms = False
+        self.map.save()
+        self.assertEqual(self._access(), 2)
+
+    def test_edit_signature_checks_the_system_map(self):
+        self.grant.access = 2
+        self.grant.save()
+        other = self.make_map('Other', 1)
+        other.explicitperms = True
+        other.save()
+        map_system = other.systems.get()
+        request = RequestFactory().post(
+            '/', {'sigid': 'XYZ-123', 'info': '', 'sigtype': ''},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = self.user
+        response = views.edit_signature(request, str(self.map.pk),
+                                        str(map_system.pk))
+        self.assertEqual(response.content, '')
+        self.assertFalse(Signature.objects.filter(
+            system=map_system.system, sigid='XYZ-123').exists())
+
+
+class MapCheckinTest(MapTestMixin, TestCase):
+    def setUp(self):
+        super(MapCheckinTest, self).setUp()
+        self.user.is_superuser = True
+        self.user.save()
+        self.map = self.make_map('Checkin', 1)
+        # Map ids are reused between tests
+        cache.delete(MapLog.cursor_key(self.map.pk))
+        self.factory = RequestFactory()
+
+    def _checkin(self, cursor):
+        request = self.factory.post('/map/%s/update/' % self.map.pk,
+                                    {'cursor': cursor})
+        request.user = self.user
+        request.is_igb_trusted = False
+        response = views.map_checkin(request, str(self.map.pk))
+        return json.loads(response.content)
+
+    def test_nothing_new(self):
+        cursor = self._checkin(0)['cursor']
+        self.assertEqual(cursor, MapLog.get_cursor(self.map.pk))
+        self.map.add_log(self.user, 'Hidden')
+        with self.assertNumQueries(0):
+            self.assertEqual(self._checkin(cursor), {'cursor': cursor})
+
+    def test_new_entries(self):
+        cursor = self._checkin(0)['cursor']
+        self.map.add_log(self.user, 'First', visible=True)
+        first = self._checkin(cursor)
+        self.assertEqual([x['action'] for x in first['logs']], ['First'])
+        self.map.add_log(self.user, 'Hidden')
+        self.map.add_log(self.user, 'Second', visible=True)
+        second = self._checkin(first['cursor'])
+        self.assertEqual([x['action'] for x in second['logs']], ['Second'])
+        self.assertEqual(second['cursor'], MapLog.get_cursor(self.map.pk))
+        old_broker = pubsub._broker
+        pubsub._broker = pubsub.LocalBroker()
+        try:
+            self.map.add_logs(self.user, ['Third', 'Fourth'], visible=True)
+            published = pubsub._broker.read(pubsub.map_channel(self.map.pk),
+                                            0)
+        finally:
+            pubsub._broker = old_broker
+        third = self._checkin(second['cursor'])
+        self.assertEqual([x['action'] for x in third['logs']],
+                         ['Third', 'Fourth'])
+        self.assertEqual([x[2]['id'] for x in published],
+                         [x['id'] for x in third['logs']])
+
+
+class IGBCheckinTest(MapTestMixin, TestCase):
+    def setUp(self):
+        super(IGBCheckinTest, self).setUp()
+        self.user.is_superuser = True
+        self.user.save()
+        self.map = self.make_map('Jumps', 3)
+        self.root, self.first, self.second = [
+            x.system for x in self.map.systems.order_by('pk')]
+        self.factory = RequestFactory()
+        cache.clear()
+
+    def _checkin(self, system, silent=True):
+        request = self.factory.post(
+            '/map/%s/update/' % self.map.pk,
+            {'cursor': MapLog.get_cursor(self.map.pk),
+             'silent': 'true' if silent else 'false'})
+        request.user = self.user
+        request.is_igb_trusted = True
+        request.eve_systemid = str(system.pk)
+        request.eve_charid = 90000001
+        request.eve_charname = 'Pilot'
+        request.eve_shipname = 'Ship'
+        request.eve_shiptypename = 'Frigate'
+        return views.map_checkin(request, str(self.map.pk))
+
+    def test_jumps_within_the_map_need_no_queries(self):
+        self._checkin(self.first)
+        with self.assertNumQueries(0):
+            self._checkin(self.second)
+            self._checkin(self.first)
+        self.assertEqual(
+            locations.get_store().user(self.user.pk).values()[0].system_id,
+            self.first.pk)
+
+    def test_jump_out_of_the_map_adds_the_system(self):
+        self._checkin(self.second)
+        new_system = self.make_system()
+        self._checkin(new_system)
+        added = self.map.systems.get(system=new_system)
+        self.assertEqual(added.parentsystem.system_id, self.second.pk)
+        self.assertIn(new_system, Map.objects.get(pk=self.map.pk))
+
+    def test_kspace_jumps_are_not_added(self):
+        self._checkin(self.root)
+        highsec = self.make_system(sysclass=7)
+        self._checkin(highsec)
+        self.assertNotIn(highsec, Map.objects.get(pk=self.map.pk))
+
+    def test_changed_system_class_is_picked_up(self):
+        self.assertEqual(utils.get_system_class(self.first.pk), 3)
+        system = WSystem.objects.get(pk=self.first.pk)
+        system.importance = 1
+        system.save()
+        with self.assertNumQueries(0):
+            utils.get_system_class(self.first.pk)
+        system.sysclass = 5
+        system.save()
+        self.assertEqual(utils.get_system_class(self.first.pk), 5)
+
+
+class TooltipCacheTest(MapTestMixin, TestCase):
+    def setUp(self):
+        super(TooltipCacheTest, self).setUp()
+        self.user.is_superuser = True
+        self.user.save()
+        self.map = self.make_map('Tooltips', 5)
+        self.factory = RequestFactory()
+        cache.clear()
+
+    def _get(self, view):
+        request = self.factory.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = self.user
+        return view(request, str(self.map.pk)).content
+
+    def test_system_counts(self):
+        system = self.map.systems.order_by('pk')[1].system
+        for sigid in ('XYZ-001', 'XYZ-002'):
+            Signature.objects.create(system=system, sigid=sigid)
+        tooltips = self._get(views.system_tooltips)
+        self.assertEqual(tooltips.count('SIG: 3 POS: 0'), 1)
+        self.assertEqual(tooltips.count('SIG: 1 POS: 0'), 4)
+
+    def test_only_changed_fragments_are_rendered(self):
+        rendered = []
+        render = utils.render_to_string
+
+        def counting_render(template, context):
+            rendered.append(context)
+            return render(template, context)
+
+        utils.render_to_string = counting_render
+        try:
+            first = self._get(views.system_tooltips)
+            self.assertEqual(len(rendered), 5)
+            self.assertEqual(self._get(views.system_tooltips), first)
+            self.assertEqual(len(rendered), 5)
+            map_system = self.map.systems.order_by('pk')[2]
+            map_system.friendlyname = 'renamed'
+            map_system.save()
+            self.assertIn('RENAMED', self._get(views.system_tooltips))
+            self.assertEqual(len(rendered), 6)
+
+            self._get(views.wormhole_tooltips)
+            self.assertEqual(len(rendered), 10)
+            wormhole = map_system.parent_wormhole
+            wormhole.time_status = 1
+            wormhole.save()
+            self.assertIn('End of Life', self._get(views.wormhole_tooltips))
+            self.assertEqual(len(rendered), 11)
+        finally:
+            utils.render_to_string = render
+
+
+class SignatureListCacheTest(MapTestMixin, TestCase):
+    def setUp(self):
+        super(SignatureListCacheTest, self).setUp()
+        self.user.is_superuser = True
+        self.user.save()
+        self.map = self.make_map('Signatures', 3)
+        self.map_system = self.map.systems.order_by('pk')[1]
+        self.factory = RequestFactory()
+        cache.clear()
+
+    def _get(self, user=None, **params):
+        request = self.factory.get('/', params,
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = user or self.user
+        request.is_igb_trusted = False
+        request.META['CSRF_COOKIE'] = 'token-%s' % request.user.username
+        return views.get_signature_list(
+            request, str(self.map.pk), str(self.map_system.pk),
+            str(self.map_system.system_id))
+
+    def test_rendered_once_per_revision(self):
+        rendered = []
+        render = views.render_to_string
+
+        def counting_render(template, context):
+            rendered.append(context)
+            return render(template, context)
+
+        other = get_user_model().objects.create_user('other',
+                                                     password='other')
+        other.is_superuser = True
+        other.save()
+        views.render_to_string = counting_render
+        try:
+            first = self._get().content
+            self.assertNotIn(views.SIG_LIST_CSRF_PLACEHOLDER, first)
+            self.assertIn('token-mapper', first)
+            self.assertIn('ABC-001', first)
+            self.assertIn('token-other', self._get(other).content)
+            self.assertEqual(len(rendered), 1)
+            signature = Signature.objects.get(system=self.map_system.system)
+            signature.info = 'Renamed site'
+            signature.save()
+            self.assertIn('Renamed site', self._get().content)
+            self.assertEqual(len(rendered), 2)
+        finally:
+            views.render_to_string = render
+
+    def test_json(self):
+        signatures = json.loads(self._get(format='json').content)
+        self.assertEqual([x['id'] for x in signatures], ['ABC-001'])
+        self.assertEqual(signatures[0]['type'], 'WH')
+        signature = Signature.objects.get(system=self.map_system.system)
+        signature.activate()
+        signatures = json.loads(self._get(format='json').content)
+        self.assertEqual(signatures[0]['downtimes'], 0)
+        self.assertIsNotNone(signatures[0]['activated'])
+
+
+class MapRefreshTest(MapTestMixin, TestCase):
+    def setUp(self):
+        super(MapRefreshTest, self).setUp()
+        self.user.is_superuser = True
+        self.user.save()
+        self.map = self.make_map('Refresh', 4)
+        self.factory = RequestFactory()
+        cache.clear()
+
+    def _get(self, **headers):
+        request = self.factory.get('/', HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   **headers)
+        request.user = self.user
+        request.is_igb_trusted = False
+        return views.map_refresh(request, str(self.map.pk))
+
+    def test_payload(self):
+        response = self._get()
+        payload = json.loads(response.content)
+        self.assertEqual(len(payload['systems']), 4)
+        self.assertEqual(response['ETag'], '"%s"' % payload['version'])
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['X-Map-User-Locations'], '')
+
+        zipped = self._get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(zipped['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            gzip.GzipFile(fileobj=BytesIO(zipped.content)).read(),
+            response.content)
+
+    def test_not_modified(self):
+        etag = self._get()['ETag']
+        self.user.update_location(self.map.root.pk, 1, 'Pilot', 'Ship',
+                                  'Frigate')
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['X-Map-User-Locations'],
+                         str(self.map.root.pk))
+        map_system = self.map.systems.order_by('pk')[1]
+        map_system.friendlyname = 'changed'
+        map_system.save()
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+    def _get_delta(self, version='', **headers):
+        request = self.factory.get('/', {'version': version},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                   **headers)
+        request.user = self.user
+        return views.map_refresh_delta(request, str(self.map.pk))
+
+    def test_delta_payload(self):
+        response = self._get_delta(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        delta = json.loads(
+            gzip.GzipFile(fileobj=BytesIO(response.content)).read())
+        self.assertTrue(delta['full'])
+        self.assertEqual(response['ETag'], '"%s"' % delta['version'])
+        self.assertEqual(self._get_delta(delta['version']).status_code, 304)
+
+        response = self._get_delta(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        map_system = self.map.systems.order_by('pk')[1]
+        map_system.friendlyname = 'changed'
+        map_system.save()
+        changed = json.loads(self._get_delta(delta['version']).content)
+        self.assertEqual([x['msID'] for x in changed['systems']],
+                         [map_system.pk])
+
+
+    def test_event_stream_is_opt_in(self):
+        request = self.factory.get('/')
+        request.user = self.user
+        self.assertRaises(Http404, views.map_events, request,
+                          str(self.map.pk))
+        with self.settings(MAP_EVENT_STREAM=True):
+            response = views.map_events(request, str(self.map.pk))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+
+class BulkSignatureImportTest(MapTestMixin, TestCase):
+    """Signature.import_tsv must be set based."""
+
+    def setUp(self):
+        super(BulkSignatureImportTest, self).setUp()
+        self.map = self.make_map('Import', 3)
+        self.map_system = self.map.systems.order_by('-pk')[0]
+        self.system = self.map_system.system
+
+    def _rows(self, count, start=0):
+        return [['XYZ%03d' % i, 'Cosmic Signature', 'Wormhole',
+                 'Unstable Wormhole' if i % 2 else '', '100.0%', '5 AU']
+                for i in range(start, start + count)]
+
+    def _import(self, rows):
+        with CaptureQueriesContext(connection) as queries:
+            results = Signature.import_tsv(self.user, self.map_system, rows)
+        return results, len(queries)
+
+    def test_query_count_is_constant(self):
+        # Sizes stay below SQLite's limit on query parameters, which
+        # splits bulk inserts into batches.
+        self._import(self._rows(10))
+        small = self._import(self._rows(10, start=5) + self._rows(5, 500))[1]
+        large = self._import(self._rows(40) + self._rows(20, 1000))[1]
+        self.assertEqual(small, large)
+        self.assertEqual(self.system.signatures.count(), 1 + 40 + 20 + 5)
+
+    def test_actions_and_values(self):
+        Signature.objects.create(system=self.system, sigid='XYZ-001',
+                                 info='Old name')
+        rows = self._rows(3)
+        rows.append(['xyz002', 'Cosmic Signature', 'Wormhole', 'Later',
+                     '100.0%', '5 AU'])
+        results, queries = self._import(rows)
+        self.assertEqual([(sig.sigid, action) for sig, action, row
+                          in results],
+                         [('XYZ-000', 'Created'), ('XYZ-001', 'Scanned'),
+                          ('XYZ-002', 'Created'), ('XYZ-002', 'Scanned')])
+        sigs = dict((sig.sigid, sig) for sig in self.system.signatures.all())
+        self.assertEqual(sigs['XYZ-001'].info, 'Unstable Wormhole')
+        self.assertEqual(sigs['XYZ-002'].info, 'Later')
+        self.assertEqual(sigs['XYZ-000'].sigtype, self.sigtype)
+        self.assertEqual(sigs['XYZ-001'].modified_by, self.user)
+        self.assertTrue(all(sig.pk for sig, action, row in results))
+        self.assertEqual(
+            self.map.logentries.filter(action__startswith='Scanned').count(), 2)
@@ -0,0 +1,131 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+In-memory index of the parent links between the systems of a map.
+"""
+from collections import defaultdict
+
+from django.core.exceptions import ObjectDoesNotExist
+
+
+class MapTree(object):
+    """Answers ancestry questions about a map's systems without queries.
+
+    Systems are numbered in depth first order from the roots, so the
+    subtree of a system is a contiguous run of that order and checking
+    whether one system is below another compares two numbers.
+    """
+    def __init__(self, rows):
+        """rows holds a (pk, parent_id, collapsed) tuple per map system,
+        where collapsed tells whether its parent wormhole has collapsed.
+        """
+        self.parents = {}
+        self.children = defaultdict(list)
+        self.collapsed = set()
+        for pk, parent_id, collapsed in sorted(rows):
+            self.parents[pk] = parent_id
+            self.children[parent_id].append(pk)
+            if collapsed:
+                self.collapsed.add(pk)
+        self.order = []
+        self.depths = {}
+        # A system's subtree is order[first[pk]:last[pk]]
+        self.first = {}
+        self.last = {}
+        for root in self.children[None]:
+            stack = [(root, 0, False)]
+            while stack:
+                pk, depth, finished = stack.pop()
+                if finished:
+                    self.last[pk] = len(self.order)
+                    continue
+                self.first[pk] = len(self.order)
+                self.order.append(pk)
+                self.depths[pk] = depth
+                stack.append((pk, depth, True))
+                for child in reversed(self.children[pk]):
+                    if child not in self.first:
+                        stack.append((child, depth + 1, False))
+
+    @classmethod
+    def for_map(cls, map_id):
+        """Builds the tree of the map with pk map_id in one query."""
+        from Map.models import MapSystem
+        return cls(MapSystem.objects.filter(map_id=map_id).values_list(
+            'pk', 'parentsystem_id', 'parent_wormhole__collapsed'))
+
+    @classmethod
+    def from_map_systems(cls, map_systems):
+        """Builds the tree from MapSystems fetched with their parent
+        wormholes.
+        """
+        rows = []
+        for map_system in map_systems:
+            try:
+                collapsed = map_system.parent_wormhole.collapsed
+            except ObjectDoesNotExist:
+                collapsed = None
+            rows.append((map_system.pk, map_system.parentsystem_id,
+                         collapsed))
+        return cls(rows)
+
+    def __contains__(self, pk):
+        return pk in self.parents
+
+    def depth(self, pk):
+        """Returns the number of jumps from the root to the system."""
+        return self.depths[pk]
+
+    def ancestors(self, pk):
+        """Returns the ids of the system's parent, its parent and so on up
+        to the root.
+        """
+        result = []
+        parent = self.parents[pk]
+        while parent is not None and len(result) <= len(self.parents):
+            result.append(parent)
+            parent = self.parents[parent]
+        return result
+
+    def is_below(self, pk, ancestor):
+        """Returns whether pk is ancestor or in its subtree."""
+        return self.first[ancestor] <= self.first[pk] < self.last[ancestor]
+
+    def subtree(self, pk):
+        """Returns the ids of the system and every system below it."""
+        return set(self.order[self.first[pk]:self.last[pk]])
+
+    def open_path(self, pk):
+        """
+        Returns the ids of the system and its ancestors up to the root or
+        the first system whose parent wormhole has collapsed.
+        """
+        result = [pk]
+        while pk not in self.collapsed and self.parents[pk] is not None:
+            pk = self.parents[pk]
+            result.append(pk)
+            if len(result) > len(self.parents):
+                break
+        return result
+
+    def interest_path(self, pks):
+        """Returns the ids of the systems on the open paths of pks."""
+        result = set()
+        for pk in pks:
+            for system in self.open_path(pk):
+                if system in result:
+                    break
+                result.add(system)
+        return result
@@ -45,7 +45,7 @@ syspatterns = patterns(
     url(r'^signatures/(?P<sig_id>\d+)/', include(sigpatterns)),
     url(r'^collapse/$', 'collapse_system'),
     url(r'^resurrect/$', 'resurrect_system'),
-    url(r'^movesys/(?P<action>up|down)/$', 'move_system'),
+    url(r'^movesys/(?P<action>up|down|to)/$', 'move_system'),
 )
 
 wormholepatterns = patterns(
@@ -58,6 +58,9 @@ mappatterns = patterns(
     url(r'^$', 'get_map'),
     url(r'^update/$', 'map_checkin'),
     url(r'^refresh/$', 'map_refresh'),
+    url(r'^refresh/delta/$', 'map_refresh_delta'),
+    url(r'^events/$', 'map_events'),
+    url(r'^exits/$', 'map_exits'),
     url(r'^delete/$', 'delete_map'),
     url(r'^export/$', 'export_map'),
     url(r'^system/new/$', 'add_system'),
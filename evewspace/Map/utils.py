@@ -16,15 +16,43 @@ from collections import defaultdict
 from datetime import timedelta
 from math import pow, sqrt
 import datetime
+import hashlib
 import json
+import re
+import time
 
+from core.caching import ProcessCache, StaleWhileRevalidateCache
+from Map import locations
+from Map.tree import MapTree
 from core.utils import get_config
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils.text import compress_string
 import pytz
 
 
+# How long superseded map snapshots are kept around for computing deltas
+MAP_SNAPSHOT_TIMEOUT = 10 * 60
+# How long a rendered tooltip is kept. Tooltips show times relative to now,
+# so they are rendered again at least this often.
+TOOLTIP_TIMEOUT = 60
+# How long a rendered signature list is kept, for the same reason
+SIG_LIST_TIMEOUT = 60
+# How long a computed map layout is kept
+LAYOUT_TIMEOUT = 60 * 60
+# How long a map state is served before it is rebuilt
+MAP_STATE_TIMEOUT = 15
+
+# Map versions sent by clients, as made by _build_map_state
+MAP_VERSION_RE = re.compile(r'^\d+\.\d+$')
+
+# Map states, rebuilt by one process at a time while the others keep
+# serving the previous one
+map_state_cache = StaleWhileRevalidateCache(MAP_STATE_TIMEOUT,
+                                            MAP_SNAPSHOT_TIMEOUT)
+
+
 class MapJSONGenerator(object):
     """Provides methods create a JSON representation of a Map.
 
@@ -37,40 +65,103 @@ class MapJSONGenerator(object):
         self.pvp_threshold = int(get_config("MAP_PVP_THRESHOLD", user).value)
         self.npc_threshold = int(get_config("MAP_NPC_THRESHOLD", user).value)
         self.interest_time = int(get_config("MAP_INTEREST_TIME", user).value)
+        self._prefetched = False
 
     def _get_interest_path(self):
-        """Get all MapSystems contained in a path to a system of interest."""
+        """
+        Get the ids of all MapSystems contained in a path to a system of
+        interest.
+        """
         try:
             return self._interest_path
         except AttributeError:
             threshold = (datetime.datetime.now(pytz.utc) -
                          timedelta(minutes=self.interest_time))
-            systems = []
-            for system in self.map.systems.filter(
-                    interesttime__gt=threshold).iterator():
-                systems.extend(self.get_path_to_map_system(system))
-            self._interest_path = systems
-            return systems
+            self._interest_path = self._get_tree().interest_path(
+                self.map.systems.filter(interesttime__gt=threshold)
+                .values_list('pk', flat=True))
+            return self._interest_path
+
+    def _get_tree(self):
+        try:
+            return self._tree
+        except AttributeError:
+            self._tree = MapTree.for_map(self.map.pk)
+            return self._tree
 
     @staticmethod
     def get_cache_key(map_inst):
         return '%s_map' % map_inst.pk
 
+    @staticmethod
+    def expire_map_state(map_inst):
+        """Makes the next request for the map's state rebuild it."""
+        map_state_cache.expire(MapJSONGenerator.get_cache_key(map_inst))
+
+    @staticmethod
+    def get_version_key(map_inst):
+        return '%s_map_version' % map_inst.pk
+
+    @staticmethod
+    def get_snapshot_key(map_inst, version):
+        return '%s_map_%s' % (map_inst.pk, version)
+
+    @staticmethod
+    def get_payload_key(map_inst, version):
+        return '%s_map_payload_%s' % (map_inst.pk, version)
+
+    @staticmethod
+    def get_delta_key(map_inst, since_version, version):
+        return '%s_map_delta_%s_%s' % (map_inst.pk, since_version, version)
+
     @staticmethod
     def get_path_to_map_system(system):
         """
         Returns a list of MapSystems on the route between the map root and
         the provided MapSystem.
         """
-        systemlist = []
-        parent = system
-        while parent:
-            systemlist.append(parent)
-            if parent.parentsystem and not parent.parent_wormhole.collapsed:
-                parent = parent.parentsystem
-            else:
-                parent = None
-        return systemlist
+        from Map.models import MapSystem
+        path = MapTree.for_map(system.map_id).open_path(system.pk)
+        systems = MapSystem.objects.in_bulk(path)
+        return [systems[x] for x in path]
+
+    def _prefetch_system_data(self, map_systems):
+        """Load icon and pilot data for a batch of MapSystems.
+
+        Fleet presence, signature freshness and pilot locations are
+        fetched for all systems at once with aggregate queries and one
+        location store read, then looked up per system from memory.
+        """
+        from Map.models import System, Signature
+        sys_ids = set(x.system_id for x in map_systems)
+        sig_threshold = (datetime.datetime.now(pytz.utc) -
+                         datetime.timedelta(days=1))
+
+        self._fleet_systems = set(
+            System.objects.filter(pk__in=sys_ids, stfleets__isnull=False,
+                                  stfleets__ended__isnull=True)
+            .values_list('pk', flat=True).distinct())
+        self._fresh_sig_systems = set(
+            Signature.objects.filter(system_id__in=sys_ids,
+                                     modified_time__gte=sig_threshold,
+                                     sigtype__isnull=False)
+            .values_list('system_id', flat=True).distinct())
+        self._unscanned_sig_systems = set(
+            Signature.objects.filter(system_id__in=sys_ids,
+                                     sigtype__isnull=True)
+            .values_list('system_id', flat=True).distinct())
+
+        self._pilot_lists = locations.get_store().systems(sys_ids)
+        self._prefetched = True
+
+    def _ensure_prefetched(self):
+        if not self._prefetched:
+            self._prefetch_system_data(list(self.map.systems.all()))
+
+    def get_pilot_list(self, system):
+        """Returns the cached pilot dict for a MapSystem."""
+        self._ensure_prefetched()
+        return self._pilot_lists.get(system.system_id, {})
 
     def get_system_icon(self, system):
         """Get URL to system background icon.
@@ -78,13 +169,14 @@ class MapJSONGenerator(object):
         Takes a MapSystem and returns the appropriate icon to
         display on the map as a relative URL.
         """
+        self._ensure_prefetched()
         pvp_threshold = self.pvp_threshold
         npc_threshold = self.npc_threshold
         static_prefix = "%s" % (settings.STATIC_URL + "images/")
         if system.system.sysclass == 99:
             return static_prefix + "scan.png"
-        
-        if system.system.stfleets.filter(ended__isnull=True).exists():
+
+        if system.system_id in self._fleet_systems:
             return static_prefix + "farm.png"
 
         if system.system.shipkills + system.system.podkills > pvp_threshold:
@@ -94,11 +186,11 @@ class MapJSONGenerator(object):
             return static_prefix + "carebears.png"
 
         # unscanned for >24h
-        if not system.system.signatures.filter(modified_time__gte=(datetime.datetime.now(pytz.utc)-datetime.timedelta(days=1))).filter(sigtype__isnull=False).exists():
+        if system.system_id not in self._fresh_sig_systems:
             return static_prefix + "scan.png"
 
         # partially scanned
-        if system.system.signatures.filter(sigtype__isnull=True).exists():
+        if system.system_id in self._unscanned_sig_systems:
             return static_prefix + "isis_scan.png"
 
         return None
@@ -111,6 +203,7 @@ class MapJSONGenerator(object):
         """
         system_obj = system.system
         is_wspace = system_obj.is_wspace()
+        pilot_list = self.get_pilot_list(system)
         system_dict = {
             'sysID': system_obj.pk,
             'Name': system_obj.name,
@@ -122,10 +215,10 @@ class MapJSONGenerator(object):
                 system.interesttime and
                 system.interesttime > datetime.datetime.now(pytz.utc) -
                 timedelta(minutes=self.interest_time),
-            'interestpath': system in self._get_interest_path(),
-            'activePilots': len(system_obj.pilot_list),
-            'pilot_list': [x[1][1] for x in system_obj.pilot_list.items()
-                           if x[1][1] != "OOG Browser"],
+            'interestpath': system.pk in self._get_interest_path(),
+            'activePilots': len(pilot_list),
+            'pilot_list': [x.charname for x in pilot_list.values()
+                           if x.charname != "OOG Browser"],
             'iconImageURL': self.get_system_icon(system),
             'msID': system.pk,
             'backgroundImageURL': self.get_system_background(system),
@@ -135,10 +228,10 @@ class MapJSONGenerator(object):
                 system_obj.wsystem.is_shattered if is_wspace else False,
         }
 
-        if system.parentsystem:
+        if system.parentsystem_id:
             parent_wh = system.parent_wormhole
             system_dict.update({
-                'ParentID': system.parentsystem.pk,
+                'ParentID': system.parentsystem_id,
                 'WhToParent': parent_wh.bottom_type.name,
                 'WhFromParent': parent_wh.top_type.name,
                 'WhMassStatus': parent_wh.mass_status,
@@ -185,18 +278,145 @@ class MapJSONGenerator(object):
 
         return "{0}images/{1}".format(settings.STATIC_URL, image)
 
+    def get_map_state(self):
+        """Returns the current state of the map.
+
+        The state is a dict holding the map revision, a version string and
+        the list of system dicts. The version only changes when the system
+        list does, so clients can cheaply check whether they are current.
+
+        While the state is being rebuilt after it expired or the map
+        changed, other requests get the previous state.
+        """
+        return map_state_cache.get(
+            self.get_cache_key(self.map), self._build_map_state,
+            lambda state: state['revision'] >= self.map.revision)
+
+    def _build_map_state(self):
+        systems = self.create_syslist()
+        version_key = self.get_version_key(self.map)
+        version = cache.get(version_key)
+        if (not version or cache.get(self.get_snapshot_key(
+                self.map, version)) != systems):
+            version = '%s.%s' % (self.map.revision, int(time.time() * 1000))
+            cache.set(self.get_snapshot_key(self.map, version), systems,
+                      MAP_SNAPSHOT_TIMEOUT)
+            cache.set(version_key, version, MAP_SNAPSHOT_TIMEOUT)
+        return {'revision': self.map.revision, 'version': version,
+                'systems': systems}
+
+    def get_payload(self):
+        """Returns the map's systems serialised for map_refresh.
+
+        The payload is a dict holding the version, the JSON and a gzipped
+        copy of it, made once per version of the map and shared by every
+        user. It holds nothing user specific.
+        """
+        state = self.get_map_state()
+        cache_key = self.get_payload_key(self.map, state['version'])
+        payload = cache.get(cache_key)
+        if payload is None:
+            payload = self._make_payload(state['version'], {
+                'version': state['version'], 'systems': state['systems']})
+            cache.set(cache_key, payload, MAP_SNAPSHOT_TIMEOUT)
+        return payload
+
+    def get_delta_payload(self, since_version=None):
+        """Returns get_systems_delta serialised like get_payload, or None
+        if since_version is still current. The payload is made once per
+        pair of versions and shared by every user.
+        """
+        since_version = self._clean_version(since_version)
+        state = self._get_state_since(since_version)
+        if state is None:
+            return None
+        cache_key = self.get_delta_key(self.map, since_version or 'full',
+                                       state['version'])
+        payload = cache.get(cache_key)
+        if payload is None:
+            payload = self._make_payload(
+                state['version'], self._diff_state(state, since_version))
+            cache.set(cache_key, payload, MAP_SNAPSHOT_TIMEOUT)
+        return payload
+
+    @staticmethod
+    def _make_payload(version, data):
+        content = json.dumps(data, sort_keys=True)
+        return {'version': version, 'content': content,
+                'gzip': compress_string(content)}
+
+    def get_systems_delta(self, since_version=None):
+        """Returns the changes to the map since since_version.
+
+        Returns None if since_version is still current. Otherwise returns
+        a dict with the new version, the added or changed system dicts,
+        the msIDs of removed systems and the drawing order. If the
+        snapshot for since_version is no longer available all systems are
+        returned and 'full' is set.
+        """
+        since_version = self._clean_version(since_version)
+        state = self._get_state_since(since_version)
+        if state is None:
+            return None
+        return self._diff_state(state, since_version)
+
+    @staticmethod
+    def _clean_version(version):
+        """Returns version, or None if it isn't one of ours."""
+        if version and MAP_VERSION_RE.match(version):
+            return version
+        return None
+
+    def _get_state_since(self, since_version):
+        """Returns the map state, or None if since_version is current."""
+        if since_version and self.is_current(since_version):
+            return None
+        state = self.get_map_state()
+        if since_version and since_version == state['version']:
+            return None
+        return state
+
+    def _diff_state(self, state, since_version):
+        systems = state['systems']
+        old_systems = None
+        if since_version:
+            old_systems = cache.get(self.get_snapshot_key(self.map,
+                                                          since_version))
+        if old_systems is None:
+            changed = systems
+            removed = []
+        else:
+            old_by_id = dict((x['msID'], x) for x in old_systems)
+            changed = [x for x in systems if old_by_id.get(x['msID']) != x]
+            current_ids = set(x['msID'] for x in systems)
+            removed = [x for x in old_by_id if x not in current_ids]
+        return {
+            'version': state['version'],
+            'full': old_systems is None,
+            'systems': changed,
+            'removed': removed,
+            'order': [x['msID'] for x in systems],
+        }
+
+    def is_current(self, version):
+        """Returns whether version is the latest state of the map without
+        loading the state. Changes to the map expire the state, so while it
+        is fresh only the version needs checking.
+        """
+        return (map_state_cache.is_fresh(self.get_cache_key(self.map)) and
+                cache.get(self.get_version_key(self.map)) == version)
+
+    def get_user_locations(self):
+        """Returns the system IDs the user's characters are located in."""
+        return [x.system_id for x in
+                locations.get_store().user(self.user.pk).values()]
+
     def get_systems_json(self):
         """Returns a JSON string representing the systems in a map."""
-        cache_key = self.get_cache_key(self.map)
-        systems = cache.get(cache_key)
-        if systems is None:
-            systems = self.create_syslist()
-            cache.set(cache_key, systems, 15)
-
-        user_locations_dict = cache.get('user_%s_locations' % self.user.pk)
-        if user_locations_dict:
+        systems = self.get_map_state()['systems']
+        user_locations = self.get_user_locations()
+        if user_locations:
             user_img = "%s/images/mylocation.png" % (settings.STATIC_URL,)
-            user_locations = [i[1][0] for i in user_locations_dict.items()]
             for system in systems:
                 if (system['sysID'] in user_locations and
                         system['iconImageURL'] is None):
@@ -216,13 +436,24 @@ class MapJSONGenerator(object):
         priorities = dict()
 
         for system in (self.map.systems.all()
-                       .select_related('system', 'parentsystem',
-                                       'parent_wormhole')
+                       .select_related('system', 'system__wsystem',
+                                       'parent_wormhole',
+                                       'parent_wormhole__top_type',
+                                       'parent_wormhole__bottom_type')
                        .iterator()):
             children[system.parentsystem_id].append(system.pk)
             systems[system.pk] = system
             priorities[system.pk] = system.display_order_priority
 
+        # load fleets, signature state and pilots for all systems at once
+        self._prefetch_system_data(systems.values())
+        self._tree = MapTree.from_map_systems(systems.values())
+        threshold = (datetime.datetime.now(pytz.utc) -
+                     timedelta(minutes=self.interest_time))
+        self._interest_path = self._tree.interest_path(
+            x.pk for x in systems.values()
+            if x.interesttime and x.interesttime > threshold)
+
         # sort children by priority
         for l in children.values():
             l.sort(key=priorities.__getitem__)
@@ -241,50 +472,128 @@ class MapJSONGenerator(object):
         return syslist
 
 
+class _WormholeTypeTable(ProcessCache):
+    """
+    Resolves the wormhole types between two system classes from an
+    in-memory copy of WormholeType, remembering each resolved pair.
+    """
+    version_key = 'wormhole_types_version'
+
+    def reset(self):
+        self.types = None
+        self.resolved = {}
+
+    def _load(self):
+        from Map.models import WormholeType
+        self.types = defaultdict(list)
+        for whtype in WormholeType.objects.order_by('pk'):
+            self.types[(whtype.source, whtype.destination)].append(whtype)
+
+    def _find(self, sources, destination):
+        found = []
+        for source in sources:
+            found.extend(self.types.get((source, destination), []))
+        return sorted(found, key=lambda x: x.pk)
+
+    def _resolve(self, sysclass1, destination):
+        # System.is_wspace is a method and so always true when tested
+        # without calling it; every class other than highsec and low/null
+        # is looked up by its own number.
+        source = str(sysclass1)
+        if sysclass1 == 7:
+            source = "H"
+        if sysclass1 in [8, 9, 10, 11]:
+            source = "NH"
+
+        if source in ("H", "NH"):
+            return (self._find([source], destination) or
+                    self._find(["K"], destination))
+        if source in ("5", "6") and self._find(["Z"], destination):
+            return self._find(["Z", "W"], destination)
+        return self._find([source, "W"], destination)
+
+    def get(self, sysclass1, sysclass2):
+        self.validate()
+        key = (sysclass1, sysclass2)
+        if key not in self.resolved:
+            if self.types is None:
+                self._load()
+            self.resolved[key] = self._resolve(sysclass1, sysclass2)
+        return list(self.resolved[key])
+
+_wormhole_types = _WormholeTypeTable()
+
+
+def invalidate_wormhole_types():
+    """Drops the resolved wormhole types in every process."""
+    _wormhole_types.bump()
+    _wormhole_types.reset()
+
+
+class _SystemClassTable(ProcessCache):
+    """
+    Holds the class of every system in memory. Systems are not added or
+    removed through Django, so the table is loaded once per process and
+    only systems missing from it are looked up. It is reloaded everywhere
+    when a system's class changes.
+    """
+    version_key = 'system_classes_version'
+
+    def reset(self):
+        self.classes = None
+
+    def get(self, system_id):
+        from Map.models import System
+        self.validate()
+        if self.classes is None:
+            self.classes = dict(System.objects.values_list('pk', 'sysclass'))
+        if system_id not in self.classes:
+            sysclass = (System.objects.filter(pk=system_id)
+                        .values_list('sysclass', flat=True).first())
+            if sysclass is None:
+                return None
+            self.classes[system_id] = sysclass
+        return self.classes[system_id]
+
+_system_classes = _SystemClassTable()
+
+
+def get_system_class(system_id):
+    """Returns the class of the system with pk system_id, or None if there
+    is no such system.
+    """
+    return _system_classes.get(system_id)
+
+
+def invalidate_system_classes():
+    """Reloads the system classes in every process."""
+    _system_classes.bump()
+    _system_classes.reset()
+
+
+def render_tooltips(template, name, objects, revisions):
+    """Returns the tooltips of objects rendered with template, joined.
+
+    template renders the objects in the list it is given as name. Each
+    object's tooltip is cached under the object's pk and its revision, a
+    tuple of everything its tooltip shows, so only the tooltips of objects
+    that changed are rendered. Cached tooltips are read with one get_many.
+    """
+    keys = ['tooltip_%s_%s_%s' % (template, obj.pk,
+                                  hashlib.md5(repr(revision)).hexdigest())
+            for obj, revision in zip(objects, revisions)]
+    tips = cache.get_many(keys)
+    new_tips = dict((key, render_to_string(template, {name: [obj]}))
+                    for obj, key in zip(objects, keys) if key not in tips)
+    if new_tips:
+        cache.set_many(new_tips, TOOLTIP_TIMEOUT)
+        tips.update(new_tips)
+    return ''.join(tips[key] for key in keys)
+
+
 def get_wormhole_type(system1, system2):
     """Gets the one-way wormhole types between system1 and system2."""
-    from Map.models import WormholeType
-    source = "K"
-    # Set the source and destination for system1 > system2
-    if system1.is_wspace:
-        source = str(system1.sysclass)
-    if system1.sysclass == 7:
-        source = "H"
-    if system1.sysclass in [8, 9, 10, 11]:
-        source = "NH"
-
-    destination = system2.sysclass
-
-    sourcewh = None
-
-    if source == "H":
-        if WormholeType.objects.filter(
-                source="H", destination=destination).count() == 0:
-            sourcewh = WormholeType.objects.filter(
-                source="K", destination=destination).all()
-        else:
-            sourcewh = WormholeType.objects.filter(
-                source="H", destination=destination).all()
-    if source == "NH":
-        if WormholeType.objects.filter(
-                source="NH", destination=destination).count() == 0:
-            sourcewh = WormholeType.objects.filter(
-                source="K", destination=destination).all()
-        else:
-            sourcewh = WormholeType.objects.filter(
-                source="NH", destination=destination).all()
-    if source == "5" or source == "6":
-        if WormholeType.objects.filter(
-                source="Z", destination=destination).count() != 0:
-            sourcewh = (WormholeType.objects
-                        .filter(Q(source="Z") | Q(source='W'))
-                        .filter(destination=destination).all())
-
-    if sourcewh is None:
-        sourcewh = (WormholeType.objects
-                    .filter(Q(source=source) | Q(source='W'))
-                    .filter(destination=destination).all())
-    return sourcewh
+    return _wormhole_types.get(system1.sysclass, system2.sysclass)
 
 
 def get_possible_wh_types(system1, system2):
@@ -320,6 +629,112 @@ def convert_signature_id(sigid):
         return sigid.upper()
 
 
+class _RouteData(ProcessCache):
+    """
+    Holds the route graph, jump table and coordinates of the current
+    process so every RouteFinder shares them.
+    """
+    version_key = 'route_graph_version'
+
+    def reset(self):
+        self.table = None
+        self.table_loaded = False
+        self.graph = None
+        self.coordinates = None
+
+_route_data = _RouteData()
+
+
+def bump_route_version():
+    """
+    Marks the route graph and jump table as changed so every process
+    reloads them.
+    """
+    _route_data.bump()
+
+
+def get_kspace_gates():
+    """Returns a list of (from_id, to_id) stargate pairs from k-space."""
+    from Map.models import KSystem
+    from core.models import SystemJump
+    kspace = set(KSystem.objects.values_list('pk', flat=True))
+    return [(from_id, to_id) for from_id, to_id
+            in SystemJump.objects.values_list('fromsystem', 'tosystem')
+            if from_id in kspace]
+
+
+def get_jump_table():
+    """
+    Returns the precomputed JumpTable of this process, or None if
+    buildjumptable has not been run.
+    """
+    _route_data.validate()
+    if not _route_data.table_loaded:
+        from Map.jumptable import JumpTable
+        _route_data.table = JumpTable.load(settings.MAP_JUMP_TABLE_PATH)
+        _route_data.table_loaded = True
+    return _route_data.table
+
+
+def get_coordinate_table():
+    """
+    Returns the CoordinateTable of every solar system for this process,
+    loading it from SystemData the first time it is needed.
+    """
+    _route_data.validate()
+    if _route_data.coordinates is None:
+        from core.models import SystemData
+        from Map.spatial import CoordinateTable
+        _route_data.coordinates = CoordinateTable.from_rows(
+            SystemData.objects.values_list('pk', 'x', 'y', 'z'))
+    return _route_data.coordinates
+
+
+def get_route_graph():
+    """
+    Returns the networkx route graph of this process, unpickling it from
+    the cache or building it the first time it is needed.
+    """
+    import cPickle
+    _route_data.validate()
+    if _route_data.graph is None:
+        pickled = cache.get('route_graph')
+        if pickled:
+            _route_data.graph = cPickle.loads(pickled)
+        else:
+            import networkx as nx
+            graph = nx.Graph(get_kspace_gates())
+            cache.set('route_graph',
+                      cPickle.dumps(graph, cPickle.HIGHEST_PROTOCOL), None)
+            _route_data.graph = graph
+    return _route_data.graph
+
+
+def closest_by_bfs(graph, source_ids, target_ids):
+    """
+    Finds the nearest of source_ids to each of target_ids with a single
+    breadth-first search started from every source at once. Returns the
+    same dict as JumpTable.closest.
+    """
+    from collections import deque
+    remaining = set(target_ids)
+    found = {}
+    queue = deque()
+    for source in source_ids:
+        if source in graph and source not in found:
+            found[source] = (source, 0)
+            queue.append(source)
+    while queue and remaining:
+        node = queue.popleft()
+        remaining.discard(node)
+        source, jumps = found[node]
+        for neighbour in graph[node]:
+            if neighbour not in found:
+                found[neighbour] = (source, jumps + 1)
+                queue.append(neighbour)
+    return dict((x, found.get(x, None)) for x in target_ids)
+
+
 class RouteFinder(object):
     """Provides methods for finding distances between systems.
 
@@ -328,12 +743,10 @@ class RouteFinder(object):
     as a list of KSystem objects.
     """
     def __init__(self):
-        from django.core.cache import cache
-        if not cache.get('route_graph'):
-            self._cache_graph()
-        else:
-            import cPickle
-            self.graph = cPickle.loads(cache.get('route_graph'))
+        self.graph = None
+        self.table = get_jump_table()
+        if self.table is None:
+            self.graph = get_route_graph()
 
     @staticmethod
     def _get_ly_distance(sys1, sys2):
@@ -355,6 +768,35 @@ class RouteFinder(object):
     def ly_distance(self, sys1, sys2):
         return self._get_ly_distance(sys1, sys2)
 
+    def closest_exits(self, exits, destinations):
+        """
+        Takes lists of k-space systems. Returns a dict mapping each
+        destination's pk to an (exit pk, jumps) tuple for the exit with the
+        fewest jumps to it, or None if no exit has a route.
+        """
+        exit_ids = [x.pk for x in exits]
+        destination_ids = [x.pk for x in destinations]
+        if self.table is not None:
+            return self.table.closest(exit_ids, destination_ids)
+        if not self.graph:
+            self._cache_graph()
+        return closest_by_bfs(self.graph, exit_ids, destination_ids)
+
+    def ly_distances(self, sys1, systems):
+        """
+        Returns a list of the light-year distances from sys1 to each of
+        systems, computed in one call on the coordinate table.
+        """
+        table = get_coordinate_table()
+        return table.ly_distances(sys1.pk, [x.pk for x in systems]).tolist()
+
+    def systems_in_range(self, sys1, ly_range):
+        """
+        Returns a list of (system_id, distance) tuples for the systems
+        within ly_range light years of sys1, nearest first.
+        """
+        return get_coordinate_table().within(sys1.pk, ly_range)
+
     def route_as_ids(self, sys1, sys2):
         return self._find_route(sys1, sys2)
 
@@ -364,38 +806,23 @@ class RouteFinder(object):
                 for sysid in self._find_route(sys1, sys2)]
 
     def route_length(self, sys1, sys2):
+        if self.table is not None:
+            return self.table.jumps(sys1.pk, sys2.pk) + 1
         return len(self._find_route(sys1, sys2))
 
     def _cache_graph(self):
-        from Map.models import KSystem
-        from core.models import SystemJump
-        from django.core.cache import cache
-        import cPickle
-        import networkx as nx
-        if not cache.get('route_graph'):
-            graph = nx.Graph()
-            for from_system in KSystem.objects.all():
-                for to_system in (SystemJump.objects
-                                  .filter(fromsystem=from_system.pk)):
-                    graph.add_edge(from_system.pk, to_system.tosystem)
-            cache.set('route_graph',
-                      cPickle.dumps(graph, cPickle.HIGHEST_PROTOCOL), 0)
-            self.graph = graph
+        self.graph = get_route_graph()
 
     def _find_route(self, sys1, sys2):
         """
         Takes two system objects (can be KSystem or SystemData).
         Returns a list of system IDs that comprise the route.
         """
+        if self.table is not None:
+            return self.table.route(sys1.pk, sys2.pk)
         import networkx as nx
-        import cPickle
         if not self.graph:
-            from django.core.cache import cache
-            if not cache.get('route_graph'):
-                self._cache_graph()
-                self.graph = cPickle.loads(cache.get('route_graph'))
-            else:
-                self.graph = cPickle.loads(cache.get('route_graph'))
+            self._cache_graph()
         return nx.shortest_path(self.graph, source=sys1.pk, target=sys2.pk)
 
 
@@ -415,22 +842,46 @@ class LayoutGenerator(object):
         # system ids in drawing order
         self.processed = []
 
+    def get_cache_key(self):
+        """
+        Returns the cache key of the layout, a fingerprint of the parent
+        links and child order. The links are between map system ids, so
+        each map has its own layouts, and a layout is reused until a
+        system is added, removed or moved, which changes the key.
+        """
+        structure = sorted((k, v) for k, v in self.children.items() if v)
+        return 'map_layout_%s' % hashlib.md5(repr(structure)).hexdigest()
+
     def get_layout(self):
         """Create map layout.
 
         returns a dictionary containing x, y positions for
-        the given system ids.
+        the given system ids. Layouts are cached by get_cache_key.
         """
         if self.positions is not None:
             return self.positions
 
+        cache_key = self.get_cache_key()
+        cached = cache.get(cache_key)
+        if cached is not None:
+            self.positions, self.processed = cached
+            return self.positions
+        self.compute_layout()
+        cache.set(cache_key, (self.positions, self.processed),
+                  LAYOUT_TIMEOUT)
+        return self.positions
+
+    def compute_layout(self):
+        """Create map layout without the cache."""
         self.positions = {}
+        self.occupied = [-1]
+        self.processed = []
         root_node = self.children[None][0]
         self._place_node(root_node, 0, 0)
         return self.positions
 
     def _place_node(self, node_id, x, min_y):
-        """Determine x, y position for a node.
+        """Determine x, y position for a node and the nodes below it.
 
         node_id: id of the node to be positioned
         x: x position (depth) of the node
@@ -438,32 +889,52 @@ class LayoutGenerator(object):
                (can't be above parent nodes)
 
         returns: y offset relative to min_y
+
+        Each node is placed after its first child, which can move it down,
+        and before its other children. The nodes being placed are kept on
+        a stack of [node_id, x, min_y, y, next child index] lists rather
+        than by recursion, so chains of any length can be placed.
         """
+        stack = [self._start_node(node_id, x, min_y)]
+        while True:
+            frame = stack[-1]
+            node_id, x, min_y, y, index = frame
+            children = self.children[node_id]
+            if index == 0:
+                frame[4] = 1
+                if children:
+                    # position first child (and thus its children)
+                    stack.append(self._start_node(children[0], x + 1, y))
+                    continue
+                self._fix_node(frame)
+            elif index < len(children):
+                # place the rest of the children
+                frame[4] = index + 1
+                stack.append(self._start_node(children[index], x + 1, y))
+                continue
+            stack.pop()
+            offset = y - min_y
+            if not stack:
+                return offset
+            parent = stack[-1]
+            if parent[4] == 1:
+                # the first child is placed, move the parent down if the
+                # child moved down
+                parent[3] += offset
+                self._fix_node(parent)
+
+    def _start_node(self, node_id, x, min_y):
+        """Returns the stack entry for a node about to be placed."""
         self.processed.append(node_id)
 
         # initially set y to the next free y in this column
         # or min_y, whichever is greater
-        try:
-            y_occupied = self.occupied[x]
-        except IndexError:
+        if len(self.occupied) <= x:
             self.occupied.append(-1)
-            y_occupied = -1
-        y = max(min_y, y_occupied + 1)
+        return [node_id, x, min_y, max(min_y, self.occupied[x] + 1), 0]
 
-        # position first child (and thus its children)
-        # and move this node down if child moved down
-        try:
-            first_child = self.children[node_id][0]
-            y += self._place_node(first_child, x + 1, y)
-        except IndexError:
-            pass  # node has no children, ignore that.
-
-        # system position is now final, save it
+    def _fix_node(self, frame):
+        """The node's position is now final, save it."""
+        node_id, x, min_y, y, index = frame
         self.occupied[x] = y
         self.positions[node_id] = (x, y)
-
-        # place the rest of the children
-        for child in self.children[node_id][1:]:
-            self._place_node(child, x + 1, y)
-
-        return y - min_y
@@ -14,9 +14,11 @@
 #   limitations under the License.
 import json
 import csv
+import time
 
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.http import Http404, HttpResponseRedirect, HttpResponse, JsonResponse
+from django.http import StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
@@ -24,11 +26,15 @@ from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.models import Permission
 from django.shortcuts import render, get_object_or_404
-from django.db.models import Q
-from django.views.decorators.cache import cache_page
+from django.db.models import Count, Q
+from django.utils.functional import SimpleLazyObject
+from django.middleware.csrf import get_token
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.csrf import csrf_exempt
 from Map.models import *
-from Map import utils, signals
+from Map import locations, pubsub, utils, signals
 from core.utils import get_config
 from core.models import ConfigEntry
 
@@ -36,15 +42,22 @@ from core.models import ConfigEntry
 # Decorator to check map permissions. Takes request and map_id
 # Permissions are 0 = None, 1 = View, 2 = Change
 # When used without a permission=x specification, requires Change access
+# The map and the user's permission on it are passed to the view as
+# request.current_map and request.map_permission. The map is only fetched
+# when the permission is not cached or the view uses it.
 
 
 def require_map_permission(permission=2):
     def _dec(view_func):
         def _view(request, map_id, *args, **kwargs):
-            current_map = get_object_or_404(Map, pk=map_id)
-            if current_map.get_permission(request.user) < permission:
+            current_map = SimpleLazyObject(
+                lambda: get_object_or_404(Map, pk=map_id))
+            access = get_map_permission(map_id, request.user, current_map)
+            if access < permission:
                 raise PermissionDenied
             else:
+                request.current_map = current_map
+                request.map_permission = access
                 return view_func(request, map_id, *args, **kwargs)
         _view.__name__ = view_func.__name__
         _view.__doc__ = view_func.__doc__
@@ -62,10 +75,12 @@ def get_map(request, map_id):
     If we do, then return a TemplateResponse for the map. If map does not
     exist, return 404. If we don't have permission, return PermissionDenied.
     """
-    current_map = get_object_or_404(Map, pk=map_id)
+    current_map = request.current_map
     context = {
         'map': current_map,
-        'access': current_map.get_permission(request.user),
+        'access': request.map_permission,
+        'log_cursor': MapLog.get_cursor(map_id),
+        'event_stream': settings.MAP_EVENT_STREAM,
     }
     template = 'map.html'
     return TemplateResponse(request, template, context)
@@ -73,30 +88,36 @@ def get_map(request, map_id):
 @login_required
 @require_map_permission(permission=1)
 def map_checkin(request, map_id):
+    """
+    Returns the map's visible log entries newer than the cursor POST
+    parameter, the id of the newest entry the client has, along with the
+    new cursor. Checkins with nothing new are answered from the cache.
+    """
     # Initialize json return dict
     json_values = {}
-    current_map = get_object_or_404(Map, pk=map_id)
-
-    # AJAX requests should post a JSON datetime called loadtime
-    # back that we use to get recent logs.
-    if 'loadtime' not in request.POST:
-        return HttpResponse(json.dumps({'error': "No loadtime"}),
+    try:
+        cursor = int(request.POST['cursor'])
+    except (KeyError, ValueError):
+        return HttpResponse(json.dumps({'error': "No cursor"}),
                             content_type="application/json")
-    time_string = request.POST['loadtime']
-
-    load_time = datetime.strptime(time_string, "%Y-%m-%d %H:%M:%S.%f")
-    load_time = load_time.replace(tzinfo=pytz.utc)
 
     if request.is_igb_trusted:
-        dialog_html = _checkin_igb_trusted(request, current_map)
+        dialog_html = _checkin_igb_trusted(request, map_id,
+                                           request.current_map)
         if dialog_html is not None:
             json_values.update({'dialogHTML': dialog_html})
-    log_list = MapLog.objects.filter(timestamp__gt=load_time,
-                                     visible=True,
-                                     map=current_map)
 
-    log_string = render_to_string('log_div.html', {'logs': log_list})
-    json_values.update({'logs': log_string})
+    if MapLog.get_cursor(map_id) > cursor:
+        # Clients with an old cursor only get as many entries as they show
+        logs = list(MapLog.objects.filter(map_id=map_id, visible=True,
+                                          pk__gt=cursor)
+                    .select_related('user').order_by('-pk')[:20])
+        logs.reverse()
+        json_values['logs'] = [{'id': log.pk, 'user': log.user.username,
+                                'action': log.action} for log in logs]
+        if logs:
+            cursor = logs[-1].pk
+    json_values['cursor'] = cursor
 
     return HttpResponse(json.dumps(json_values), content_type="application/json")
 
@@ -105,64 +126,169 @@ def map_checkin(request, map_id):
 @require_map_permission(permission=1)
 def map_refresh(request, map_id):
     """
-    Returns an HttpResponse with the updated systemJSON for an asynchronous
-    map refresh.
+    Returns the map version and all of its systems for an asynchronous map
+    refresh, gzipped when the client accepts it. The map version is the
+    ETag, and an empty 304 response is returned when the client has it.
+    The user's own locations are sent in the X-Map-User-Locations header
+    so the payload can be shared by every user.
+    """
+    if not request.is_ajax():
+        raise PermissionDenied
+    generator = utils.MapJSONGenerator(request.current_map, request.user)
+    return _map_payload_response(request, generator,
+                                 generator.get_payload())
+
+
+@login_required
+@require_map_permission(permission=1)
+def map_refresh_delta(request, map_id):
+    """
+    Returns the systems that changed since the map version given in the
+    version GET parameter, or an empty 304 response if there were no
+    changes. Like map_refresh the response is shared by every user,
+    gzipped when the client accepts it and has the map version as ETag.
     """
     if not request.is_ajax():
         raise PermissionDenied
-    current_map = get_object_or_404(Map, pk=map_id)
-    result = [
-        datetime.now(pytz.utc).strftime("%Y-%m-%d %H:%M:%S.%f"),
-        utils.MapJSONGenerator(current_map, request.user).get_systems_json(),
-    ]
-    return HttpResponse(json.dumps(result))
+    generator = utils.MapJSONGenerator(request.current_map, request.user)
+    return _map_payload_response(
+        request, generator,
+        generator.get_delta_payload(request.GET.get('version', None)))
 
 
-def _checkin_igb_trusted(request, current_map):
+def _map_payload_response(request, generator, payload):
+    """
+    Returns a response for a payload made by MapJSONGenerator, or an empty
+    304 response if payload is None or the client has its version.
+    """
+    if payload is None or payload['version'] in parse_etags(
+            request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponse(status=304)
+    elif re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        response = HttpResponse(payload['gzip'],
+                                content_type="application/json")
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(payload['content'],
+                                content_type="application/json")
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if payload is not None:
+        response['ETag'] = quote_etag(payload['version'])
+    response['X-Map-User-Locations'] = ','.join(
+        str(x) for x in generator.get_user_locations())
+    return response
+
+
+@login_required
+@require_map_permission(permission=1)
+def map_events(request, map_id):
+    """
+    Streams the map's events to the client as server-sent events.
+
+    The stream closes after MAP_EVENT_STREAM_TIMEOUT seconds and the
+    browser reconnects with the Last-Event-ID header so no events are
+    missed. Dialog events are only sent to the user they belong to.
+    Returns 404 unless MAP_EVENT_STREAM is set.
+    """
+    if not settings.MAP_EVENT_STREAM:
+        raise Http404
+    channel = pubsub.map_channel(map_id)
+    broker = pubsub.get_broker()
+    last_id = request.META.get('HTTP_LAST_EVENT_ID', None)
+    try:
+        last_id = int(last_id)
+    except (TypeError, ValueError):
+        last_id = broker.last_id(channel)
+    user_id = request.user.pk
+    timeout = settings.MAP_EVENT_STREAM_TIMEOUT
+
+    def stream(last_id):
+        yield 'retry: 3000\n\n'
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events = broker.listen(channel, last_id, min(remaining, 15))
+            if not events:
+                # Keep proxies from closing an idle connection
+                yield ': keepalive\n\n'
+                continue
+            for event_id, event, data in events:
+                last_id = event_id
+                if event == 'dialog' and data['user'] != user_id:
+                    continue
+                yield 'id: %s\nevent: %s\ndata: %s\n\n' % (
+                    event_id, event, json.dumps(data))
+
+    response = StreamingHttpResponse(stream(last_id),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _checkin_igb_trusted(request, map_id, current_map):
     """
     Runs the specific code for the case that the request came from an igb that
     trusts us, returns None if no further action is required, returns a string
     containing the html for a system add dialog if we detect that a new system
     needs to be added
+
+    Jumps are detected from the cached map members and system classes, so
+    only adding a system touches the database.
     """
-    can_edit = current_map.get_permission(request.user) == 2
-    current_location = (request.eve_systemid, request.eve_charname,
+    can_edit = request.map_permission == 2
+    try:
+        system_id = int(request.eve_systemid)
+    except (TypeError, ValueError):
+        raise Http404
+    current_class = utils.get_system_class(system_id)
+    if current_class is None:
+        raise Http404
+    current_location = (system_id, request.eve_charname,
                         request.eve_shipname, request.eve_shiptypename)
     char_cache_key = 'char_%s_location' % request.eve_charid
     old_location = cache.get(char_cache_key)
     result = None
-    current_system = get_object_or_404(System, pk=current_location[0])
     silent_map = request.POST.get('silent', 'false') == 'true'
     kspace_map = request.POST.get('kspace', 'false') == 'true'
 
     if old_location != current_location:
         if old_location:
-            old_system = get_object_or_404(System, pk=old_location[0])
-            old_system.remove_active_pilot(request.eve_charid)
+            old_id = int(old_location[0])
+            old_class = utils.get_system_class(old_id)
+            if old_class is None:
+                raise Http404
         request.user.update_location(
-            current_system.pk,
+            system_id,
             request.eve_charid, request.eve_charname,
             request.eve_shipname, request.eve_shiptypename)
         cache.set(char_cache_key, current_location, 60 * 5)
     # Conditions for the system to be automagically added to the map.
+        members = Map.get_members(map_id) if can_edit else {}
         if (can_edit and
             old_location and
-            old_system in current_map and
-            current_system not in current_map and
+            old_id in members and
+            system_id not in members and
             not _is_moving_from_kspace_to_kspace(
-                old_system, current_system, kspace_map)):
+                old_class, current_class, kspace_map)):
+            old_map_system = MapSystem.objects.select_related('system').get(
+                pk=members[old_id])
+            current_system = System.objects.get(pk=system_id)
             context = {
-                'oldsystem':
-                    current_map.systems.filter(system=old_system).all()[0],
+                'oldsystem': old_map_system,
                 'newsystem': current_system,
-                'wormholes': utils.get_possible_wh_types(old_system,
-                                                         current_system),
+                'wormholes': utils.get_possible_wh_types(
+                    old_map_system.system, current_system),
             }
 
             if request.POST.get('silent', 'false') != 'true':
                 result = render_to_string(
                     'igb_system_add_dialog.html', context,
                     context_instance=RequestContext(request))
+                pubsub.publish(pubsub.map_channel(current_map.pk), 'dialog',
+                               {'user': request.user.pk, 'html': result})
             else:
                 new_ms = current_map.add_system(
                     request.user, current_system, '', context['oldsystem'])
@@ -171,25 +297,24 @@ def _checkin_igb_trusted(request, current_map):
                 result = 'silent'
     else:
         cache.set(char_cache_key, current_location, 60 * 5)
-        # Use add_active_pilot to refresh the user's record in the global
-        # location cache
-        current_system.add_active_pilot(
-            request.user.username, request.eve_charid, request.eve_charname,
-            request.eve_shipname, request.eve_shiptypename
-        )
+        # Refresh the character's record in the location store
+        request.user.update_location(
+            system_id,
+            request.eve_charid, request.eve_charname,
+            request.eve_shipname, request.eve_shiptypename)
 
     return result
 
 
-def _is_moving_from_kspace_to_kspace(old_system, current_system, kspace_map):
+def _is_moving_from_kspace_to_kspace(old_class, current_class, kspace_map):
     """
     returns whether we are moving through kspace
-    :param old_system:
-    :param current_system:
+    :param old_class: class of the system moved from
+    :param current_class: class of the system moved to
     :return:
     """
     if not kspace_map:
-        return old_system.is_kspace() and current_system.is_kspace()
+        return old_class in range(7, 12) and current_class in range(7, 12)
     else:
         # K-space mapping enabled, pass the check
         return False
@@ -197,7 +322,8 @@ def _is_moving_from_kspace_to_kspace(old_system, current_system, kspace_map):
 
 def get_system_context(ms_id, user):
     map_system = get_object_or_404(MapSystem, pk=ms_id)
-    if map_system.map.get_permission(user) == 2:
+    if get_map_permission(map_system.map_id, user,
+                          SimpleLazyObject(lambda: map_system.map)) == 2:
         can_edit = True
     else:
         can_edit = False
@@ -222,9 +348,7 @@ def get_system_context(ms_id, user):
         interest = map_system.interesttime
         # Include any SiteTracker fleets that are active
     st_fleets = map_system.system.stfleets.filter(ended=None).all()
-    locations = cache.get('sys_%s_locations' % map_system.system.pk)
-    if not locations:
-        locations = {}
+    locations = map_system.system.pilot_list
     has_siblings = map_system.has_siblings()
     return {'system': system, 'mapsys': map_system,
             'scanwarning': scan_warning, 'isinterest': interest,
@@ -251,7 +375,7 @@ def add_system(request, map_id):
         raise PermissionDenied
     try:
         # Prepare data
-        current_map = Map.objects.get(pk=map_id)
+        current_map = request.current_map
         top_ms = MapSystem.objects.get(pk=request.POST.get('topMsID'))
         if request.POST.get('bottomSystem') == "Unknown":
             bottom_sys, created = System.objects.get_or_create(
@@ -324,7 +448,7 @@ def promote_system(request, map_id, ms_id):
     """
     Promotes the MapSystem to map root and truncates other chains.
     """
-    map_obj = get_object_or_404(Map, pk=map_id)
+    map_obj = request.current_map
     if map_obj.truncate_allowed:
         system = get_object_or_404(MapSystem, pk=ms_id)
         system.promote_system(request.user)
@@ -380,19 +504,44 @@ def system_tooltips(request, map_id):
     """
     if not request.is_ajax():
         raise PermissionDenied
-    cache_key = 'map_%s_sys_tooltip' % map_id
-    cached_tips = cache.get(cache_key)
-    if not cached_tips:
-        ms_list = (MapSystem.objects.filter(map_id=map_id)
-                   .select_related('parent_wormhole', 'system__region')
-                   .iterator())
-        new_tips = render_to_string('system_tooltip.html',
-                                    {'map_systems': ms_list},
-                                    RequestContext(request))
-        cache.set(cache_key, new_tips, 60)
-        return HttpResponse(new_tips)
-    else:
-        return HttpResponse(cached_tips)
+    ms_list = list(MapSystem.objects.filter(map_id=map_id)
+                   .select_related('parent_wormhole', 'system__region',
+                                   'system__ksystem')
+                   .order_by('pk'))
+    system_ids = set(x.system_id for x in ms_list)
+    # Counted separately, as counting both in one join multiplies the rows
+    sig_counts = dict(System.objects.filter(pk__in=system_ids)
+                      .annotate(count=Count('signatures'))
+                      .values_list('pk', 'count'))
+    pos_counts = dict(System.objects.filter(pk__in=system_ids)
+                      .annotate(count=Count('poses'))
+                      .values_list('pk', 'count'))
+    pilots = locations.get_store().systems(system_ids)
+    for map_system in ms_list:
+        map_system.sig_count = sig_counts.get(map_system.system_id, 0)
+        map_system.pos_count = pos_counts.get(map_system.system_id, 0)
+        map_system.pilots = pilots.get(map_system.system_id, {})
+    return HttpResponse(utils.render_tooltips(
+        'system_tooltip.html', 'map_systems', ms_list,
+        [_system_tooltip_revision(x) for x in ms_list]))
+
+
+def _system_tooltip_revision(map_system):
+    """Returns what the system tooltip of map_system shows that can change.
+    """
+    system = map_system.system
+    try:
+        collapsed = map_system.parent_wormhole.collapsed
+    except ObjectDoesNotExist:
+        collapsed = None
+    stats = (system.npckills, system.shipkills, system.podkills)
+    if system.is_kspace():
+        stats += (system.ksystem.jumps, system.ksystem.sov)
+    pilots = sorted((charid, x.username, x.charname, x.shiptype)
+                    for charid, x in map_system.pilots.items())
+    return (map_system.friendlyname, collapsed, system.updated,
+            system.lastscanned, stats, map_system.sig_count,
+            map_system.pos_count, pilots)
 
 
 # noinspection PyUnusedLocal
@@ -405,19 +554,15 @@ def wormhole_tooltips(request, map_id):
     """
     if not request.is_ajax():
         raise PermissionDenied
-    cache_key = 'map_%s_wh_tooltip' % map_id
-    cached_tips = cache.get(cache_key)
-    if not cached_tips:
-        cur_map = get_object_or_404(Map, pk=map_id)
-        ms_list = MapSystem.objects.filter(map=cur_map).all()
-        whs = Wormhole.objects.filter(top__in=ms_list).all()
-        new_tips = render_to_string('wormhole_tooltip.html',
-                                    {'wormholes': whs},
-                                    RequestContext(request))
-        cache.set(cache_key, new_tips, 60)
-        return HttpResponse(new_tips)
-    else:
-        return HttpResponse(cached_tips)
+    whs = list(Wormhole.objects.filter(top__map_id=map_id)
+               .select_related('top__system', 'bottom__system', 'top_type',
+                               'bottom_type')
+               .order_by('pk'))
+    return HttpResponse(utils.render_tooltips(
+        'wormhole_tooltip.html', 'wormholes', whs,
+        [(x.updated, x.time_status, x.mass_status, x.eol_time,
+          x.top_bubbled, x.bottom_bubbled, x.top_type_id, x.bottom_type_id)
+         for x in whs]))
 
 
 # noinspection PyUnusedLocal
@@ -505,15 +650,7 @@ def manual_location(request, map_id, ms_id):
     """
     if not request.is_ajax():
         raise PermissionDenied
-    user_locations = cache.get('user_%s_locations' % request.user.pk)
-    if user_locations:
-        old_location = user_locations.pop(request.user.pk, None)
-        if old_location:
-            old_sys = get_object_or_404(System, pk=old_location[0])
-            old_sys.remove_active_pilot(request.user.pk)
     map_sys = get_object_or_404(MapSystem, pk=ms_id)
-    map_sys.system.add_active_pilot(request.user.username, request.user.pk,
-                                    'OOG Browser', 'Unknown', 'Unknown')
     request.user.update_location(map_sys.system.pk, request.user.pk,
                                  'OOG Browser', 'Unknown', 'Unknown')
     map_sys.map.clear_caches()
@@ -560,58 +697,40 @@ def bulk_sig_import(request, map_id, ms_id):
         raise PermissionDenied
     
     map_system = get_object_or_404(MapSystem, pk=ms_id)
-    k = 0 # all imported sigs
-    numchanged = 0 # sigs changed during import 
-    numscanned = 0 # sigs changed and fully scanned down during import
     if request.method == 'POST':
-        reader = csv.reader(
+        rows = list(csv.reader(
             request.POST.get('paste', '').decode().splitlines(),
-            delimiter="\t")
-        COL_SIG = 0
+            delimiter="\t"))
         COL_STRENGTH = 4
-        for row in reader:
-            # To prevent pasting of POSes into the sig importer, make sure
-            # the strength column is present
-            try:
-                test_var = row[COL_STRENGTH]
-            except IndexError:
-                return HttpResponse('A valid signature paste was not found',
-                                    status=400)
-            # limit number of rows pasted
-            if k < 75:
-                # get sig id from pasted data
-                sig_id = utils.convert_signature_id(row[COL_SIG])
-                # Query signatures in system to see if it exists
-                sig, sigcreated = Signature.objects.get_or_create(
-                    sigid=sig_id, system=map_system.system)
-
-                # Update sig with copied TSV data
-                sig, update_type = sig.update_from_tsv(request.user, 
-                                                       sigcreated, 
-                                                       row, map_system)
-                
-                sig.modified_by = request.user
-                sig.save()
-                signals.signature_update.send_robust(
-                    sig, user=request.user, map=map_system.map,
-                    signal_strength=row[COL_STRENGTH]
-                )
-                # increment really changed sigs counter
-                if update_type == "Updated" or update_type == "Created":
-                    numchanged += 1
-                if update_type == "Scanned":
-                    numscanned += 1
-                # increment all imported sigs counter
-                k += 1
+        # To prevent pasting of POSes into the sig importer, make sure
+        # the strength column is present
+        if any(len(row) <= COL_STRENGTH for row in rows):
+            return HttpResponse('A valid signature paste was not found',
+                                status=400)
+        results = Signature.import_tsv(request.user, map_system, rows)
+        numchanged = 0 # sigs changed during import
+        numscanned = 0 # sigs changed and fully scanned down during import
+        for sig, update_type, row in results:
+            if update_type == "None":
+                continue
+            signals.signature_update.send_robust(
+                sig, user=request.user, map=map_system.map,
+                signal_strength=row[COL_STRENGTH]
+            )
+            # increment really changed sigs counter
+            if update_type == "Updated" or update_type == "Created":
+                numchanged += 1
+            if update_type == "Scanned":
+                numscanned += 1
 
         # Log the summary as a publicly visible log entry
         map_system.map.add_log(
             request.user,
             "Imported %s signatures for %s(%s). Adjusted:  %s. Scanned: %s." %
-            (k, map_system.system.name, map_system.friendlyname, numchanged, 
-             numscanned),
+            (len(results), map_system.system.name, map_system.friendlyname,
+             numchanged, numscanned),
             True)
-        
+
         map_system.system.lastscanned = datetime.now(pytz.utc)
         map_system.system.save()
         return HttpResponse()
@@ -642,8 +761,10 @@ def edit_signature(request, map_id, ms_id, sig_id=None):
     if not request.is_ajax():
         raise PermissionDenied
     map_system = get_object_or_404(MapSystem, pk=ms_id)
-    # If the user can't edit signatures, return a blank response
-    if map_system.map.get_permission(request.user) != 2:
+    # If the user can't edit signatures, return a blank response. The map
+    # system can belong to another map than the one in the URL.
+    if get_map_permission(map_system.map_id, request.user,
+                          SimpleLazyObject(lambda: map_system.map)) != 2:
         return HttpResponse()
     action = None
     isnewscan = False
@@ -712,25 +833,51 @@ def edit_signature(request, map_id, ms_id, sig_id=None):
                                  'system': map_system, 'sig': signature})
 
 
+# Stands in for the CSRF token in cached signature lists, which are shared
+# by every viewer
+SIG_LIST_CSRF_PLACEHOLDER = 'SIG-LIST-CSRF-TOKEN'
+
+
 # noinspection PyUnusedLocal
 @login_required()
 @require_map_permission(permission=1)
-@cache_page(1)
 def get_signature_list(request, map_id, ms_id, sys_id):
     """
     Determines the proper escalationThreshold time and renders
-    system_signatures.html
+    system_signatures.html, or returns the signatures as JSON when
+    format=json is given.
+
+    Both are cached per revision of the system's signature list, so each
+    change is rendered once for all viewers.
     """
     if not request.is_ajax():
         raise PermissionDenied
-    signatures = Signature.objects.select_related('sigtype','owned_by','modified_by').filter(system_id=sys_id).all()
+    revision = System.sig_revision(sys_id)
+    signatures = Signature.objects.select_related(
+        'sigtype', 'owned_by', 'modified_by', 'system').filter(
+        system_id=sys_id)
+    if request.GET.get('format') == 'json':
+        cache_key = 'sys_%s_sig_json_%s' % (sys_id, revision)
+        content = cache.get(cache_key)
+        if content is None:
+            content = json.dumps([x.as_list_dict() for x in signatures])
+            cache.set(cache_key, content, utils.SIG_LIST_TIMEOUT)
+        return HttpResponse(content, content_type="application/json")
     escalation_downtimes = int(get_config("MAP_ESCALATION_BURN",
                                           request.user).value)
-    return TemplateResponse(request, "system_signatures.html",
-                            {'signatures': signatures,
-                             'downtimes': escalation_downtimes,
-                             'sysID': sys_id,
-                             'msID': ms_id})
+    cache_key = 'sys_%s_sig_html_%s_%s_%s' % (sys_id, ms_id,
+                                              escalation_downtimes, revision)
+    content = cache.get(cache_key)
+    if content is None:
+        content = render_to_string("system_signatures.html",
+                                   {'signatures': signatures,
+                                    'downtimes': escalation_downtimes,
+                                    'sysID': sys_id,
+                                    'msID': ms_id,
+                                    'csrf_token': SIG_LIST_CSRF_PLACEHOLDER})
+        cache.set(cache_key, content, utils.SIG_LIST_TIMEOUT)
+    return HttpResponse(content.replace(SIG_LIST_CSRF_PLACEHOLDER,
+                                        get_token(request) or ''))
 
 
 # noinspection PyUnusedLocal
@@ -958,11 +1105,18 @@ def import_map(request):
 @require_map_permission(permission=1)
 def export_map(request, map_id):
     """
-    Exports a map as YAML.
+    Exports a map as YAML, shown in a dialog or, with format=yaml, streamed
+    as a file download.
     """
-    map_obj = get_object_or_404(Map, pk=map_id)
+    map_obj = request.current_map
     map_obj.add_log(user=request.user, action='Exported the map to YAML.',
                     visible=True)
+    if request.GET.get('format') == 'yaml':
+        response = StreamingHttpResponse(map_obj.yaml_chunks(),
+                                         content_type='application/x-yaml')
+        response['Content-Disposition'] = (
+            'attachment; filename="map-%s.yaml"' % map_obj.pk)
+        return response
     return TemplateResponse(request, 'export_map_dialog.html',
                             {'yaml_string': map_obj.as_yaml()})
 
@@ -1003,18 +1157,20 @@ def destination_list(request, map_id, ms_id):
     """
     if not request.is_ajax():
         raise PermissionDenied
-    destinations = Destination.objects.filter(Q(user=None) |
-                                              Q(user=request.user))
+    destinations = Destination.objects.filter(
+        Q(user=None) | Q(user=request.user)).select_related('system')
     map_system = get_object_or_404(MapSystem, pk=ms_id)
     try:
-        system = KSystem.objects.get(pk=map_system.system.pk)
+        system = KSystem.objects.get(pk=map_system.system_id)
         rf = utils.RouteFinder()
+        dest_systems = [destination.system for destination in destinations]
+        distances = rf.ly_distances(system, dest_systems)
         result = []
-        for destination in destinations:
+        for dest_system, distance in zip(dest_systems, distances):
             result.append((
-                destination.system,
-                rf.route_length(system, destination.system) - 1,
-                round(rf.ly_distance(system, destination.system), 3),
+                dest_system,
+                rf.route_length(system, dest_system) - 1,
+                round(distance, 3),
             ))
     except ObjectDoesNotExist:
         return HttpResponse()
@@ -1023,6 +1179,40 @@ def destination_list(request, map_id, ms_id):
                    'destinations': _sort_destinations(result)})
 
 
+@login_required
+@require_map_permission(permission=1)
+def map_exits(request, map_id):
+    """
+    Returns JSON listing, for each of the user's destinations, the k-space
+    system in the map with the fewest jumps to it.
+    """
+    if not request.is_ajax():
+        raise PermissionDenied
+    current_map = request.current_map
+    exits = (current_map.systems.filter(system__ksystem__isnull=False)
+             .select_related('system').order_by('pk'))
+    exit_systems = dict((ms.system_id, ms) for ms in exits)
+    destinations = Destination.objects.filter(
+        Q(user=None) | Q(user=request.user)).select_related('system')
+    dest_systems = [destination.system for destination in destinations]
+    closest = utils.RouteFinder().closest_exits(
+        [ms.system for ms in exits], dest_systems)
+    result = []
+    for dest_system in dest_systems:
+        nearest = closest[dest_system.pk]
+        entry = {'destination': dest_system.name,
+                 'destinationID': dest_system.pk,
+                 'exit': None, 'exitID': None, 'msID': None, 'jumps': None}
+        if nearest is not None:
+            map_system = exit_systems[nearest[0]]
+            entry.update({'exit': map_system.system.name,
+                          'exitID': map_system.system_id,
+                          'msID': map_system.pk,
+                          'jumps': nearest[1]})
+        result.append(entry)
+    return JsonResponse({'exits': result})
+
+
 # noinspection PyUnusedLocal
 def site_spawns(request, map_id, ms_id, sig_id):
     """
@@ -1395,7 +1585,12 @@ def move_system(request, map_id, ms_id, action):
     if action == 'up':
         mapsys.move_up()
     elif action == 'down':
-        mapsys.move_down();
+        mapsys.move_down()
+    elif action == 'to':
+        try:
+            mapsys.move_to(int(request.POST['index']))
+        except (KeyError, ValueError):
+            return HttpResponse(status=400)
     else:
         raise Http404
 
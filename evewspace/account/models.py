@@ -16,8 +16,8 @@ from django.db import models
 from django import forms
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager, Group
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
-from django.core.cache import cache
 from django.conf import settings
+from Map import locations
 from Map.models import Map, System
 from django.db.models.signals import post_save
 from django.utils import timezone
@@ -26,7 +26,6 @@ from django.core.mail import send_mail
 from django.utils.translation import ugettext_lazy as _
 import pytz
 import datetime
-import time
 # Create your models here.
 
 User = settings.AUTH_USER_MODEL
@@ -110,33 +109,15 @@ class EWSUser(AbstractBaseUser, PermissionsMixin):
 
     def update_location(self, sys_id, charid, charname, shipname, shiptype):
         """
-        Updates the cached locations dict for this user.
+        Records that one of this user's characters is in sys_id and returns
+        its Location.
         """
-        current_time = time.time()
-        user_cache_key = 'user_%s_locations' % self.pk
-        user_locations_dict = cache.get(user_cache_key)
-        time_threshold = current_time - (60 * 15)
-        location_tuple = (sys_id, charname, shipname, shiptype, current_time)
-        if user_locations_dict:
-            user_locations_dict.pop(charid, None)
-            user_locations_dict[charid] = location_tuple
-        else:
-            user_locations_dict = {charid: location_tuple}
-        # Prune dict to ensure we're not carrying over stale entries
-        for charid, location in user_locations_dict.items():
-            if location[4] < time_threshold:
-                user_locations_dict.pop(charid, None)
-
-        cache.set(user_cache_key, user_locations_dict, 60 * 15)
-        return user_locations_dict
+        return locations.get_store().update(self, sys_id, charid, charname,
+                                            shipname, shiptype)
 
     def get_settings(self):
-        from core.utils import get_config
-        from core.models import ConfigEntry
-        config_dict = dict()
-        for x in ConfigEntry.objects.filter(user=None).all():
-            config_dict[x.name] = get_config(x.name, self).value
-        return config_dict
+        from core.utils import get_settings
+        return get_settings(self)
 
 
 class GroupProfile(models.Model):
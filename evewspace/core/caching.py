@@ -0,0 +1,166 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Helpers for data cached in each process and shared through the cache.
+"""
+from collections import OrderedDict
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+# Seconds between checks of a ProcessCache's version key
+PROCESS_CACHE_CHECK_INTERVAL = 5
+
+
+class ProcessCache(object):
+    """
+    Base class for data held once per process.
+
+    Subclasses set version_key and implement reset() to drop what they
+    hold. The data is dropped in every process when the token stored under
+    version_key in the shared cache changes, which bump() does. Processes
+    check the token at most every PROCESS_CACHE_CHECK_INTERVAL seconds.
+    """
+    version_key = None
+
+    def __init__(self):
+        self.version = None
+        self.checked = 0
+        self.reset()
+
+    def reset(self):
+        raise NotImplementedError
+
+    def validate(self, force=False):
+        """Resets the data if the shared version token has changed."""
+        now = time.time()
+        if not force and now - self.checked < PROCESS_CACHE_CHECK_INTERVAL:
+            return
+        self.checked = now
+        version = cache.get(self.version_key)
+        # A missing token (e.g. memcached restarted) does not mean the
+        # data changed, so keep what we have.
+        if version is not None and version != self.version:
+            self.version = version
+            self.reset()
+
+    def bump(self):
+        """Marks the data as changed in every process."""
+        cache.set(self.version_key, '%r' % time.time(), None)
+        self.checked = 0
+
+
+class StaleWhileRevalidateCache(object):
+    """
+    Two tier cache for values that are expensive to build.
+
+    Values are kept in the shared cache for hard_timeout seconds and in an
+    LRU of the last local_size values in each process. A value is fresh for
+    soft_timeout seconds after it was built or until expire() is called.
+    The first caller to find it stale takes a lock in the shared cache and
+    rebuilds it while everyone else keeps getting the stale copy, so only
+    one process rebuilds at a time. Callers that find no copy at all wait
+    up to lock_timeout seconds for the rebuild before building their own.
+
+    Freshness is tracked by a small stamp key next to each value, so a
+    process only fetches the value from the shared cache when its local
+    copy is out of date.
+    """
+    poll_interval = 0.05
+
+    def __init__(self, soft_timeout, hard_timeout, lock_timeout=30,
+                 local_size=100):
+        self.soft_timeout = soft_timeout
+        self.hard_timeout = hard_timeout
+        self.lock_timeout = lock_timeout
+        self.local_size = local_size
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get_local(self, key):
+        with self.lock:
+            entry = self.local.pop(key, None)
+            if entry is not None:
+                self.local[key] = entry
+            return entry
+
+    def _set_local(self, key, entry):
+        with self.lock:
+            self.local.pop(key, None)
+            self.local[key] = entry
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def get(self, key, build, is_valid=None):
+        """
+        Returns the value cached under key, calling build() to make it
+        when it is missing or stale. is_valid, if given, is called with a
+        fresh value and can reject it, which makes it stale.
+        """
+        stamp = cache.get(key + '_stamp')
+        entry = self._get_local(key)
+        if entry is None or entry[0] != stamp:
+            entry = cache.get(key) or entry
+            if entry is not None:
+                self._set_local(key, entry)
+        if (entry is not None and stamp is not None and entry[0] == stamp and
+                (is_valid is None or is_valid(entry[1]))):
+            return entry[1]
+
+        lock_key = key + '_lock'
+        token = uuid.uuid4().hex
+        if cache.add(lock_key, token, self.lock_timeout):
+            return self._rebuild(key, build, token)
+        if entry is not None:
+            return entry[1]
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            entry = cache.get(key)
+            if entry is not None:
+                self._set_local(key, entry)
+                return entry[1]
+            if cache.add(lock_key, token, self.lock_timeout):
+                return self._rebuild(key, build, token)
+        return build()
+
+    def _rebuild(self, key, build, token):
+        """Builds and stores the value, then releases the lock if it is
+        still ours. A build that outlives lock_timeout leaves alone the
+        lock another caller has taken since.
+        """
+        lock_key = key + '_lock'
+        try:
+            value = build()
+            entry = ('%r' % time.time(), value)
+            cache.set(key, entry, self.hard_timeout)
+            cache.set(key + '_stamp', entry[0], self.soft_timeout)
+            self._set_local(key, entry)
+            return value
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    def is_fresh(self, key):
+        """Returns whether the value under key is fresh, without fetching
+        it. is_valid is not checked.
+        """
+        return cache.get(key + '_stamp') is not None
+
+    def expire(self, key):
+        """Marks the value under key stale in every process."""
+        cache.delete(key + '_stamp')
@@ -15,7 +15,7 @@
 from django.core.management.base import NoArgsCommand, CommandError
 from core.models import *
 from Map.models import *
-from Map.utils import RouteFinder
+from Map.utils import RouteFinder, invalidate_system_classes
 import datetime
 import pytz
 
@@ -78,3 +78,5 @@ class Command(NoArgsCommand):
                     newdata.save()
             except LocationWormholeClass.DoesNotExist:
                 pass
+        # The IGB checkin looks classes up from a copy in each process
+        invalidate_system_classes()
@@ -0,0 +1,25 @@
+#   Eve W-Space
+#   Copyright 2014 Andrew Austin and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from core.utils import check_config
+
+
+class ConfigCacheMiddleware(object):
+    """
+    Checks the cached config entries against the shared version at the
+    start of each request, so a setting saved by another process is seen
+    by the next request rather than after the usual check interval.
+    """
+    def process_request(self, request):
+        check_config()
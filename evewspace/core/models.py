@@ -13,6 +13,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 from django.conf import settings
 # Core models contains models used across multiple apps
 
@@ -245,3 +246,12 @@ class Faction(models.Model):
     class Meta:
         managed = False
         db_table = u'chrFactions'
+
+
+def config_entry_changed(sender, **kwargs):
+    """Drops the cached config entries when a ConfigEntry changes."""
+    from core.utils import invalidate_config
+    invalidate_config()
+
+post_save.connect(config_entry_changed, sender=ConfigEntry)
+post_delete.connect(config_entry_changed, sender=ConfigEntry)
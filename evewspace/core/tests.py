@@ -19,7 +19,16 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+
+from core.caching import StaleWhileRevalidateCache
+from core.models import ConfigEntry
+from core.utils import get_config, get_settings, invalidate_config
 
 
 class SimpleTest(TestCase):
@@ -28,3 +37,119 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class ConfigCacheTest(TestCase):
+    def setUp(self):
+        invalidate_config()
+        self.user = get_user_model().objects.create_user('pilot',
+                                                         password='pilot')
+        ConfigEntry.objects.create(name='TEST_A', value='1')
+        ConfigEntry.objects.create(name='TEST_B', value='2')
+        ConfigEntry.objects.create(name='TEST_B', value='3', user=self.user)
+
+    def test_user_value_has_priority(self):
+        self.assertEqual(get_config('TEST_A', self.user).value, '1')
+        self.assertEqual(get_config('TEST_B', self.user).value, '3')
+        self.assertEqual(get_config('TEST_B', None).value, '2')
+        self.assertEqual(get_settings(self.user),
+                         {'TEST_A': '1', 'TEST_B': '3'})
+        self.assertRaises(ConfigEntry.DoesNotExist, get_config,
+                          'TEST_MISSING', None)
+
+    def test_lookups_are_cached(self):
+        get_config('TEST_A', self.user)
+        with self.assertNumQueries(0):
+            get_config('TEST_A', self.user)
+            get_config('TEST_B', self.user)
+            get_settings(self.user)
+
+    def test_entries_are_copies_and_saves_write_through(self):
+        entry = get_config('TEST_A', self.user)
+        self.assertIsNone(entry.user)
+        entry.value = '5'
+        self.assertEqual(get_config('TEST_A', None).value, '1')
+        entry.save()
+        self.assertEqual(get_config('TEST_A', None).value, '5')
+        self.assertEqual(ConfigEntry.objects.filter(name='TEST_A').count(), 1)
+
+
+class StaleWhileRevalidateCacheTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache = StaleWhileRevalidateCache(60, 600, local_size=2)
+        self.builds = []
+
+    def build(self, value='new', delay=0):
+        def _build():
+            self.builds.append(value)
+            time.sleep(delay)
+            return value
+        return _build
+
+    def _concurrent_gets(self, count=50):
+        """Calls get from count threads at once while a slow rebuild runs.
+        """
+        start = threading.Event()
+        results = []
+
+        def run():
+            start.wait()
+            results.append(self.cache.get('key', self.build(delay=0.3)))
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_fresh_values_are_not_rebuilt(self):
+        self.assertEqual(self.cache.get('key', self.build('old')), 'old')
+        self.assertEqual(self.cache.get('key', self.build()), 'old')
+        self.assertEqual(self.builds, ['old'])
+        self.cache.expire('key')
+        self.assertEqual(self.cache.get('key', self.build()), 'new')
+        self.assertEqual(
+            self.cache.get('key', self.build('rejected'),
+                           lambda value: value != 'new'), 'rejected')
+
+    def test_single_rebuild_serves_stale(self):
+        self.cache.get('key', self.build('old'))
+        self.cache.expire('key')
+        results = self._concurrent_gets()
+        self.assertEqual(self.builds, ['old', 'new'])
+        self.assertEqual(sorted(set(results)), ['new', 'old'])
+        self.assertEqual(self.cache.get('key', self.build()), 'new')
+
+    def test_single_rebuild_when_missing(self):
+        results = self._concurrent_gets()
+        self.assertEqual(self.builds, ['new'])
+        self.assertEqual(results, ['new'] * 50)
+
+    def test_slow_rebuild_keeps_a_newer_lock(self):
+        def build():
+            # The lock expired and another caller took it meanwhile
+            cache.set('key_lock', 'other', 60)
+            return 'new'
+        self.assertEqual(self.cache.get('key', build), 'new')
+        self.assertEqual(cache.get('key_lock'), 'other')
+        self.cache.expire('key')
+        self.assertEqual(self.cache.get('key', self.build('stale')), 'new')
+        self.assertEqual(self.builds, [])
+        cache.delete('key_lock')
+        self.assertEqual(self.cache.get('key', self.build()), 'new')
+        self.assertIsNone(cache.get('key_lock'))
+        self.assertEqual(self.builds, ['new'])
+
+    def test_local_values_follow_the_shared_cache(self):
+        other = StaleWhileRevalidateCache(60, 600)
+        self.cache.get('key', self.build('old'))
+        self.assertEqual(other.get('key', self.build()), 'old')
+        other.expire('key')
+        self.assertEqual(other.get('key', self.build()), 'new')
+        self.assertEqual(self.cache.get('key', self.build('unused')), 'new')
+        self.cache.get('a', self.build('a'))
+        self.cache.get('b', self.build('b'))
+        self.assertEqual(list(self.cache.local), ['a', 'b'])
@@ -12,14 +12,87 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+from core.caching import ProcessCache
 from core.models import ConfigEntry
 
+
+class _ConfigCache(ProcessCache):
+    """
+    ConfigEntry rows held by this process: the global defaults, loaded in
+    one query, and each user's overrides, loaded in one query the first
+    time the user is seen.
+    """
+    version_key = 'config_version'
+
+    def reset(self):
+        self.defaults = None
+        self.overrides = {}
+
+    def get_entries(self, user_id):
+        """Returns the (defaults, overrides) dicts of entries by name."""
+        self.validate()
+        if self.defaults is None:
+            self.defaults = dict((x.name, x) for x in
+                                 ConfigEntry.objects.filter(user=None))
+        if user_id is None:
+            return self.defaults, {}
+        if user_id not in self.overrides:
+            self.overrides[user_id] = dict(
+                (x.name, x) for x in
+                ConfigEntry.objects.filter(user_id=user_id))
+        return self.defaults, self.overrides[user_id]
+
+_config_cache = _ConfigCache()
+
+
+def check_config():
+    """Drops the cached config entries if another process changed them."""
+    _config_cache.validate(force=True)
+
+
+def invalidate_config():
+    """Drops the cached config entries in every process."""
+    _config_cache.bump()
+    _config_cache.reset()
+
+
+def _user_id(user):
+    # Callers pass None or False for the global value
+    if not user:
+        return None
+    return user.pk
+
+
 def get_config(name, user):
     """
     Gets the correct config value for the given key name.
     Value with the given user has priority over any default value.
+
+    Returns a copy of the cached entry, so callers may change and save it.
+    """
+    user_id = _user_id(user)
+    defaults, overrides = _config_cache.get_entries(user_id)
+    entry = overrides.get(name, None) or defaults.get(name, None)
+    if entry is None:
+        raise ConfigEntry.DoesNotExist(
+            'ConfigEntry matching query does not exist.')
+    result = ConfigEntry(id=entry.id, name=entry.name, value=entry.value,
+                         user_id=entry.user_id)
+    result._state.adding = False
+    result._state.db = entry._state.db
+    if entry.user_id is not None:
+        result.user = user
+    return result
+
+
+def get_settings(user):
+    """
+    Returns a dict of every config value by name, with the user's values
+    taking priority over the defaults.
     """
-    try:
-        return ConfigEntry.objects.get(name=name, user=user)
-    except ConfigEntry.DoesNotExist:
-        return ConfigEntry.objects.get(name=name, user=None)
+    defaults, overrides = _config_cache.get_entries(_user_id(user))
+    result = dict((name, x.value) for name, x in defaults.items())
+    for name in result:
+        if name in overrides:
+            result[name] = overrides[name].value
+    return result
@@ -7,6 +7,8 @@ ADMINS = (
         # ('Your Name', 'your_email@example.com'),
 )
 
+import os
+
 # import Celery config
 import djcelery
 djcelery.setup_loader()
@@ -83,6 +85,29 @@ CACHES = {
         'TIMEOUT': 0
     }
 }
+# Broker used to push map events to clients. CacheBroker shares events
+# between processes through the cache above; Map.pubsub.LocalBroker only
+# reaches clients served by the same process.
+MAP_PUBSUB_BACKEND = 'Map.pubsub.CacheBroker'
+# Store for the systems pilots are in. CacheLocationStore shares them
+# between processes through the cache above; Map.locations.LocalLocationStore
+# keeps them in the current process only.
+MAP_LOCATION_BACKEND = 'Map.locations.CacheLocationStore'
+# Push map changes to browsers over server-sent events instead of only
+# polling. Each open map then holds a worker for up to
+# MAP_EVENT_STREAM_TIMEOUT seconds, so only enable this when serving the
+# site with a threaded or evented worker class (e.g. gunicorn with
+# --worker-class=gevent); with sync workers a few open maps block the site.
+MAP_EVENT_STREAM = False
+# Seconds an event stream stays open before the browser reconnects.
+MAP_EVENT_STREAM_TIMEOUT = 55
+# Path, without extension, of the precomputed stargate jump table built
+# by "manage.py buildjumptable". Route lookups use networkx without it.
+# The default files are ignored by git; point this elsewhere if the source
+# tree is read only.
+MAP_JUMP_TABLE_PATH = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'jumptable')
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -166,6 +191,7 @@ MIDDLEWARE_CLASSES = (
         'django.contrib.messages.middleware.MessageMiddleware',
         'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
         'eveigb.middleware.IGBMiddleware',
+        'core.middleware.ConfigCacheMiddleware',
 )
 
 ROOT_URLCONF = 'evewspace.urls'